@@ -4,6 +4,7 @@
 #include "src/i2c_handler/i2c_handler.h"
 #include "src/can_handler/can_handler.h"
 #include "src/temperature_handler/temperature_handler.h" // Include the new temperature handler
+#include "esp_timer.h"
 
 // ####################################################################
 //                 MASTER ID, individual for each tester board
@@ -26,6 +27,12 @@ Role currentRole = UNKNOWN; // This is now the definitive declaration
 #define UART_TX_PIN 17
 #define UART_RX_PIN 16
 #define UART_BAUD_RATE 115200
+#define USB_BAUD_RATE 115200
+#define USB_FRAMING "8N1"
+// Longest command line accepted from the PC, RUN_CURRENT_SEQ carries a code list
+#define CMD_BUFFER_SIZE 256
+// Longest reply line, CAPABILITIES and LATENCY list every command
+#define REPLY_BUFFER_SIZE 1024
 
 MasterSpiHandler* masterHandler = nullptr;
 SlaveSpiHandler* slaveHandler = nullptr;
@@ -41,152 +48,978 @@ bool master_last_power_state = false;
 
 
 // ####################################################################
-// #                       MAIN LOGIC & LOOPS                         #
+// #                      DEVICE TIMESTAMPS                           #
 // ####################################################################
 
-void slave_loop() {
-  if (UART_SERIAL.available() > 0) {
-    String command = UART_SERIAL.readStringUntil('\n');
-    command.trim();
-
-    if (command.startsWith("START_CAN_TEST ")) {
-        int num_messages = command.substring(15).toInt();
-        run_can_communication_test(num_messages);
-    } else if (command == "GET_CAN_RESULTS") {
-        char buf[100];
-        snprintf(buf, sizeof(buf), "CAN_RESULTS:%d,%d,%d,%d", testResults.tx_ok, testResults.tx_fail, testResults.rx_ok, testResults.crosstalk);
-        UART_SERIAL.println(buf);
-    } else if (command == "CHECK_SPI_ADC") {
-      AdcReadings r = slaveHandler->readAllAdcValues();
-      char buf[100];
-      snprintf(buf, sizeof(buf), "DATA:%.4f,%.4f,%.4f,%.4f", r.cic_v, r.cic_i, r.vcan_v, r.vcan_i);
-      UART_SERIAL.println(buf);
-    } else if (command == "READ_I2C_VOLTAGE_B") {
-      float v = get_i2c_voltage();
-      char buf[50];
-      snprintf(buf, sizeof(buf), "I2C_VOLTAGE_B:%.4f", v);
-      UART_SERIAL.println(buf);
-    } else if (command.startsWith("SET_I2C_CURRENT ")) {
-      uint16_t val = command.substring(16).toInt();
-      set_i2c_load_current(val);
-    } else if (command == "READ_TEMP") {
-      float temp = get_temperature();
-      char buf[50];
-      snprintf(buf, sizeof(buf), "TEMP_B:%.2f", temp);
-      UART_SERIAL.println(buf);
-    } else if (command == "GET_TEST_INFO") {
-        char buf[100];
-        snprintf(buf, sizeof(buf), "TEST_INFO:%s:%.2f", MASTER_ID, LAB_PSU_VOLTAGE);
-        UART_SERIAL.println(buf);
+/**
+ * @brief Returns the master's monotonic clock in microseconds since boot.
+ * This clock does not wrap for the lifetime of a test session.
+ */
+uint64_t device_time_us() {
+  return (uint64_t)esp_timer_get_time();
+}
+
+
+// ####################################################################
+// #                          LINE I/O                                #
+// ####################################################################
+//
+// Commands and replies go through fixed buffers instead of Arduino Strings
+// and Serial.printf, which allocate on the heap for every line. Over a long
+// sweep that fragments the heap and makes the turnaround vary.
+
+// Every reply is formatted here and handed to the UART in a single write
+static char reply_buf[REPLY_BUFFER_SIZE];
+
+/**
+ * @brief Terminates the first len characters of reply_buf with a newline and writes them.
+ * Replies longer than the buffer are cut.
+ */
+void write_reply(Print& out, int len) {
+  if (len < 0) return;
+  if (len > REPLY_BUFFER_SIZE - 2) len = REPLY_BUFFER_SIZE - 2;
+  reply_buf[len++] = '\n';
+  out.write((const uint8_t*)reply_buf, len);
+}
+
+/**
+ * @brief printf-style line output to the PC (Serial) or the slave (UART_SERIAL) without heap use.
+ * The arguments must not point into reply_buf.
+ */
+void send_line(Print& out, const char* format, ...) __attribute__((format(printf, 2, 3)));
+void send_line(Print& out, const char* format, ...) {
+  va_list args;
+  va_start(args, format);
+  int len = vsnprintf(reply_buf, REPLY_BUFFER_SIZE - 1, format, args);
+  va_end(args);
+  write_reply(out, len);
+}
+
+/**
+ * @brief Prints a measurement line with the device timestamp appended,
+ * e.g. "VCAN_DATA:1.9000,1.9000;T=123456789".
+ * @param line The measurement line without newline.
+ * @param t_us The device time at which the measurement was completed.
+ */
+void println_stamped(const char* line, uint64_t t_us) {
+  send_line(Serial, "%s;T=%llu", line, (unsigned long long)t_us);
+}
+
+bool starts_with(const char* line, const char* prefix) {
+  return strncmp(line, prefix, strlen(prefix)) == 0;
+}
+
+/**
+ * @brief Returns true for slave responses that carry measurement data.
+ * These are stamped on arrival at the master, since only the master's
+ * clock is synchronised with the PC.
+ */
+bool is_measurement_line(const char* line) {
+  return starts_with(line, "DATA:") || starts_with(line, "DATA_AGG:") || starts_with(line, "I2C_VOLTAGE_B:");
+}
+
+/**
+ * @brief Assembles lines from a serial port in a fixed buffer without blocking.
+ * Replaces readBytesUntil/readStringUntil, which allocate and wait for their
+ * timeout when a line arrives in pieces.
+ */
+struct LineReader {
+  char buf[CMD_BUFFER_SIZE];
+  size_t len = 0;
+  bool truncated = false;   // The line was longer than the buffer and was cut
+  bool complete = false;
+  uint64_t t_us = 0;        // Device time at which the line ending arrived
+
+  /**
+   * @brief Consumes the bytes available on 'in' up to the next line ending.
+   * @return true once a complete line is in buf, without line ending and surrounding blanks.
+   * The line stays valid until the next call.
+   */
+  bool poll(Stream& in) {
+    if (complete) clear();
+    while (in.available() > 0) {
+      char c = (char)in.read();
+      if (c == '\n') {
+        t_us = device_time_us();
+        while (len > 0 && isspace((unsigned char)buf[len - 1])) len--;
+        buf[len] = '\0';
+        complete = true;
+        return true;
+      }
+      if (len == 0 && isspace((unsigned char)c)) continue;
+      if (len < sizeof(buf) - 1) { buf[len++] = c; } else { truncated = true; }
+    }
+    return false;
+  }
+
+  void clear() {
+    len = 0;
+    truncated = false;
+    complete = false;
+  }
+};
+
+// Commands from the PC (master) and lines from the other board
+LineReader usb_line;
+LineReader uart_line;
+
+
+// ####################################################################
+// #                       COMMAND DISPATCH                           #
+// ####################################################################
+//
+// Commands are looked up by the FNV-1a hash of their first word in a table,
+// instead of a chain of string comparisons. The hashes of the table entries are
+// computed at compile time, the hash of a received command while it is scanned.
+// Every entry counts the turnaround of its command, from the line ending to the
+// reply being written, which the PC reads with GET_LATENCY.
+
+#define FNV_OFFSET_BASIS 2166136261u
+#define FNV_PRIME 16777619u
+
+constexpr uint32_t command_hash(const char* name, uint32_t hash = FNV_OFFSET_BASIS) {
+  return *name ? command_hash(name + 1, (hash ^ (uint8_t)*name) * FNV_PRIME) : hash;
+}
+
+// Called with the whole command line and the arguments after the command word ("" if none)
+typedef void (*CommandHandler)(const char* line, const char* args);
+
+struct CommandEntry {
+  const char* name;
+  uint32_t hash;
+  CommandHandler handler;
+  // Turnaround statistics in microseconds
+  uint32_t count;
+  uint32_t max_us;
+  uint64_t total_us;
+};
+
+#define COMMAND(name, handler) { name, command_hash(name), handler, 0, 0, 0 }
+
+// A command whose turnaround is being measured, with the time its line ended
+struct Turnaround {
+  CommandEntry* command = nullptr;
+  uint64_t t_us = 0;
+};
+
+// The command being handled
+Turnaround active_command;
+
+void record_turnaround(Turnaround& turnaround) {
+  if (turnaround.command == nullptr) return;
+  uint32_t elapsed_us = (uint32_t)(device_time_us() - turnaround.t_us);
+  CommandEntry* command = turnaround.command;
+  command->count++;
+  command->total_us += elapsed_us;
+  if (elapsed_us > command->max_us) command->max_us = elapsed_us;
+  turnaround.command = nullptr;
+}
+
+/**
+ * @brief Finds the table entry for the command word of 'line'.
+ * @param args Receives the arguments after the command word.
+ * @return The entry, or nullptr for an unknown command.
+ */
+CommandEntry* find_command(CommandEntry* table, size_t size, const char* line, const char** args) {
+  uint32_t hash = FNV_OFFSET_BASIS;
+  const char* p = line;
+  for (; *p && *p != ' '; p++) hash = (hash ^ (uint8_t)*p) * FNV_PRIME;
+  size_t word_len = p - line;
+  *args = *p ? p + 1 : p;
+  for (size_t i = 0; i < size; i++) {
+    // The name is compared as well, so a hash collision cannot run the wrong command
+    if (table[i].hash == hash && strncmp(table[i].name, line, word_len) == 0 && table[i].name[word_len] == '\0') {
+      return &table[i];
     }
   }
+  return nullptr;
 }
 
-void master_loop() {
-  if (Serial.available() > 0) {
-    char cmdBuffer[50];
-    int bytesRead = Serial.readBytesUntil('\n', cmdBuffer, sizeof(cmdBuffer) - 1);
-    cmdBuffer[bytesRead] = '\0';
-
-    int setting;
-    uint16_t dacValue;
-    int num_messages;
-
-    if (sscanf(cmdBuffer, "RUN_CAN_TEST %d", &num_messages) == 1) {
-        // 1. Command slave to start its test
-        UART_SERIAL.printf("START_CAN_TEST %d\n", num_messages);
-
-        // 2. Run our test simultaneously
-        run_can_communication_test(num_messages);
-
-        // 3. Request results from slave
-        delay(100);
-        while(UART_SERIAL.available() > 0) { UART_SERIAL.read(); } // Clear UART buffer
-        UART_SERIAL.println("GET_CAN_RESULTS");
-
-        bool received = false;
-        unsigned long start_time = millis();
-        while(millis() - start_time < 2000 && !received) {
-            if(UART_SERIAL.available() > 0) {
-                String response = UART_SERIAL.readStringUntil('\n');
-                int s_tx_ok, s_tx_fail, s_rx_ok, s_crosstalk;
-                if(sscanf(response.c_str(), "CAN_RESULTS:%d,%d,%d,%d", &s_tx_ok, &s_tx_fail, &s_rx_ok, &s_crosstalk) == 4) {
-                    received = true;
-                    Serial.println("CAN_TEST_PROGRESS: Received results from slave.");
-
-                    // 4. Final validation
-                    bool pass = (testResults.tx_fail == 0 && testResults.rx_ok >= num_messages && testResults.crosstalk == 0 &&
-                                 s_tx_fail == 0 && s_rx_ok >= num_messages && s_crosstalk == 0);
-                    const char* result_str = pass ? "PASS" : "FAIL";
-
-                    Serial.printf("CAN_TEST_FINAL:%s:Master(tx_ok:%d,tx_fail:%d,rx_ok:%d,crosstalk:%d) Slave(tx_ok:%d,tx_fail:%d,rx_ok:%d,crosstalk:%d)\n",
-                        result_str,
-                        testResults.tx_ok, testResults.tx_fail, testResults.rx_ok, testResults.crosstalk,
-                        s_tx_ok, s_tx_fail, s_rx_ok, s_crosstalk);
-                }
-            }
-        }
-        if(!received) Serial.println("CAN_TEST_FINAL:FAIL:No results response from slave.");
-
-    } else if (strcmp(cmdBuffer, "READ_TEMP") == 0) {
-        float master_temp = get_temperature();
-
-        while(UART_SERIAL.available() > 0) { UART_SERIAL.read(); } // Clear UART buffer
-        UART_SERIAL.println("READ_TEMP");
-
-        bool received = false;
-        float slave_temp = 99.00; // Default fail value
-        unsigned long start_time = millis();
-        while(millis() - start_time < 2000 && !received) {
-            if(UART_SERIAL.available() > 0) {
-                String response = UART_SERIAL.readStringUntil('\n');
-                float temp_val;
-                if(sscanf(response.c_str(), "TEMP_B:%f", &temp_val) == 1) {
-                    slave_temp = temp_val;
-                    received = true;
-                }
-            }
+/**
+ * @brief Runs a received command and records its turnaround from t_us, the time its line ended.
+ * @return false if the command is not in the table.
+ */
+bool dispatch(CommandEntry* table, size_t size, const char* line, uint64_t t_us) {
+  const char* args;
+  CommandEntry* command = find_command(table, size, line, &args);
+  if (command == nullptr) return false;
+  active_command.command = command;
+  active_command.t_us = t_us;
+  command->handler(line, args);
+  record_turnaround(active_command);
+  return true;
+}
+
+
+// ####################################################################
+// #                      MASTER-SLAVE LINK                           #
+// ####################################################################
+//
+// Requests to the slave are framed as "#<id>|<command>*<checksum>" and the slave
+// answers "#<id>|<reply>*<checksum>", with the id and the checksum (XOR of the
+// characters between '#' and '*') in two hex digits. The id lets the master keep
+// several requests in flight and match every reply to its request: a command
+// that needs both boards sends the slave's part first, takes the master's own
+// measurement meanwhile and then collects the reply, so channel B costs no
+// extra round trip. Id 00 marks commands without a reply. Corrupt frames are
+// dropped and the request times out. Unframed lines are still understood.
+
+// Slave requests the master keeps open at the same time
+#define MAX_SLAVE_IN_FLIGHT 8
+// A relayed request without reply is answered with ERR:SLAVE_TIMEOUT after this
+#define SLAVE_TIMEOUT_MS 1000
+
+struct SlaveRequest {
+  uint8_t id = 0;               // 0 while the slot is free
+  bool relay = false;           // The reply is forwarded to the PC as it arrives
+  const char* name = nullptr;   // The PC command, for the timeout error
+  unsigned long sent_ms = 0;
+  Turnaround turnaround;        // The PC command waiting for the reply
+};
+
+SlaveRequest slave_requests[MAX_SLAVE_IN_FLIGHT];
+uint8_t next_slave_id = 1;
+// Id of the request the slave is handling, -1 for an unframed command
+int slave_frame_id = -1;
+
+uint8_t frame_checksum(const char* start, size_t len) {
+  uint8_t checksum = 0;
+  for (size_t i = 0; i < len; i++) checksum ^= (uint8_t)start[i];
+  return checksum;
+}
+
+/**
+ * @brief Formats "#<id>|<payload>*<checksum>" into reply_buf and writes it.
+ */
+void send_frame(Print& out, uint8_t id, const char* format, va_list args) {
+  int len = snprintf(reply_buf, REPLY_BUFFER_SIZE, "#%02X|", id);
+  int payload = vsnprintf(reply_buf + len, REPLY_BUFFER_SIZE - len - 4, format, args);
+  if (payload < 0) return;
+  len += payload < REPLY_BUFFER_SIZE - len - 5 ? payload : REPLY_BUFFER_SIZE - len - 5;
+  len += snprintf(reply_buf + len, REPLY_BUFFER_SIZE - len, "*%02X", frame_checksum(reply_buf + 1, len - 1));
+  write_reply(out, len);
+}
+
+void send_frame(Print& out, uint8_t id, const char* format, ...) __attribute__((format(printf, 3, 4)));
+void send_frame(Print& out, uint8_t id, const char* format, ...) {
+  va_list args;
+  va_start(args, format);
+  send_frame(out, id, format, args);
+  va_end(args);
+}
+
+int hex_digit(char c) {
+  if (c >= '0' && c <= '9') return c - '0';
+  if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+  return -1;
+}
+
+/**
+ * @brief Splits a framed line in place into its id and payload.
+ * @return The payload, or nullptr for an unframed line or a frame with a bad checksum.
+ */
+char* parse_frame(char* line, size_t len, uint8_t* id) {
+  if (len < 7 || line[0] != '#' || line[3] != '|' || line[len - 3] != '*') return nullptr;
+  int id_hi = hex_digit(line[1]), id_lo = hex_digit(line[2]);
+  int cs_hi = hex_digit(line[len - 2]), cs_lo = hex_digit(line[len - 1]);
+  if (id_hi < 0 || id_lo < 0 || cs_hi < 0 || cs_lo < 0) return nullptr;
+  if (frame_checksum(line + 1, len - 4) != (uint8_t)(cs_hi * 16 + cs_lo)) return nullptr;
+  line[len - 3] = '\0';
+  *id = (uint8_t)(id_hi * 16 + id_lo);
+  return line + 4;
+}
+
+/**
+ * @brief Sends a command the slave does not answer, e.g. SET_I2C_CURRENT.
+ */
+void send_to_slave(const char* command) {
+  send_frame(UART_SERIAL, 0, "%s", command);
+}
+
+/**
+ * @brief Sends a request to the slave without waiting for the reply.
+ * @return The open request, or nullptr if MAX_SLAVE_IN_FLIGHT requests are open.
+ */
+SlaveRequest* slave_request(const char* command) {
+  SlaveRequest* free_slot = nullptr;
+  for (SlaveRequest& request : slave_requests) {
+    if (request.id == 0) { free_slot = &request; break; }
+  }
+  if (free_slot == nullptr) return nullptr;
+  // Skip 0 and the ids of open requests, a late reply must not match a new request
+  for (bool in_use = true; in_use; ) {
+    if (++next_slave_id == 0) next_slave_id = 1;
+    in_use = false;
+    for (const SlaveRequest& request : slave_requests) in_use |= request.id == next_slave_id;
+  }
+  free_slot->id = next_slave_id;
+  free_slot->relay = false;
+  free_slot->sent_ms = millis();
+  free_slot->turnaround.command = nullptr;
+  send_frame(UART_SERIAL, free_slot->id, "%s", command);
+  return free_slot;
+}
+
+/**
+ * @brief Forwards a reply line from the slave to the PC. Measurement lines are stamped
+ * with their arrival time, since only the master's clock is synchronised with the PC.
+ */
+void forward_to_pc(const char* line, uint64_t t_us) {
+  if (is_measurement_line(line)) {
+    println_stamped(line, t_us);
+  } else {
+    send_line(Serial, "%s", line);
+  }
+}
+
+/**
+ * @brief Handles a line from the slave. The reply to the awaited request (id, 0 for none)
+ * is returned. Other replies to relayed requests and unframed lines are forwarded to the
+ * PC, replies to timed out requests are dropped.
+ * @return The payload of the awaited reply, or nullptr.
+ */
+const char* handle_slave_line(LineReader& line, uint8_t awaited) {
+  uint8_t id;
+  const char* payload = parse_frame(line.buf, line.len, &id);
+  if (payload == nullptr) {
+    if (line.buf[0] != '#') forward_to_pc(line.buf, line.t_us);
+    return nullptr;
+  }
+  if (id != 0 && id == awaited) return payload;
+  for (SlaveRequest& request : slave_requests) {
+    if (request.id != 0 && request.id == id) {
+      if (request.relay) {
+        forward_to_pc(payload, line.t_us);
+        record_turnaround(request.turnaround);
+      }
+      request.id = 0;
+      break;
+    }
+  }
+  return nullptr;
+}
+
+/**
+ * @brief Collects the reply to a request. Lines for other requests that arrive
+ * meanwhile are handled as usual.
+ * @param prefix The reply must start with this.
+ * @return The reply, valid until the next read from the slave, or nullptr if it did not
+ * arrive within timeout_ms of sending or if request is nullptr.
+ */
+const char* await_slave(SlaveRequest* request, const char* prefix, unsigned long timeout_ms) {
+  if (request == nullptr) return nullptr;
+  const char* reply = nullptr;
+  while(reply == nullptr && millis() - request->sent_ms < timeout_ms) {
+    if (uart_line.poll(UART_SERIAL)) reply = handle_slave_line(uart_line, request->id);
+  }
+  request->id = 0;
+  return reply != nullptr && starts_with(reply, prefix) ? reply : nullptr;
+}
+
+/**
+ * @brief Sends a command to the slave and waits for its reply.
+ * @param prefix The reply line must start with this.
+ * @return The reply line, valid until the next read from the slave, or nullptr
+ * if it did not arrive within timeout_ms.
+ */
+const char* query_slave(const char* command, const char* prefix, unsigned long timeout_ms) {
+  return await_slave(slave_request(command), prefix, timeout_ms);
+}
+
+/**
+ * @brief Forwards a PC command to the slave. master_loop relays the reply to the PC
+ * when it arrives, so the master keeps accepting commands meanwhile. The turnaround
+ * of the command then ends with the relayed reply.
+ */
+void relay_to_slave(const char* line) {
+  SlaveRequest* request = slave_request(line);
+  if (request == nullptr) {
+    send_line(Serial, "ERR:SLAVE_BUSY:%d", MAX_SLAVE_IN_FLIGHT);
+    return;
+  }
+  request->relay = true;
+  request->name = active_command.command->name;
+  request->turnaround = active_command;
+  active_command.command = nullptr;
+}
+
+/**
+ * @brief Answers relayed requests the slave did not reply to within SLAVE_TIMEOUT_MS,
+ * so the PC does not wait for its own timeout.
+ */
+void expire_slave_requests() {
+  for (SlaveRequest& request : slave_requests) {
+    if (request.id != 0 && request.relay && millis() - request.sent_ms >= SLAVE_TIMEOUT_MS) {
+      send_line(Serial, "ERR:SLAVE_TIMEOUT:%s", request.name);
+      request.id = 0;
+    }
+  }
+}
+
+/**
+ * @brief Slave side: replies to the request being handled, framed with its id if it was framed.
+ */
+void reply_to_master(const char* format, ...) __attribute__((format(printf, 1, 2)));
+void reply_to_master(const char* format, ...) {
+  va_list args;
+  va_start(args, format);
+  if (slave_frame_id >= 0) {
+    send_frame(UART_SERIAL, (uint8_t)slave_frame_id, format, args);
+  } else {
+    write_reply(UART_SERIAL, vsnprintf(reply_buf, REPLY_BUFFER_SIZE - 1, format, args));
+  }
+  va_end(args);
+}
+
+
+// ####################################################################
+// #                     CAPABILITIES HANDSHAKE                       #
+// ####################################################################
+
+// Increase when the format of an existing command or reply changes
+#define PROTOCOL_VERSION 1
+// Largest number of measurements a single batched command may request,
+// e.g. the conversions aggregated by "CHECK_SPI_ADC <n>"
+#define MAX_BATCH_SIZE 64
+
+
+// ####################################################################
+// #                       ADC OVERSAMPLING                           #
+// ####################################################################
+
+/**
+ * @brief Running mean (Welford), variance, minimum and maximum of one ADC channel.
+ */
+struct ChannelAggregate {
+  int n = 0;
+  float mean = 0.0f, m2 = 0.0f, min = INFINITY, max = -INFINITY;
+
+  void add(float value) {
+    n++;
+    float delta = value - mean;
+    mean += delta / n;
+    m2 += delta * (value - mean);
+    if (value < min) min = value;
+    if (value > max) max = value;
+  }
+
+  // Sample standard deviation (n - 1), 0 for a single conversion
+  float std() const { return n > 1 ? sqrtf(m2 / (n - 1)) : 0.0f; }
+};
+
+/**
+ * @brief Slave side of "CHECK_SPI_ADC <n>": takes n conversions of all four ADC channels
+ * back to back and formats the aggregate reply
+ * "DATA_AGG:<n>:<cic_v mean>,<min>,<max>,<std>,<cic_i ...>,<vcan_v ...>,<vcan_i ...>".
+ * The values have more digits than a single reading, as the mean resolves below one LSB.
+ */
+void format_adc_aggregate(int samples, char* buf, size_t size) {
+  samples = constrain(samples, 1, MAX_BATCH_SIZE);
+  ChannelAggregate channels[4];
+  for (int n = 0; n < samples; n++) {
+    AdcReadings r = slaveHandler->readAllAdcValues();
+    channels[0].add(r.cic_v);
+    channels[1].add(r.cic_i);
+    channels[2].add(r.vcan_v);
+    channels[3].add(r.vcan_i);
+  }
+  int len = snprintf(buf, size, "DATA_AGG:%d:", samples);
+  for (int c = 0; c < 4 && len < (int)size; c++) {
+    len += snprintf(buf + len, size - len, c == 0 ? "%.6f,%.6f,%.6f,%.6f" : ",%.6f,%.6f,%.6f,%.6f",
+                    channels[c].mean, channels[c].min, channels[c].max, channels[c].std());
+  }
+}
+
+
+// ####################################################################
+// #                FIRMWARE-SEQUENCED CURRENT TEST                   #
+// ####################################################################
+
+// Most voltage codes a single RUN_CURRENT_SEQ may carry
+#define MAX_SEQ_CODES 16
+// Slave ADC conversions averaged for the current of board B
+#define SEQ_CURRENT_SAMPLES 16
+
+/**
+ * @brief Sets the VCAN voltage code on both channels and reads back the SPI voltages.
+ * Waits longer after switching the power off, so the output has discharged.
+ */
+void set_vcan_voltage(int setting, float* v_a, float* v_b) {
+  bool current_power_state = (setting & 0x3) == 0x3;
+  masterHandler->setVcanPower('A', (byte)setting);
+  masterHandler->setVcanPower('B', (byte)setting);
+  if (master_last_power_state && !current_power_state) { delay(300); } else { delay(100); }
+  *v_a = masterHandler->readVcanVoltage('A');
+  *v_b = masterHandler->readVcanVoltage('B');
+  master_last_power_state = current_power_state;
+}
+
+/**
+ * @brief Runs the current test for a list of voltage codes without a PC round trip per step.
+ * Command: "RUN_CURRENT_SEQ <dac> <settle_ms> <stable_ua> <tol_mv> <code>:<expected_mv>,..."
+ * For every code, the voltage is set and read over SPI and I2C on both boards. If all
+ * four voltages are within tol_mv of the expected voltage, the load current is set on
+ * both boards, allowed to settle and measured. Settling waits settle_ms, or with
+ * stable_ua > 0 until two master current readings 10 ms apart differ by at most
+ * stable_ua, with settle_ms as the upper bound. The current of board B is the mean of
+ * SEQ_CURRENT_SAMPLES slave conversions. The slave's readings are requested before the
+ * master takes its own, so both boards measure at the same time.
+ * Replies one line per code,
+ * "CURRENT_REC:<code>,<v_spi_a>,<v_spi_b>,<v_i2c_a>,<v_i2c_b>,<current_set>,<i_a>,<i_b>,<settled_ms>;T=<us>"
+ * with nan for values not measured, and "CURRENT_SEQ_DONE:<count>;T=<us>" when done.
+ * The load current is switched off at the end.
+ */
+void run_current_sequence(const char* args) {
+  unsigned int dac, settle_ms, stable_ua, tol_mv;
+  int offset = 0;
+  if (sscanf(args, "%u %u %u %u %n", &dac, &settle_ms, &stable_ua, &tol_mv, &offset) != 4 || dac > 4095) {
+    send_line(Serial, "ERR:BAD_ARGUMENT:RUN_CURRENT_SEQ <dac> <settle_ms> <stable_ua> <tol_mv> <code>:<mv>,...");
+    return;
+  }
+
+  int codes[MAX_SEQ_CODES];
+  float expected_v[MAX_SEQ_CODES];
+  int count = 0;
+  for (const char* p = args + offset; *p; ) {
+    int code, mv, used;
+    if (sscanf(p, "%d:%d%n", &code, &mv, &used) != 2 || code < 0 || code > 255) {
+      send_line(Serial, "ERR:BAD_ARGUMENT:%s", p);
+      return;
+    }
+    if (count == MAX_SEQ_CODES) {
+      send_line(Serial, "ERR:TOO_MANY_CODES:%d", MAX_SEQ_CODES);
+      return;
+    }
+    codes[count] = code;
+    expected_v[count] = mv / 1000.0f;
+    count++;
+    p += used;
+    if (*p == ',') p++;
+  }
+
+  float tol_v = tol_mv / 1000.0f;
+  const char* reply;
+  for (int n = 0; n < count; n++) {
+    float v_spi_a, v_spi_b;
+    float v_i2c_b = NAN, i_a = NAN, i_b = NAN;
+    unsigned long settled_ms = 0;
+
+    set_vcan_voltage(codes[n], &v_spi_a, &v_spi_b);
+    SlaveRequest* request = slave_request("READ_I2C_VOLTAGE_B");
+    float v_i2c_a = get_i2c_voltage();
+    if ((reply = await_slave(request, "I2C_VOLTAGE_B:", 500))) {
+      sscanf(reply, "I2C_VOLTAGE_B:%f", &v_i2c_b);
+    }
+
+    // Comparisons with nan are false, so a missing reading fails the check
+    bool voltage_ok = fabsf(v_spi_a - expected_v[n]) <= tol_v && fabsf(v_spi_b - expected_v[n]) <= tol_v &&
+                      fabsf(v_i2c_a - expected_v[n]) <= tol_v && fabsf(v_i2c_b - expected_v[n]) <= tol_v;
+    if (voltage_ok) {
+      char slave_command[24];
+      snprintf(slave_command, sizeof(slave_command), "SET_I2C_CURRENT %u", dac);
+      set_i2c_load_current(dac);
+      send_to_slave(slave_command);
+      unsigned long start_time = millis();
+      if (stable_ua == 0) {
+        delay(settle_ms);
+      } else {
+        float previous = masterHandler->readVcanCurrent('A');
+        while (millis() - start_time < settle_ms) {
+          delay(10);
+          float present = masterHandler->readVcanCurrent('A');
+          if (fabsf(present - previous) * 1e6f <= stable_ua) break;
+          previous = present;
         }
-        Serial.printf("TEMPERATURES:Master=%.2f,Slave=%.2f\n", master_temp, slave_temp);
-
-    } else if (sscanf(cmdBuffer, "SET_VCAN_VOLTAGE %d", &setting) == 1) {
-      bool current_power_state = (setting & 0x3) == 0x3;
-      masterHandler->setVcanPower('A', (byte)setting);
-      masterHandler->setVcanPower('B', (byte)setting);
-      if (master_last_power_state && !current_power_state) { delay(300); } else { delay(100); }
-      float v_a = masterHandler->readVcanVoltage('A');
-      float v_b = masterHandler->readVcanVoltage('B');
-      char buffer[50];
-      snprintf(buffer, sizeof(buffer), "VCAN_DATA:%.4f,%.4f", v_a, v_b);
-      Serial.println(buffer);
-      master_last_power_state = current_power_state;
-    } else if (sscanf(cmdBuffer, "SET_I2C_CURRENT %hu", &dacValue) == 1) {
-      set_i2c_load_current(dacValue);
-      UART_SERIAL.println(cmdBuffer);
-      Serial.println("ACK_CURRENT_SET");
-    } else if (strcmp(cmdBuffer, "READ_MASTER_SPI") == 0) {
-      float v_a = masterHandler->readVcanVoltage('A');
-      float i_a = masterHandler->readVcanCurrent('A');
-      char buffer[50];
-      snprintf(buffer, sizeof(buffer), "MASTER_SPI:%.4f,%.4f", v_a, i_a);
-      Serial.println(buffer);
-    } else if (strcmp(cmdBuffer, "READ_I2C_VOLTAGE_A") == 0) {
-      float v = get_i2c_voltage();
-      char buf[50];
-      snprintf(buf, sizeof(buf), "I2C_VOLTAGE_A:%.4f", v);
-      Serial.println(buf);
-    } else if (strcmp(cmdBuffer, "GET_TEST_INFO") == 0) {
-        UART_SERIAL.printf("TEST_INFO:%s:%.2f\n", MASTER_ID, LAB_PSU_VOLTAGE);
-        Serial.printf("TEST_INFO:%s:%.2f\n", MASTER_ID, LAB_PSU_VOLTAGE);
-    } else {
-        UART_SERIAL.println(cmdBuffer);
+      }
+      settled_ms = millis() - start_time;
+
+      snprintf(slave_command, sizeof(slave_command), "CHECK_SPI_ADC %d", SEQ_CURRENT_SAMPLES);
+      request = slave_request(slave_command);
+      i_a = masterHandler->readVcanCurrent('A');
+      if ((reply = await_slave(request, "DATA_AGG:", 500))) {
+        // Mean of vcan_i, the 13th value after the count
+        sscanf(reply, "DATA_AGG:%*d:%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%f", &i_b);
+      }
+    }
+
+    char buf[160];
+    snprintf(buf, sizeof(buf), "CURRENT_REC:%d,%.4f,%.4f,%.4f,%.4f,%d,%.4f,%.4f,%lu", codes[n],
+             v_spi_a, v_spi_b, v_i2c_a, v_i2c_b, voltage_ok ? 1 : 0, i_a, i_b, settled_ms);
+    println_stamped(buf, device_time_us());
+  }
+
+  set_i2c_load_current(0);
+  send_to_slave("SET_I2C_CURRENT 0");
+  char buf[40];
+  snprintf(buf, sizeof(buf), "CURRENT_SEQ_DONE:%d", count);
+  println_stamped(buf, device_time_us());
+}
+
+
+// ####################################################################
+// #                      SLAVE COMMAND HANDLERS                      #
+// ####################################################################
+
+void slave_start_can_test(const char* line, const char* args) {
+  int num_messages = 0;
+  long bitrate = CAN_DEFAULT_BITRATE;
+  unsigned long send_interval_ms = CAN_DEFAULT_SEND_INTERVAL_MS;
+  sscanf(args, "%d %ld %lu", &num_messages, &bitrate, &send_interval_ms);
+  run_can_communication_test(num_messages, bitrate, send_interval_ms);
+}
+
+void slave_get_can_results(const char* line, const char* args) {
+  reply_to_master("CAN_RESULTS:%d,%d,%d,%d", testResults.tx_ok, testResults.tx_fail, testResults.rx_ok,
+                  testResults.crosstalk);
+}
+
+void slave_check_spi_adc(const char* line, const char* args) {
+  if (*args) {
+    char buf[200];
+    format_adc_aggregate(atoi(args), buf, sizeof(buf));
+    reply_to_master("%s", buf);
+  } else {
+    AdcReadings r = slaveHandler->readAllAdcValues();
+    reply_to_master("DATA:%.4f,%.4f,%.4f,%.4f", r.cic_v, r.cic_i, r.vcan_v, r.vcan_i);
+  }
+}
+
+void slave_read_i2c_voltage_b(const char* line, const char* args) {
+  reply_to_master("I2C_VOLTAGE_B:%.4f", get_i2c_voltage());
+}
+
+void slave_set_i2c_current(const char* line, const char* args) {
+  set_i2c_load_current((uint16_t)atoi(args));
+}
+
+void slave_read_temp(const char* line, const char* args) {
+  reply_to_master("TEMP_B:%.2f", get_temperature());
+}
+
+void slave_read_temp_cached(const char* line, const char* args) {
+  reply_to_master("TEMP_B:%.2f", get_cached_temperature());
+}
+
+void slave_get_test_info(const char* line, const char* args) {
+  reply_to_master("TEST_INFO:%s:%.2f", MASTER_ID, LAB_PSU_VOLTAGE);
+}
+
+
+// ####################################################################
+// #                     MASTER COMMAND HANDLERS                      #
+// ####################################################################
+
+/**
+ * @brief "RUN_CAN_TEST <messages> [bitrate] [interval_ms]", also accepted as START_CAN_TEST,
+ * the name used towards the slave. Runs the two-way CAN test on both boards at once.
+ */
+void master_run_can_test(const char* line, const char* args) {
+  int num_messages;
+  long bitrate = CAN_DEFAULT_BITRATE;
+  unsigned long send_interval_ms = CAN_DEFAULT_SEND_INTERVAL_MS;
+  if (sscanf(args, "%d %ld %lu", &num_messages, &bitrate, &send_interval_ms) < 1) {
+    send_line(Serial, "ERR:BAD_ARGUMENT:RUN_CAN_TEST <messages> [bitrate] [interval_ms]");
+    return;
+  }
+  if (!is_supported_can_bitrate(bitrate)) {
+    send_line(Serial, "CAN_TEST_FINAL:FAIL:Unsupported bitrate %ld", bitrate);
+    return;
+  }
+
+  // 1. Command slave to start its test
+  char slave_command[48];
+  snprintf(slave_command, sizeof(slave_command), "START_CAN_TEST %d %ld %lu", num_messages, bitrate, send_interval_ms);
+  send_to_slave(slave_command);
+
+  // 2. Run our test simultaneously
+  run_can_communication_test(num_messages, bitrate, send_interval_ms);
+
+  // 3. Request results from slave
+  delay(100);
+  const char* response = query_slave("GET_CAN_RESULTS", "CAN_RESULTS:", 2000);
+  int s_tx_ok, s_tx_fail, s_rx_ok, s_crosstalk;
+  if (!response || sscanf(response, "CAN_RESULTS:%d,%d,%d,%d", &s_tx_ok, &s_tx_fail, &s_rx_ok, &s_crosstalk) != 4) {
+    send_line(Serial, "CAN_TEST_FINAL:FAIL:No results response from slave.");
+    return;
+  }
+  send_line(Serial, "CAN_TEST_PROGRESS: Received results from slave.");
+
+  // 4. Final validation
+  bool pass = (testResults.tx_fail == 0 && testResults.rx_ok >= num_messages && testResults.crosstalk == 0 &&
+               s_tx_fail == 0 && s_rx_ok >= num_messages && s_crosstalk == 0);
+  send_line(Serial, "CAN_TEST_FINAL:%s:Master(tx_ok:%d,tx_fail:%d,rx_ok:%d,crosstalk:%d) Slave(tx_ok:%d,tx_fail:%d,rx_ok:%d,crosstalk:%d) Timing(bitrate:%ld,interval_ms:%lu,elapsed_ms:%lu)",
+            pass ? "PASS" : "FAIL",
+            testResults.tx_ok, testResults.tx_fail, testResults.rx_ok, testResults.crosstalk,
+            s_tx_ok, s_tx_fail, s_rx_ok, s_crosstalk,
+            bitrate, send_interval_ms, testResults.elapsed_ms);
+}
+
+// Both boards convert at the same time: the slave's reading is requested before the master's
+void master_read_temp(const char* line, const char* args) {
+  SlaveRequest* request = slave_request("READ_TEMP");
+  float master_temp = get_temperature();
+  float slave_temp = 99.00; // Default fail value
+  const char* response = await_slave(request, "TEMP_B:", 2000);
+  if (response) sscanf(response, "TEMP_B:%f", &slave_temp);
+  char buf[60];
+  snprintf(buf, sizeof(buf), "TEMPERATURES:Master=%.2f,Slave=%.2f", master_temp, slave_temp);
+  println_stamped(buf, device_time_us());
+}
+
+/**
+ * @brief Non-blocking variant of READ_TEMP for polling during burnout: both boards
+ * answer from their background sampling, so only the UART round trip is waited for.
+ */
+void master_read_temp_cached(const char* line, const char* args) {
+  uint64_t t_us = device_time_us();
+  float slave_temp = 99.00; // Default fail value
+  const char* response = query_slave("READ_TEMP_CACHED", "TEMP_B:", 100);
+  if (response) sscanf(response, "TEMP_B:%f", &slave_temp);
+  char buf[60];
+  snprintf(buf, sizeof(buf), "TEMPERATURES:Master=%.2f,Slave=%.2f", get_cached_temperature(), slave_temp);
+  println_stamped(buf, t_us);
+}
+
+void master_set_vcan_voltage(const char* line, const char* args) {
+  int setting;
+  if (sscanf(args, "%d", &setting) != 1) {
+    send_line(Serial, "ERR:BAD_ARGUMENT:SET_VCAN_VOLTAGE <code>");
+    return;
+  }
+  float v_a, v_b;
+  set_vcan_voltage(setting, &v_a, &v_b);
+  uint64_t t_us = device_time_us();
+  char buffer[50];
+  snprintf(buffer, sizeof(buffer), "VCAN_DATA:%.4f,%.4f", v_a, v_b);
+  println_stamped(buffer, t_us);
+}
+
+void master_run_current_seq(const char* line, const char* args) {
+  run_current_sequence(args);
+}
+
+void master_set_i2c_current(const char* line, const char* args) {
+  uint16_t dacValue;
+  if (sscanf(args, "%hu", &dacValue) != 1) {
+    send_line(Serial, "ERR:BAD_ARGUMENT:SET_I2C_CURRENT <dac>");
+    return;
+  }
+  set_i2c_load_current(dacValue);
+  send_to_slave(line);
+  send_line(Serial, "ACK_CURRENT_SET");
+}
+
+void master_read_master_spi(const char* line, const char* args) {
+  float v_a = masterHandler->readVcanVoltage('A');
+  float i_a = masterHandler->readVcanCurrent('A');
+  uint64_t t_us = device_time_us();
+  char buffer[50];
+  snprintf(buffer, sizeof(buffer), "MASTER_SPI:%.4f,%.4f", v_a, i_a);
+  println_stamped(buffer, t_us);
+}
+
+void master_read_i2c_voltage_a(const char* line, const char* args) {
+  float v = get_i2c_voltage();
+  uint64_t t_us = device_time_us();
+  char buf[50];
+  snprintf(buf, sizeof(buf), "I2C_VOLTAGE_A:%.4f", v);
+  println_stamped(buf, t_us);
+}
+
+// Used by the PC to estimate the offset between device and wall clock
+void master_get_time(const char* line, const char* args) {
+  send_line(Serial, "TIME:%llu", (unsigned long long)device_time_us());
+}
+
+void master_get_test_info(const char* line, const char* args) {
+  send_line(UART_SERIAL, "TEST_INFO:%s:%.2f", MASTER_ID, LAB_PSU_VOLTAGE);
+  send_line(Serial, "TEST_INFO:%s:%.2f", MASTER_ID, LAB_PSU_VOLTAGE);
+}
+
+// Oversampled read ("CHECK_SPI_ADC <n>"), aggregated on the slave and relayed like the single read
+void master_check_spi_adc(const char* line, const char* args) {
+  if (*args) {
+    int samples = atoi(args);
+    if (samples < 1 || samples > MAX_BATCH_SIZE) {
+      send_line(Serial, "ERR:BAD_ARGUMENT:CHECK_SPI_ADC <1..%d>", MAX_BATCH_SIZE);
+      return;
     }
+  }
+  relay_to_slave(line);
+}
+
+void master_relay(const char* line, const char* args) {
+  relay_to_slave(line);
+}
 
-  if (UART_SERIAL.available() > 0) {
-    String response = UART_SERIAL.readStringUntil('\n');
-    response.trim();
-    Serial.println(response);
+/**
+ * @brief Reads vcan_v and vcan_i from a slave "DATA:" or "DATA_AGG:" reply (the means).
+ */
+bool parse_slave_adc(const char* reply, float* vcan_v, float* vcan_i) {
+  if (starts_with(reply, "DATA_AGG:")) {
+    return sscanf(reply, "DATA_AGG:%*d:%*f,%*f,%*f,%*f,%*f,%*f,%*f,%*f,%f,%*f,%*f,%*f,%f", vcan_v, vcan_i) == 2;
   }
+  return sscanf(reply, "DATA:%*f,%*f,%f,%f", vcan_v, vcan_i) == 2;
+}
+
+/**
+ * @brief "READ_I2C_VOLTAGES": the I2C voltages of both boards in one reply,
+ * "I2C_VOLTAGES:<v_a>,<v_b>;T=<us>", nan for a board without reading.
+ * Board B is read while the master reads board A, so it adds no round trip.
+ */
+void master_read_i2c_voltages(const char* line, const char* args) {
+  SlaveRequest* request = slave_request("READ_I2C_VOLTAGE_B");
+  float v_a = get_i2c_voltage();
+  uint64_t t_us = device_time_us();
+  float v_b = NAN;
+  const char* reply = await_slave(request, "I2C_VOLTAGE_B:", SLAVE_TIMEOUT_MS);
+  if (reply) sscanf(reply, "I2C_VOLTAGE_B:%f", &v_b);
+  char buf[60];
+  snprintf(buf, sizeof(buf), "I2C_VOLTAGES:%.4f,%.4f", v_a, v_b);
+  println_stamped(buf, t_us);
+}
+
+/**
+ * @brief "READ_ALL_SPI [n]": VCAN voltage and current of both boards in one reply,
+ * "ALL_SPI:<v_a>,<i_a>,<v_b>,<i_b>;T=<us>", nan for board B without reading. With n > 1,
+ * the values of board B are the means of n slave conversions. Board B is converted while
+ * the master reads board A, so it adds no round trip.
+ */
+void master_read_all_spi(const char* line, const char* args) {
+  int samples = *args ? atoi(args) : 1;
+  if (samples < 1 || samples > MAX_BATCH_SIZE) {
+    send_line(Serial, "ERR:BAD_ARGUMENT:READ_ALL_SPI <1..%d>", MAX_BATCH_SIZE);
+    return;
+  }
+  char slave_command[24];
+  snprintf(slave_command, sizeof(slave_command), samples > 1 ? "CHECK_SPI_ADC %d" : "CHECK_SPI_ADC", samples);
+  SlaveRequest* request = slave_request(slave_command);
+  float v_a = masterHandler->readVcanVoltage('A');
+  float i_a = masterHandler->readVcanCurrent('A');
+  uint64_t t_us = device_time_us();
+  float v_b = NAN, i_b = NAN;
+  const char* reply = await_slave(request, "DATA", SLAVE_TIMEOUT_MS);
+  if (reply && !parse_slave_adc(reply, &v_b, &i_b)) v_b = i_b = NAN;
+  char buf[80];
+  snprintf(buf, sizeof(buf), "ALL_SPI:%.4f,%.4f,%.6f,%.6f", v_a, i_a, v_b, i_b);
+  println_stamped(buf, t_us);
+}
+
+void master_get_capabilities(const char* line, const char* args);
+void master_get_latency(const char* line, const char* args);
+
+
+// ####################################################################
+// #                         COMMAND TABLES                           #
+// ####################################################################
+
+// Commands of the master: handled itself, with the slave's part requested over the link, or
+// relayed to the slave with the reply relayed back
+CommandEntry MASTER_COMMANDS[] = {
+  COMMAND("GET_CAPABILITIES", master_get_capabilities),
+  COMMAND("GET_TEST_INFO", master_get_test_info),
+  COMMAND("GET_TIME", master_get_time),
+  COMMAND("GET_LATENCY", master_get_latency),
+  COMMAND("RUN_CAN_TEST", master_run_can_test),
+  COMMAND("START_CAN_TEST", master_run_can_test),
+  COMMAND("READ_TEMP", master_read_temp),
+  COMMAND("READ_TEMP_CACHED", master_read_temp_cached),
+  COMMAND("SET_VCAN_VOLTAGE", master_set_vcan_voltage),
+  COMMAND("SET_I2C_CURRENT", master_set_i2c_current),
+  COMMAND("READ_MASTER_SPI", master_read_master_spi),
+  COMMAND("READ_I2C_VOLTAGE_A", master_read_i2c_voltage_a),
+  COMMAND("READ_I2C_VOLTAGES", master_read_i2c_voltages),
+  COMMAND("READ_ALL_SPI", master_read_all_spi),
+  COMMAND("RUN_CURRENT_SEQ", master_run_current_seq),
+  COMMAND("CHECK_SPI_ADC", master_check_spi_adc),
+  COMMAND("READ_I2C_VOLTAGE_B", master_relay)
+};
+const size_t MASTER_COMMAND_COUNT = sizeof(MASTER_COMMANDS) / sizeof(MASTER_COMMANDS[0]);
+
+// Commands the slave receives from the master
+CommandEntry SLAVE_COMMANDS[] = {
+  COMMAND("START_CAN_TEST", slave_start_can_test),
+  COMMAND("GET_CAN_RESULTS", slave_get_can_results),
+  COMMAND("CHECK_SPI_ADC", slave_check_spi_adc),
+  COMMAND("READ_I2C_VOLTAGE_B", slave_read_i2c_voltage_b),
+  COMMAND("SET_I2C_CURRENT", slave_set_i2c_current),
+  COMMAND("READ_TEMP", slave_read_temp),
+  COMMAND("READ_TEMP_CACHED", slave_read_temp_cached),
+  COMMAND("GET_TEST_INFO", slave_get_test_info)
+};
+const size_t SLAVE_COMMAND_COUNT = sizeof(SLAVE_COMMANDS) / sizeof(SLAVE_COMMANDS[0]);
+
+/**
+ * @brief Replies to GET_CAPABILITIES, e.g.
+ * "CAPABILITIES:1:64:115200:8N1:GET_CAPABILITIES,GET_TEST_INFO,...".
+ * Fields: protocol version, max batch size, USB baud rate, framing, command list.
+ */
+void master_get_capabilities(const char* line, const char* args) {
+  int len = snprintf(reply_buf, REPLY_BUFFER_SIZE, "CAPABILITIES:%d:%d:%d:%s:",
+                     PROTOCOL_VERSION, MAX_BATCH_SIZE, USB_BAUD_RATE, USB_FRAMING);
+  for (size_t i = 0; i < MASTER_COMMAND_COUNT && len < REPLY_BUFFER_SIZE; i++) {
+    len += snprintf(reply_buf + len, REPLY_BUFFER_SIZE - len, i == 0 ? "%s" : ",%s", MASTER_COMMANDS[i].name);
+  }
+  write_reply(Serial, len);
+}
+
+/**
+ * @brief Replies to "GET_LATENCY [RESET]" with the turnaround of every command used since
+ * boot or the last reset, e.g. "LATENCY:GET_TIME:12:85:310,SET_VCAN_VOLTAGE:256:101240:101630".
+ * Fields per command: count, mean and maximum turnaround in microseconds. Relayed
+ * commands include the slave's part. With RESET, the statistics are cleared after the reply.
+ */
+void master_get_latency(const char* line, const char* args) {
+  int len = snprintf(reply_buf, REPLY_BUFFER_SIZE, "LATENCY:");
+  bool first = true;
+  for (size_t i = 0; i < MASTER_COMMAND_COUNT && len < REPLY_BUFFER_SIZE; i++) {
+    const CommandEntry& command = MASTER_COMMANDS[i];
+    if (command.count == 0) continue;
+    len += snprintf(reply_buf + len, REPLY_BUFFER_SIZE - len, first ? "%s:%u:%u:%u" : ",%s:%u:%u:%u", command.name,
+                    (unsigned)command.count, (unsigned)(command.total_us / command.count), (unsigned)command.max_us);
+    first = false;
+  }
+  write_reply(Serial, len);
+  if (strcmp(args, "RESET") == 0) {
+    for (size_t i = 0; i < MASTER_COMMAND_COUNT; i++) {
+      MASTER_COMMANDS[i].count = 0;
+      MASTER_COMMANDS[i].max_us = 0;
+      MASTER_COMMANDS[i].total_us = 0;
+    }
+    for (SlaveRequest& request : slave_requests) request.turnaround.command = nullptr;
+    // Not counted, so the next report starts empty
+    active_command.command = nullptr;
+  }
+}
+
+
+// ####################################################################
+// #                       MAIN LOGIC & LOOPS                         #
+// ####################################################################
+
+void slave_loop() {
+  if (uart_line.poll(UART_SERIAL) && !uart_line.truncated) {
+    uint8_t id;
+    const char* command = parse_frame(uart_line.buf, uart_line.len, &id);
+    if (command == nullptr && uart_line.buf[0] == '#') return; // Corrupt frame, the master times out
+    slave_frame_id = command ? id : -1;
+    dispatch(SLAVE_COMMANDS, SLAVE_COMMAND_COUNT, command ? command : uart_line.buf, uart_line.t_us);
+  }
+}
+
+void master_loop() {
+  if (usb_line.poll(Serial)) {
+    if (usb_line.truncated) {
+      send_line(Serial, "ERR:LINE_TOO_LONG:%d", CMD_BUFFER_SIZE - 1);
+    } else if (usb_line.len > 0 && !dispatch(MASTER_COMMANDS, MASTER_COMMAND_COUNT, usb_line.buf, usb_line.t_us)) {
+      // Reply at once so the PC does not wait for a response that never comes
+      send_line(Serial, "ERR:UNKNOWN_COMMAND:%s", usb_line.buf);
+    }
+  }
+
+  // Relay the slave's replies to relayed commands to the PC
+  if (uart_line.poll(UART_SERIAL)) handle_slave_line(uart_line, 0);
+  expire_slave_requests();
 }
 
 void setup() {
@@ -215,6 +1048,7 @@ void setup() {
 }
 
 void loop() {
+  update_temperature(); // Keeps a fresh reading for READ_TEMP_CACHED without blocking
   if (currentRole == MASTER) master_loop();
   else if (currentRole == SLAVE) slave_loop();
 }
@@ -4,19 +4,44 @@
 // The 'extern' in the header file makes this single instance visible elsewhere.
 CanTestResults testResults;
 
+/**
+ * @brief Fills the TWAI timing configuration for the requested bitrate.
+ * @return false if the bitrate is not one of the supported values.
+ */
+static bool get_timing_config(long bitrate, twai_timing_config_t* t_config) {
+    switch (bitrate) {
+        case 125000:  { twai_timing_config_t c = TWAI_TIMING_CONFIG_125KBITS(); *t_config = c; return true; }
+        case 250000:  { twai_timing_config_t c = TWAI_TIMING_CONFIG_250KBITS(); *t_config = c; return true; }
+        case 500000:  { twai_timing_config_t c = TWAI_TIMING_CONFIG_500KBITS(); *t_config = c; return true; }
+        case 1000000: { twai_timing_config_t c = TWAI_TIMING_CONFIG_1MBITS();   *t_config = c; return true; }
+        default: return false;
+    }
+}
+
+bool is_supported_can_bitrate(long bitrate) {
+    twai_timing_config_t unused;
+    return get_timing_config(bitrate, &unused);
+}
+
 /**
  * @brief Runs a two-way communication integrity test. Both Master and Slave
  * will transmit requests and listen for responses simultaneously.
  * @param num_messages The number of request/response cycles to perform.
+ * @param bitrate The bus bitrate in bit/s.
+ * @param send_interval_ms The pause between two requests in milliseconds.
  */
-void run_can_communication_test(int num_messages) {
+void run_can_communication_test(int num_messages, long bitrate, unsigned long send_interval_ms) {
     // Ensure a clean state for the TWAI driver
     twai_driver_uninstall(); 
     delay(50);
 
     // Standard configuration for the single CAN bus
     twai_general_config_t g_config = TWAI_GENERAL_CONFIG_DEFAULT((gpio_num_t)CAN_TX_PIN, (gpio_num_t)CAN_RX_PIN, TWAI_MODE_NORMAL);
-    twai_timing_config_t t_config = TWAI_TIMING_CONFIG_125KBITS();
+    twai_timing_config_t t_config;
+    if (!get_timing_config(bitrate, &t_config)) {
+        if(currentRole == MASTER) Serial.printf("CAN_TEST_FINAL:FAIL:Unsupported bitrate %ld\n", bitrate);
+        return;
+    }
     twai_filter_config_t f_config = TWAI_FILTER_CONFIG_ACCEPT_ALL();
     if (twai_driver_install(&g_config, &t_config, &f_config) != ESP_OK || twai_start() != ESP_OK) {
         if(currentRole == MASTER) Serial.println("CAN_TEST_FINAL:FAIL:Could not start TWAI driver");
@@ -24,20 +49,21 @@ void run_can_communication_test(int num_messages) {
     }
 
     // Reset results and define CAN IDs based on the device's role
-    testResults = {0, 0, 0, 0};
+    testResults = {0, 0, 0, 0, 0};
     unsigned long last_send = 0;
-    const unsigned long SEND_INTERVAL = 50; // ms
 
     uint32_t my_request_id = (currentRole == MASTER) ? 0x581 : 0x582;
     uint32_t expected_response_id = (currentRole == MASTER) ? 0x701 : 0x702;
     uint32_t request_from_other_id = (currentRole == MASTER) ? 0x582 : 0x581;
     uint32_t my_response_id = (currentRole == MASTER) ? 0x702 : 0x701;
 
-    if (currentRole == MASTER) Serial.printf("CAN_TEST_PROGRESS: Starting two-way test for %d messages...\n", num_messages);
+    if (currentRole == MASTER) Serial.printf("CAN_TEST_PROGRESS: Starting two-way test for %d messages at %ld bit/s, %lu ms interval...\n",
+                                             num_messages, bitrate, send_interval_ms);
 
     // Main communication loop
+    unsigned long loop_start = millis();
     for (int i = 0; i < num_messages; i++) {
-        while (millis() - last_send < SEND_INTERVAL) {
+        do {
             twai_message_t rx_msg;
             if (twai_receive(&rx_msg, 0) == ESP_OK) {
                 if (rx_msg.identifier == request_from_other_id) {
@@ -50,7 +76,7 @@ void run_can_communication_test(int num_messages) {
                     testResults.crosstalk++; // Unexpected CAN ID
                 }
             }
-        }
+        } while (millis() - last_send < send_interval_ms);
 
         // Send our own request
         twai_message_t tx_msg = { .identifier = my_request_id, .data_length_code = 0 };
@@ -62,6 +88,8 @@ void run_can_communication_test(int num_messages) {
         last_send = millis();
     }
     
+    testResults.elapsed_ms = millis() - loop_start;
+
     // Wait a moment to catch any final in-flight responses
     delay(200);
     twai_message_t final_rx;
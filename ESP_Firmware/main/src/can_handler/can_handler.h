@@ -9,6 +9,10 @@
 #define CAN_TX_PIN 0
 #define CAN_RX_PIN 2
 
+// --- Default Timing ---
+#define CAN_DEFAULT_BITRATE 125000
+#define CAN_DEFAULT_SEND_INTERVAL_MS 50
+
 // --- Role Definition ---
 // Moved here to be accessible by both the main .ino and the can_handler.cpp
 enum Role { UNKNOWN, MASTER, SLAVE };
@@ -21,6 +25,7 @@ struct CanTestResults {
     int tx_fail = 0;
     int rx_ok = 0;
     int crosstalk = 0; // Counts unexpected CAN IDs
+    unsigned long elapsed_ms = 0; // Duration of the send loop, for throughput calculation
 };
 // Make the global testResults variable visible across files
 extern CanTestResults testResults;
@@ -29,7 +34,17 @@ extern CanTestResults testResults;
  * @brief Runs a two-way communication integrity test. Both Master and Slave
  * will transmit requests and listen for responses simultaneously.
  * @param num_messages The number of request/response cycles to perform.
+ * @param bitrate The bus bitrate in bit/s (125000, 250000, 500000 or 1000000).
+ * @param send_interval_ms The pause between two requests in milliseconds (0 = back-to-back).
+ */
+void run_can_communication_test(int num_messages, long bitrate = CAN_DEFAULT_BITRATE,
+                                unsigned long send_interval_ms = CAN_DEFAULT_SEND_INTERVAL_MS);
+
+/**
+ * @brief Checks whether a bitrate is supported by the characterisation sweep.
+ * @param bitrate The bus bitrate in bit/s.
+ * @return true if a TWAI timing configuration exists for it.
  */
-void run_can_communication_test(int num_messages);
+bool is_supported_can_bitrate(long bitrate);
 
 #endif // CAN_HANDLER_H
@@ -9,6 +9,11 @@
 OneWire oneWire(ONE_WIRE_BUS);
 DallasTemperature sensors(&oneWire);
 
+// --- State of the background sampling ---
+static float cached_temp_c = -127.0;
+static bool conversion_pending = false;
+static unsigned long conversion_start_ms = 0;
+
 /**
  * @brief Initializes the DS18B20 temperature sensor.
  */
@@ -30,3 +35,29 @@ float get_temperature() {
     }
     return tempC;
 }
+
+/**
+ * @brief Advances the background temperature sampling without blocking.
+ */
+void update_temperature() {
+    if (conversion_pending) {
+        if (millis() - conversion_start_ms < sensors.millisToWaitForConversion(sensors.getResolution())) {
+            return;
+        }
+        float tempC = sensors.getTempCByIndex(0);
+        cached_temp_c = (tempC == DEVICE_DISCONNECTED_C) ? -127.0 : tempC;
+    }
+    // Start the next conversion without waiting for it; get_temperature() keeps blocking
+    sensors.setWaitForConversion(false);
+    sensors.requestTemperatures();
+    sensors.setWaitForConversion(true);
+    conversion_start_ms = millis();
+    conversion_pending = true;
+}
+
+/**
+ * @brief Returns the latest reading of the background sampling.
+ */
+float get_cached_temperature() {
+    return cached_temp_c;
+}
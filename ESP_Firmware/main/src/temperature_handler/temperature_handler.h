@@ -14,4 +14,19 @@ void init_temperature_sensor();
  */
 float get_temperature();
 
+/**
+ * @brief Advances the background temperature sampling without blocking.
+ * Call this on every loop iteration. It starts a conversion, and once the
+ * conversion time has passed it stores the result and starts the next one,
+ * so a fresh reading is always available without waiting up to 750 ms.
+ */
+void update_temperature();
+
+/**
+ * @brief Returns the latest reading of the background sampling.
+ * * @return The temperature in degrees Celsius. Returns -127.0 until the
+ * first conversion has finished or if the sensor failed to read.
+ */
+float get_cached_temperature();
+
 #endif // TEMPERATURE_HANDLER_H
@@ -0,0 +1,41 @@
+"""
+Microbenchmark for lib/protocol.py: decodes one million reply lines.
+
+Usage (from the PC_Firmware directory):
+    python benchmarks/bench_protocol.py [num_lines]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import protocol  # noqa: E402
+
+SAMPLE_LINES = [
+    b"DATA:3.3012,0.0081,9.0034,0.0213;T=1234567890\r\n",
+    b"MASTER_SPI:1.9021,0.0012;T=1234567891\r\n",
+    b"VCAN_DATA:1.9021,1.8994;T=1234567892\r\n",
+    b"I2C_VOLTAGE_A:1.9102;T=1234567893\r\n",
+    b"I2C_VOLTAGE_B:1.9077;T=1234567894\r\n",
+    b"TEMPERATURES:Master=24.50,Slave=25.12;T=1234567895\r\n",
+    b"ACK_CURRENT_SET\r\n",
+    b"CAN_TEST_PROGRESS: Received results from slave.\r\n",
+]
+
+
+def bench(num_lines=1_000_000):
+    """Decodes num_lines lines cycling through SAMPLE_LINES and returns lines per second."""
+    lines = (SAMPLE_LINES * (num_lines // len(SAMPLE_LINES) + 1))[:num_lines]
+    decode = protocol.decode
+    start = time.perf_counter()
+    for line in lines:
+        decode(line)
+    elapsed = time.perf_counter() - start
+    return num_lines / elapsed, elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rate, elapsed = bench(count)
+    print(f"Decoded {count} lines in {elapsed:.2f}s ({rate:,.0f} lines/s, {elapsed / count * 1e6:.2f} us/line)")
@@ -0,0 +1,135 @@
+"""
+In-process stand-in for the master ESP32 on a serial port.
+
+FakeSerial answers the firmware commands instantly with plausible readings, so
+the PC-side code can be exercised and timed without hardware. It implements the
+subset of the serial.Serial interface used by the test functions.
+"""
+import time
+from collections import Counter
+
+from lib import capabilities
+from test_functions import voltage_test
+
+
+class FakeSerial:
+
+    def __init__(self, switches_on=True, master_id="QC-Station-FAKE", psu_voltage=8.0, max_batch=64):
+        self.switches_on = switches_on
+        self.max_batch = max_batch
+        self.master_id = master_id
+        self.psu_voltage = psu_voltage
+        self.vcan_code = 0
+        self.command_counts = Counter()
+        self._rx = bytearray()
+
+    # --- serial.Serial interface ---
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        for line in bytes(data).decode('utf-8').splitlines():
+            if line.strip():
+                self.command_counts[line.split(' ', 1)[0]] += 1
+                self._rx += self._respond(line.strip()).encode('utf-8')
+        return len(data)
+
+    def readline(self):
+        end = self._rx.find(b'\n')
+        if end < 0:
+            line, self._rx = bytes(self._rx), bytearray()
+            return line
+        line = bytes(self._rx[:end + 1])
+        del self._rx[:end + 1]
+        return line
+
+    def read(self, size=1):
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def read_all(self):
+        return self.read(len(self._rx))
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    # --- Firmware emulation ---
+
+    @staticmethod
+    def _stamp():
+        return f";T={time.perf_counter_ns() // 1000}\r\n"
+
+    def _vcan_voltage(self):
+        return voltage_test.get_expected_voltage(self.vcan_code, self.switches_on)
+
+    def _respond(self, command):
+        name, _, argument = command.partition(' ')
+        if name == "SET_VCAN_VOLTAGE":
+            self.vcan_code = int(argument)
+            v = self._vcan_voltage()
+            return f"VCAN_DATA:{v:.4f},{v:.4f}" + self._stamp()
+        if name in ("READ_I2C_VOLTAGE_A", "READ_I2C_VOLTAGE_B"):
+            return f"I2C_VOLTAGE_{name[-1]}:{self._vcan_voltage():.4f}" + self._stamp()
+        if name == "READ_I2C_VOLTAGES":
+            v = self._vcan_voltage()
+            return f"I2C_VOLTAGES:{v:.4f},{v:.4f}" + self._stamp()
+        if name == "READ_ALL_SPI":
+            v = self._vcan_voltage()
+            return f"ALL_SPI:{v:.4f},0.0012,{v:.4f},0.001200" + self._stamp()
+        if name == "READ_MASTER_SPI":
+            return f"MASTER_SPI:{self._vcan_voltage():.4f},0.0012" + self._stamp()
+        if name == "CHECK_SPI_ADC" and argument:
+            return (f"DATA_AGG:{int(argument)}:3.300000,3.298000,3.302000,0.001000,0.005000,0.004900,0.005100,"
+                    f"0.000050,9.000000,8.996000,9.004000,0.002000,0.020000,0.019800,0.020200,0.000100"
+                    + self._stamp())
+        if name == "CHECK_SPI_ADC":
+            return "DATA:3.3000,0.0050,9.0000,0.0200" + self._stamp()
+        if name == "SET_I2C_CURRENT":
+            return "ACK_CURRENT_SET\r\n"
+        if name == "GET_TIME":
+            return f"TIME:{time.perf_counter_ns() // 1000}\r\n"
+        if name == "GET_TEST_INFO":
+            return f"TEST_INFO:{self.master_id}:{self.psu_voltage:.2f}\r\n"
+        if name in ("READ_TEMP", "READ_TEMP_CACHED"):
+            return "TEMPERATURES:Master=24.50,Slave=25.00" + self._stamp()
+        if name == "GET_CAPABILITIES":
+            commands = ",".join(sorted(capabilities.LEGACY_COMMANDS | {"GET_CAPABILITIES", "GET_TIME", "GET_LATENCY",
+                                                                       "READ_ALL_SPI", "READ_I2C_VOLTAGES",
+                                                                       "READ_TEMP_CACHED", "RUN_CURRENT_SEQ"}))
+            return f"CAPABILITIES:{capabilities.PROTOCOL_VERSION}:{self.max_batch}:115200:8N1:{commands}\r\n"
+        if name == "RUN_CURRENT_SEQ":
+            return self._current_sequence(argument)
+        if name == "GET_LATENCY":
+            latencies = ",".join(f"{command}:{count}:100:250" for command, count in sorted(self.command_counts.items()))
+            if argument == "RESET":
+                self.command_counts.clear()
+            return f"LATENCY:{latencies}\r\n"
+        if name in ("RUN_CAN_TEST", "START_CAN_TEST"):
+            n = int(argument.split()[0])
+            return (f"CAN_TEST_FINAL:PASS:Master(tx_ok:{n},tx_fail:0,rx_ok:{n},crosstalk:0) "
+                    f"Slave(tx_ok:{n},tx_fail:0,rx_ok:{n},crosstalk:0) "
+                    f"Timing(bitrate:125000,interval_ms:50,elapsed_ms:{n * 50})\r\n")
+        return f"ERR:UNKNOWN_COMMAND:{command}\r\n"
+
+    def _current_sequence(self, argument):
+        _, settle_ms, _, tol_mv, code_list = argument.split(' ', 4)
+        lines = []
+        for entry in code_list.split(','):
+            code, expected_mv = (int(value) for value in entry.split(':'))
+            self.vcan_code = code
+            v = self._vcan_voltage()
+            current_set = abs(v * 1000 - expected_mv) <= int(tol_mv)
+            currents = "0.0012,0.0200" if current_set else "nan,nan"
+            lines.append(f"CURRENT_REC:{code},{v:.4f},{v:.4f},{v:.4f},{v:.4f},{int(current_set)},{currents},"
+                         f"{settle_ms if current_set else 0}" + self._stamp())
+        lines.append(f"CURRENT_SEQ_DONE:{len(lines)}" + self._stamp())
+        return "".join(lines)
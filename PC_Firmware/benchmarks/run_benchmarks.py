@@ -0,0 +1,185 @@
+"""
+Benchmark suite for the PC test station hot paths.
+
+Every benchmark runs against the in-process FakeSerial, with time.sleep disabled
+and console output discarded, so the numbers reflect PC-side processing only.
+The results are written as JSON; pass a previous result file as baseline to
+flag regressions.
+
+Usage (from the PC_Firmware directory):
+    python benchmarks/run_benchmarks.py [--output bench.json] [--baseline old.json] [--threshold 0.2]
+"""
+import argparse
+import contextlib
+import copy
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import protocol, utils  # noqa: E402
+from lib.csv_logger import CsvLogger, analyze_and_plot_logs  # noqa: E402
+from test_functions import voltage_test, current_test, initial_checks  # noqa: E402
+from benchmarks.bench_protocol import SAMPLE_LINES  # noqa: E402
+from benchmarks.fake_serial import FakeSerial  # noqa: E402
+
+SESSION_DETAILS = {'operator_name': 'Bench', 'serial_number': '0000', 'master_id': 'QC-Station-FAKE'}
+
+
+@contextlib.contextmanager
+def quiet_and_fast():
+    """Discards console output and turns time.sleep into a no-op."""
+    real_sleep = time.sleep
+    time.sleep = lambda seconds: None
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        time.sleep = real_sleep
+
+
+def timed(func, repeat):
+    """Runs func 'repeat' times and returns the best wall time in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_voltage_sweep(config, repeat):
+    seconds = timed(lambda: voltage_test.run_test_cycle(FakeSerial(), True, config, SESSION_DETAILS, None), repeat)
+    return {'seconds': seconds, 'codes_per_s': 256 / seconds}
+
+
+def bench_current_test(config, repeat):
+    codes = config['current_test_settings']['voltage_codes_for_current_test']
+    seconds = timed(lambda: current_test.run(FakeSerial(), config, SESSION_DETAILS), repeat)
+    return {'seconds': seconds, 'codes_per_s': len(codes) / seconds}
+
+
+def bench_initial_checks(config, ranges, duration_s=1.0):
+    """initial_checks.run is time-bounded, so the sample rate it sustains is measured instead."""
+    config = copy.deepcopy(config)
+    config['settings']['initial_voltage_duration'] = duration_s
+    ser = FakeSerial()
+    start = time.perf_counter()
+    initial_checks.run(ser, config, ranges, SESSION_DETAILS, is_pre_check=True)
+    seconds = time.perf_counter() - start
+    samples = ser.command_counts['CHECK_SPI_ADC']
+    return {'seconds': seconds, 'samples_per_s': samples / seconds}
+
+
+def bench_parsing(num_lines=200_000):
+    lines = (SAMPLE_LINES * (num_lines // len(SAMPLE_LINES) + 1))[:num_lines]
+    start = time.perf_counter()
+    for line in lines:
+        protocol.decode(line)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'lines_per_s': num_lines / seconds}
+
+
+def make_session_rows(config):
+    """Runs the fake stages once and returns the (test_name, result, data) rows of one session."""
+    ranges = config['initial_check_ranges']
+    readings = {'cic_v': 3.3, 'cic_i': 0.005, 'vcan_v': 9.0, 'vcan_i': 0.02, 't_wall': time.time()}
+    _, sweep = voltage_test.run_test_cycle(FakeSerial(), True, config, SESSION_DETAILS, None)
+    _, currents = current_test.run(FakeSerial(), config, SESSION_DETAILS)
+    return [
+        ("Initial Checks", 'PASS', {'ranges': ranges, 'readings': readings, 'overall_pass': True}),
+        ("Voltage Channels", 'PASS', {'records': sweep}),
+        ("Current Channels", 'PASS', {'records': currents}),
+    ]
+
+
+def write_synthetic_log(log_dir, rows, sessions):
+    """Writes a log file containing 'sessions' sessions and returns its path and the number of rows."""
+    logger = CsvLogger(log_dir)
+    for index in range(sessions):
+        details = dict(SESSION_DETAILS, serial_number=f"{index:04d}")
+        for test_name, result, data in rows:
+            logger.log_data(test_name, result, details, data)
+    logger.file.close()  # Close without the analysis, it is timed separately
+    return logger.log_file_path, logger.rows_written
+
+
+def bench_logging(rows, log_dir, sessions=100):
+    start = time.perf_counter()
+    _, written = write_synthetic_log(log_dir, rows, sessions)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'rows_per_s': written / seconds}
+
+
+def bench_analysis(rows, log_dir, sessions):
+    path, _ = write_synthetic_log(tempfile.mkdtemp(dir=log_dir), rows, sessions)
+    start = time.perf_counter()
+    analyze_and_plot_logs(path)
+    return {'seconds': time.perf_counter() - start}
+
+
+def compare(results, baseline, threshold):
+    """Returns the benchmarks whose time grew by more than 'threshold' (relative) against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get('results', {}).get(name)
+        if old and old['seconds'] > 0 and result['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append((name, old['seconds'], result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the PC test station hot paths.")
+    parser.add_argument('--output', default='bench_results.json', help="File to write the JSON results to.")
+    parser.add_argument('--baseline', help="Previous results file to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed relative slowdown (default 0.2).")
+    parser.add_argument('--repeat', type=int, default=3, help="Repetitions per benchmark, the best is kept.")
+    args = parser.parse_args()
+
+    config = utils.load_config()
+    if not config:
+        sys.exit(1)
+    config['current_test_settings']['current_settle_time_s'] = 0
+
+    results = {}
+    with quiet_and_fast(), tempfile.TemporaryDirectory() as log_dir:
+        results['voltage_sweep'] = bench_voltage_sweep(config, args.repeat)
+        results['current_test'] = bench_current_test(config, args.repeat)
+        results['initial_checks'] = bench_initial_checks(config, config['initial_check_ranges'])
+        results['response_parsing'] = bench_parsing()
+        rows = make_session_rows(config)
+        results['csv_logging'] = bench_logging(rows, log_dir)
+        for sessions in (10, 100, 1000):
+            results[f'analysis_{sessions}_sessions'] = bench_analysis(rows, log_dir, sessions)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        rates = ", ".join(f"{key}: {value:,.0f}" for key, value in result.items() if key != 'seconds')
+        print(f"{name:<28} {result['seconds'] * 1000:10.1f} ms  {rates}")
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, old, new in regressions:
+            print(f"REGRESSION: {name} {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Capability discovery for the master firmware.
+
+The firmware answers 'GET_CAPABILITIES' with its protocol version, the largest
+batch it accepts, its USB baud rate/framing and the commands it handles. The
+reply is cached per device, so test functions can choose the fastest path the
+firmware supports and missing commands are reported before a test starts
+instead of showing up as timeouts.
+"""
+from lib import protocol
+
+# Newest protocol version this software understands
+PROTOCOL_VERSION = 1
+
+# Commands of firmware that predates the handshake
+LEGACY_COMMANDS = frozenset({
+    "GET_TEST_INFO", "RUN_CAN_TEST", "READ_TEMP", "SET_VCAN_VOLTAGE", "SET_I2C_CURRENT",
+    "READ_MASTER_SPI", "READ_I2C_VOLTAGE_A", "CHECK_SPI_ADC", "READ_I2C_VOLTAGE_B"
+})
+
+# Assumed for firmware that does not answer 'GET_CAPABILITIES' (protocol version 0)
+LEGACY = protocol.Capabilities(protocol_version=0, max_batch=1, baud=None, framing=None,
+                               commands=LEGACY_COMMANDS, t_device_us=None)
+
+_cache = {}
+
+
+class IncompatibleDevice(Exception):
+    """Raised when the firmware cannot run a test with this software."""
+
+
+def _device_key(ser):
+    # A port and the master ID it answered with identify one tester board
+    test_info = getattr(ser, 'test_info', None)
+    return getattr(ser, 'port', None), test_info.master_id if test_info else None
+
+
+def get(ser, refresh=False, timeout=1.0):
+    """
+    Returns the capabilities of the device on 'ser', querying it only on first use
+    (or with refresh=True). Firmware without the handshake is treated as LEGACY.
+    Raises IncompatibleDevice if the firmware speaks a newer protocol version.
+    """
+    key = _device_key(ser)
+    if refresh or key not in _cache:
+        caps = protocol.query(ser, "GET_CAPABILITIES", protocol.Capabilities, timeout=timeout) or LEGACY
+        if caps.protocol_version > PROTOCOL_VERSION:
+            raise IncompatibleDevice(f"Firmware protocol version {caps.protocol_version} is newer than the "
+                                     f"supported version {PROTOCOL_VERSION}. Please update the PC software.")
+        _cache[key] = caps
+    return _cache[key]
+
+
+def missing(caps, commands):
+    """Returns the commands from 'commands' the firmware does not support, in order."""
+    return [command for command in commands if command not in caps.commands]
+
+
+def require(caps, commands, what):
+    """Raises IncompatibleDevice naming the missing commands if 'what' cannot run on this firmware."""
+    unsupported = missing(caps, commands)
+    if unsupported:
+        raise IncompatibleDevice(f"{what} needs firmware support for: {', '.join(unsupported)} "
+                                 f"(firmware protocol version {caps.protocol_version}).")
+
+
+def select_path(caps, batched=None, streaming=None):
+    """
+    Chooses the fastest way to run a measurement loop: 'batched' if the firmware
+    supports the batched command and batches larger than one, 'streaming' if it
+    supports the streaming command, and 'legacy' (one command per reading) otherwise.
+    """
+    if batched and batched in caps.commands and caps.max_batch > 1:
+        return 'batched'
+    if streaming and streaming in caps.commands:
+        return 'streaming'
+    return 'legacy'
+
+
+def describe(caps):
+    if caps is LEGACY:
+        return "legacy firmware (no capability handshake)"
+    return (f"protocol v{caps.protocol_version}, max batch {caps.max_batch}, "
+            f"{caps.baud} baud {caps.framing}, {len(caps.commands)} commands")
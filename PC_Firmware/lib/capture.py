@@ -0,0 +1,174 @@
+"""
+Fixed-record binary capture files for long streaming stages.
+
+A capture file is a small header followed by packed little-endian records:
+
+    offset 0   8s   magic b'CICCAP01'
+    offset 8   u64  number of records written
+    offset 16  u64  capacity (records the file has room for)
+    offset 24  u32  header size (offset of the first record)
+    offset 28  u32  record size in bytes
+    offset 32       JSON metadata: schema as [[name, typecode], ...], created, description
+
+The file is preallocated and written through a memory map, so appending costs no
+Python memory and the record count is updated after every record. Other processes
+can read the records written so far without copying, also while the stage is still
+running, with load() or numpy.memmap(path, dtype, offset=header_size, shape=(count,)).
+Only the first 'count' records are valid. The file is never shrunk, as truncating
+a file that a reader still has mapped fails on Windows.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+
+try:
+    import numpy as np
+except ImportError:  # Optional dependency, only needed to read captures with load()
+    np = None
+
+CAPTURE_DIR = os.path.join('logs', 'captures')
+
+MAGIC = b'CICCAP01'
+HEADER_SIZE = 4096
+# The least number of records added when a file grows
+GROW_RECORDS = 4096
+_FIXED = struct.Struct('<8sQQII')
+_COUNT = struct.Struct('<Q')
+
+# array/struct typecode -> numpy type, for the typecodes with a fixed size
+_NUMPY_TYPES = {'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4',
+                'q': '<i8', 'Q': '<u8', 'f': '<f4', 'd': '<f8'}
+
+
+class CaptureFile:
+    """
+    Appends fixed-size records with a RecordBuffer schema to a memory-mapped file.
+    When the preallocated capacity is used up, the file grows by doubling, by at
+    least GROW_RECORDS records.
+    Create a new file with CaptureFile(path, schema, capacity) or continue an
+    existing one (e.g. when a stage is resumed) with CaptureFile.open(path).
+    """
+
+    def __init__(self, path, schema=None, capacity=4096, description='', flush_interval_s=2.0):
+        self.path = path
+        self.flush_interval_s = flush_interval_s
+        self._last_flush = time.monotonic()
+        if schema is None:
+            # Continue an existing capture
+            header = read_header(path)
+            self.schema = header['schema']
+            self.count = header['count']
+            self.capacity = header['capacity']
+            self._file = open(path, 'r+b')
+        else:
+            self.schema = [(field[0], field[1]) for field in schema]
+            self.count = 0
+            self.capacity = max(int(capacity), 1)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._file = open(path, 'w+b')
+        for _, typecode in self.schema:
+            if typecode not in _NUMPY_TYPES:
+                raise ValueError(f"Typecode '{typecode}' has no fixed size and cannot be captured.")
+
+        self.fields = tuple(name for name, _ in self.schema)
+        self._record = struct.Struct('<' + ''.join(typecode for _, typecode in self.schema))
+        if schema is not None:
+            self._file.truncate(HEADER_SIZE + self.capacity * self._record.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if schema is not None:
+            self._write_header(description)
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        return cls(path, schema=None, **kwargs)
+
+    def _write_header(self, description):
+        metadata = json.dumps({
+            'schema': self.schema,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'description': description
+        }).encode('utf-8')
+        if _FIXED.size + len(metadata) > HEADER_SIZE:
+            raise ValueError("Capture metadata does not fit into the header.")
+        self._map[:HEADER_SIZE] = (_FIXED.pack(MAGIC, self.count, self.capacity, HEADER_SIZE, self._record.size)
+                                   + metadata).ljust(HEADER_SIZE, b'\0')
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, *values):
+        """Appends one record. Values must be given in schema order."""
+        if self.count == self.capacity:
+            self._grow()
+        self._record.pack_into(self._map, HEADER_SIZE + self.count * self._record.size, *values)
+        self.count += 1
+        # The count is written after the record, so readers never see a partial record
+        _COUNT.pack_into(self._map, 8, self.count)
+        if time.monotonic() - self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def __iter__(self):
+        """Yields the records written so far as tuples, without loading them all."""
+        end = HEADER_SIZE + self.count * self._record.size
+        with memoryview(self._map) as view:
+            yield from self._record.iter_unpack(view[HEADER_SIZE:end])
+
+    def _grow(self):
+        self.capacity = max(self.capacity * 2, self.capacity + GROW_RECORDS)
+        self._map.close()
+        self._file.truncate(HEADER_SIZE + self.capacity * self._record.size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        _COUNT.pack_into(self._map, 16, self.capacity)
+
+    def flush(self):
+        """Writes the mapped pages to disk, so a power loss keeps the records up to now."""
+        self._map.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flushes and closes the file. The unused preallocated space is kept, see the module docstring."""
+        if self._map.closed:
+            return
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+def read_header(path):
+    """Returns the header of a capture file as a dictionary."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    magic, count, capacity, header_size, record_size = _FIXED.unpack_from(header)
+    if magic != MAGIC:
+        raise ValueError(f"'{path}' is not a capture file.")
+    metadata = json.loads(header[_FIXED.size:header_size].rstrip(b'\0'))
+    metadata['schema'] = [tuple(field) for field in metadata['schema']]
+    metadata.update(count=count, capacity=capacity, header_size=header_size, record_size=record_size)
+    return metadata
+
+
+def numpy_dtype(schema):
+    return np.dtype([(name, _NUMPY_TYPES[typecode]) for name, typecode in schema])
+
+
+def load(path):
+    """
+    Maps the records written so far as a read-only numpy structured array, without
+    copying them into memory, e.g. load(path)['v_a']. Can be called while the file
+    is still being written; call it again to see newer records.
+    """
+    if np is None:
+        raise RuntimeError("Reading capture files needs the 'numpy' package.")
+    header = read_header(path)
+    dtype = numpy_dtype(header['schema'])
+    if header['count'] == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=header['header_size'], shape=(header['count'],))
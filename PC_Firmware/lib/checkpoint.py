@@ -0,0 +1,100 @@
+import json
+import os
+import time
+
+from lib.records import json_default
+
+CHECKPOINT_DIR = 'checkpoints'
+
+
+class StageProgress:
+    """
+    Partial progress of a single stage, e.g. the sweep position and the data
+    logged so far. Stages read 'state' when they start and call 'update' as
+    they make progress.
+    """
+
+    def __init__(self, checkpoint, name):
+        self.checkpoint = checkpoint
+        self.name = name
+
+    @property
+    def state(self):
+        return self.checkpoint.data['stage_state'].setdefault(self.name, {})
+
+    def update(self, force=False, **values):
+        """Stores new progress values and persists them (throttled unless forced)."""
+        self.state.update(values)
+        self.checkpoint.data['current_stage'] = self.name
+        self.checkpoint.save(force=force)
+
+
+class SequenceCheckpoint:
+    """
+    Persists the progress of a full test sequence for one board to
+    'checkpoints/checkpoint_<serial>.json' so an interrupted sequence can be resumed.
+    Writes are atomic (temporary file + rename), so a crash during a save never
+    leaves a corrupt checkpoint behind.
+    """
+
+    def __init__(self, serial_number, save_interval_s=2.0, directory=CHECKPOINT_DIR):
+        self.path = os.path.join(directory, f"checkpoint_{serial_number}.json")
+        self.save_interval_s = save_interval_s
+        self._last_save = 0.0
+        self.data = {
+            'serial_number': serial_number,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'completed_stages': [],
+            'current_stage': None,
+            'stage_state': {}
+        }
+
+    @classmethod
+    def load(cls, serial_number):
+        """Returns the stored checkpoint for a serial number, or None if there is none."""
+        checkpoint = cls(serial_number)
+        if not os.path.exists(checkpoint.path):
+            return None
+        try:
+            with open(checkpoint.path, 'r') as f:
+                checkpoint.data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warning: Could not read checkpoint '{checkpoint.path}': {e}")
+            return None
+        return checkpoint
+
+    def save(self, force=False):
+        """Writes the checkpoint to disk. Unforced saves are limited to one per save interval."""
+        now = time.time()
+        if not force and now - self._last_save < self.save_interval_s:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, default=json_default)
+        os.replace(tmp_path, self.path)
+        self._last_save = now
+
+    def clear(self):
+        """Removes the checkpoint once the sequence has finished."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def progress(self, name):
+        return StageProgress(self, name)
+
+    def is_completed(self, name):
+        return any(stage == name for stage, _ in self.data['completed_stages'])
+
+    def completed_result(self, name):
+        for stage, result in self.data['completed_stages']:
+            if stage == name:
+                return result
+        return None
+
+    def complete_stage(self, name, result):
+        """Marks a stage as finished and drops its partial state."""
+        self.data['completed_stages'].append([name, result])
+        self.data['stage_state'].pop(name, None)
+        self.data['current_stage'] = None
+        self.save(force=True)
@@ -0,0 +1,143 @@
+import time
+import serial
+
+from lib import metrics, protocol, timeline, utils
+
+
+class SerialReconnected(Exception):
+    """
+    Raised to the running stage when the connection was lost and has been
+    re-established. The device may have reset, so the stage should be retried.
+    """
+
+
+class SupervisedSerial:
+    """
+    A serial connection that survives USB re-enumeration.
+
+    It offers the parts of the serial.Serial interface used by the test functions.
+    If an operation fails because the port went away (e.g. an ESP32 USB-UART
+    bridge re-enumerating after a brown-out), the same device is looked up again
+    by USB VID/PID and serial string, reopened and re-identified with 'GET_TEST_INFO'.
+    The failed operation then raises SerialReconnected so the stage can retry.
+    If the device does not come back within 'reconnect_timeout_s',
+    serial.SerialException is raised as before.
+    'opener' creates the port as serial.Serial(port, baud_rate, timeout=...) does,
+    e.g. to record the session with lib.trace or to replay one.
+    """
+
+    def __init__(self, port_info, baud_rate, timeout=3, reconnect_timeout_s=30, opener=serial.Serial):
+        # Accept both a plain device name and a list_ports port info object
+        self.port = getattr(port_info, 'device', port_info)
+        self.vid = getattr(port_info, 'vid', None)
+        self.pid = getattr(port_info, 'pid', None)
+        self.usb_serial_number = getattr(port_info, 'serial_number', None)
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.reconnect_timeout_s = reconnect_timeout_s
+        self.reconnect_count = 0
+        self.test_info = None  # Last 'GET_TEST_INFO' reply, see identify()
+        self.opener = opener
+        self.ser = None
+
+    def open(self):
+        self.ser = self.opener(self.port, self.baud_rate, timeout=self.timeout)
+        return self
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
+            self.ser = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def identify(self, timeout_s=5.0):
+        """
+        Polls 'GET_TEST_INFO' until the device answers and caches the reply as 'test_info'.
+        The ESP32 may reset when the port is opened. Polling picks it up as soon as it
+        has booted instead of waiting a fixed time, and a device that did not reset
+        answers in a single round trip, which makes this cheap enough to re-validate
+        the connection before every board. Returns the TestInfo record, or None.
+        """
+        deadline = time.time() + timeout_s
+        while time.time() < deadline:
+            record = protocol.query(self.ser, "GET_TEST_INFO", protocol.TestInfo, timeout=0.3)
+            if record is None:
+                continue
+            if self.test_info and record.master_id != self.test_info.master_id:
+                print(f"Warning: Master ID changed from {self.test_info.master_id} to {record.master_id}.")
+            self.test_info = record
+            return record
+        return None
+
+    # --- Supervised serial.Serial interface ---
+
+    def _call(self, operation):
+        if self.ser is None:
+            # A failed reconnect leaves no port. Callers' cleanup code must see the serial error.
+            raise serial.SerialException(f"{self.port} is not connected.")
+        try:
+            return operation()
+        except (serial.SerialException, OSError) as e:
+            print(f"\nSerial connection lost ({e}). Trying to reconnect...")
+            with timeline.span("reconnect", 'wait', error=str(e)):
+                self._reconnect()
+            raise SerialReconnected(f"Reconnected to {self.port} after: {e}") from e
+
+    def write(self, data):
+        return self._call(lambda: self.ser.write(data))
+
+    def read(self, size=1):
+        return self._call(lambda: self.ser.read(size))
+
+    def readline(self):
+        return self._call(lambda: self.ser.readline())
+
+    def read_all(self):
+        return self._call(lambda: self.ser.read_all())
+
+    def reset_input_buffer(self):
+        return self._call(lambda: self.ser.reset_input_buffer())
+
+    def flush(self):
+        return self._call(lambda: self.ser.flush())
+
+    @property
+    def in_waiting(self):
+        return self._call(lambda: self.ser.in_waiting)
+
+    # --- Reconnection ---
+
+    def _find_port(self):
+        if self.vid is None:
+            # Not a USB device, the name is the only identity we have
+            return self.port
+        return utils.find_serial_port(self.vid, self.pid, self.usb_serial_number)
+
+    def _reconnect(self):
+        """Waits for the device to reappear, reopens it and re-syncs. Raises serial.SerialException on failure."""
+        self.close()
+        deadline = time.time() + self.reconnect_timeout_s
+        while time.time() < deadline:
+            port = self._find_port()
+            if port:
+                try:
+                    self.ser = self.opener(port, self.baud_rate, timeout=self.timeout)
+                    self.port = port
+                    if self.identify():
+                        self.reconnect_count += 1
+                        metrics.reconnected()
+                        print(f"Reconnected to {port}.")
+                        return
+                except (serial.SerialException, OSError):
+                    pass
+                self.close()
+            time.sleep(0.5)
+        raise serial.SerialException(f"Device did not reappear within {self.reconnect_timeout_s}s.")
@@ -0,0 +1,101 @@
+"""
+Console output for the measurement loops.
+
+Writing to the terminal can take a large share of a loop iteration (Windows
+consoles, remote sessions), so loops post their output as events to a
+ConsoleRenderer instead of printing. A background thread draws the events.
+"""
+import queue
+import sys
+import threading
+import time
+
+_STOP = ('stop', None)
+
+
+class ConsoleRenderer:
+    """
+    Draws console output on a background thread, so posting never blocks the caller.
+
+    progress(text) replaces the status line. Updates are coalesced, so at most
+    'refresh_hz' redraws per second show the latest one. message(text) prints a
+    full line above the status line, e.g. a failure that must stay visible.
+    Use the renderer as a context manager. On exit, all queued output is drawn.
+    """
+
+    def __init__(self, refresh_hz=10, stream=None, width=120):
+        self.period_s = 1.0 / refresh_hz
+        self.stream = stream or sys.stdout
+        self.width = width
+        self._events = queue.SimpleQueue()
+        self._thread = None
+        self._drawn = ''  # Status line currently on screen
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='console-renderer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Draws everything still queued and ends the status line."""
+        if self._thread is not None:
+            self._events.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def progress(self, text):
+        self._events.put(('progress', text))
+
+    def message(self, text):
+        self._events.put(('message', text))
+
+    def _run(self):
+        pending = None
+        next_draw = 0.0
+        while True:
+            # Only wait with a timeout while a coalesced update is held back
+            timeout = max(0.0, next_draw - time.monotonic()) if pending is not None else None
+            try:
+                kind, text = self._events.get(timeout=timeout)
+            except queue.Empty:
+                kind, text = None, None
+
+            if kind == 'progress':
+                pending = text
+            elif kind == 'message':
+                self._write_message(text)
+            elif kind == 'stop':
+                if pending is not None:
+                    self._draw(pending)
+                if self._drawn:
+                    self.stream.write('\n')
+                    self._drawn = ''
+                self.stream.flush()
+                return
+
+            now = time.monotonic()
+            if pending is not None and now >= next_draw:
+                self._draw(pending)
+                pending = None
+                next_draw = now + self.period_s
+
+    def _draw(self, text):
+        text = text[:self.width]
+        self.stream.write('\r' + text.ljust(len(self._drawn)))
+        self.stream.flush()
+        self._drawn = text
+
+    def _write_message(self, text):
+        if self._drawn:
+            self.stream.write('\r' + ' ' * len(self._drawn) + '\r')
+        self.stream.write(text + '\n')
+        if self._drawn:
+            self.stream.write(self._drawn)
+        self.stream.flush()
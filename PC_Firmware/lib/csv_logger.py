@@ -1,7 +1,67 @@
 import pandas as pd
 import matplotlib.pyplot as plt
+import ast
+import csv
+import json
 import os
 import sys
+import time
+
+from lib.records import json_default
+
+LOG_DIR = 'logs'
+LOG_COLUMNS = ['Timestamp', 'Operator_Name', 'Master_ID', 'Serial_Number', 'Test_Name', 'Overall_Result',
+               'Test_Specific_Data']
+
+
+class CsvLogger:
+    """
+    Writes one CSV row per logged test result to 'logs/test_log_<timestamp>.csv'.
+    'Test_Specific_Data' is stored as JSON; RecordBuffers are written in their
+    columnar form without converting them to dictionaries first.
+    The summary and plot are generated when the logger is closed.
+    """
+
+    def __init__(self, log_dir=LOG_DIR):
+        os.makedirs(log_dir, exist_ok=True)
+        self.log_file_path = os.path.join(log_dir, f"test_log_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+        self.file = open(self.log_file_path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(LOG_COLUMNS)
+        self.rows_written = 0
+
+    def log_data(self, test_name, overall_result, session_details, test_data):
+        """Appends one result row and flushes it, so nothing is lost if the program is killed."""
+        session_details = session_details or {}
+        self.writer.writerow([
+            time.strftime('%Y-%m-%d %H:%M:%S'),
+            session_details.get('operator_name', ''),
+            session_details.get('master_id', ''),
+            session_details.get('serial_number', ''),
+            test_name,
+            overall_result,
+            json.dumps(test_data, default=json_default)
+        ])
+        self.file.flush()
+        self.rows_written += 1
+
+    def close(self):
+        """Closes the log file and runs the analysis if anything was logged."""
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.rows_written:
+            analyze_and_plot_logs(self.log_file_path)
+
+
+def parse_test_data(value):
+    """Parses a 'Test_Specific_Data' cell (JSON, or a Python literal in older logs)."""
+    if not isinstance(value, str) or not value:
+        return {}
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
 
 
 def analyze_and_plot_logs(log_file_path):
@@ -48,7 +108,7 @@ def analyze_and_plot_logs(log_file_path):
 
     # --- Generate Plots ---
     # Convert Test_Specific_Data from string to dictionary for easier plotting
-    df['Test_Specific_Data'] = df['Test_Specific_Data'].apply(lambda x: eval(x) if isinstance(x, str) and x else {})
+    df['Test_Specific_Data'] = df['Test_Specific_Data'].apply(parse_test_data)
 
     # Extract readings for plotting
     readings = []
@@ -58,12 +118,17 @@ def analyze_and_plot_logs(log_file_path):
     if not initial_check_df.empty:
         for _, row in initial_check_df.iterrows():
             if 'readings' in row['Test_Specific_Data']:
-                readings.append(row['Test_Specific_Data']['readings'])
-                timestamps.append(row['Timestamp'])
+                reading = row['Test_Specific_Data']['readings']
+                readings.append(reading)
+                # Prefer the device-based sample time over the PC log time
+                if reading.get('t_wall'):
+                    timestamps.append(pd.to_datetime(reading['t_wall'], unit='s'))
+                else:
+                    timestamps.append(pd.to_datetime(row['Timestamp']))
 
     if readings:
         readings_df = pd.DataFrame(readings)
-        readings_df.index = pd.to_datetime(timestamps)
+        readings_df.index = pd.DatetimeIndex(timestamps)
 
         fig, ax1 = plt.subplots(figsize=(12, 6))
 
@@ -0,0 +1,54 @@
+import time
+from collections import deque
+
+from lib import protocol
+
+
+class DeviceClock:
+    """
+    Maps the master's monotonic microsecond clock to PC wall time.
+
+    Each sync round sends 'GET_TIME' and records the send and receive wall times
+    around the device reply. Assuming the reply was stamped half way through the
+    round trip, every round yields an offset estimate whose error is bounded by
+    half the round-trip time. As in NTP, only the sample with the smallest round
+    trip in the recent window is trusted, which filters out USB and scheduling jitter.
+    """
+
+    def __init__(self, window=16):
+        self.samples = deque(maxlen=window)  # (rtt_s, offset_s)
+        self.offset_s = None
+        self.rtt_s = None
+
+    def add_sample(self, t_send, device_us, t_recv):
+        """Adds one request/response exchange and updates the offset estimate."""
+        rtt = t_recv - t_send
+        offset = (t_send + t_recv) / 2.0 - device_us / 1e6
+        self.samples.append((rtt, offset))
+        self.rtt_s, self.offset_s = min(self.samples)
+
+    def sync(self, ser, rounds=8, timeout=1):
+        """
+        Performs a number of 'GET_TIME' exchanges with the device.
+        Returns True if at least one valid reply was received.
+        """
+        received = 0
+        for _ in range(rounds):
+            t_send = time.time()
+            record = protocol.query(ser, "GET_TIME", protocol.DeviceTime, timeout=timeout)
+            t_recv = time.time()
+            if record is None:
+                continue
+            self.add_sample(t_send, record.t_device_us, t_recv)
+            received += 1
+        return received > 0
+
+    @property
+    def is_synced(self):
+        return self.offset_s is not None
+
+    def to_wall(self, device_us):
+        """Converts a device timestamp in microseconds to a wall-clock time in seconds (epoch)."""
+        if device_us is None or self.offset_s is None:
+            return None
+        return device_us / 1e6 + self.offset_s
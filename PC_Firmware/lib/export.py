@@ -0,0 +1,347 @@
+"""
+Exports logged sessions into a single compressed, self-describing HDF5 archive.
+
+Archive layout (format 'cic-qc-export', see FORMAT_VERSION):
+    /sources                  one row per exported log file and the number of its rows already exported
+    /sessions                 one row per board session (log file + serial number)
+    /results                  one row per logged test result, with its scalar data as JSON
+    /measurements/<test>/<series>/<column>
+                              columnar measurement series (sweeps, burnout samples, ...) with a
+                              'result_index' column pointing into /results
+    /plots/<log file>         optional analysis plots, stored as PNG bytes
+
+Log files are read row by row and every row is appended straight to resizable,
+chunked datasets, so memory use does not grow with the size of the export.
+Series stored in capture files (logged as {'captures': {series: path}}, see
+lib/capture.py) are copied block by block into the same /measurements layout.
+Exporting into an existing archive only adds rows that are not in it yet, so a
+daily export touches only new sessions and rows appended to open logs. A column
+whose values change type between exports (e.g. 'PASS'/'FAIL' where older logs
+had 0/1) is widened from integer to float to string instead of failing the append.
+
+Usage (from the PC_Firmware directory):
+    python -m lib.export [logs ...] [-o export.h5] [--serial 0001 --serial 0002] [--plots]
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+
+try:
+    import h5py
+    import numpy as np
+except ImportError:  # Optional dependency, only needed for the export
+    h5py = None
+
+from lib import capture
+from lib.csv_logger import LOG_COLUMNS, LOG_DIR, parse_test_data
+
+FORMAT_NAME = 'cic-qc-export'
+FORMAT_VERSION = 1
+DEFAULT_ARCHIVE = 'qc_export.h5'
+
+# Keys of 'Test_Specific_Data' holding columnar measurement series
+SERIES_KEYS = ('records', 'samples', 'temperatures')
+
+# Capture file records are copied into the archive in blocks of this many rows
+CAPTURE_BLOCK_ROWS = 65536
+
+_COMPRESSION = dict(compression='gzip', compression_opts=4, shuffle=True)
+
+# Burnout rows can exceed the csv module's default field size limit of 128 KiB
+csv.field_size_limit(2 ** 31 - 1)
+
+if h5py is not None:
+    _STR = h5py.string_dtype()
+    SOURCE_DTYPE = np.dtype([('log_file', _STR), ('rows_exported', 'i8')])
+    SESSION_DTYPE = np.dtype([('log_file', _STR), ('serial_number', _STR), ('master_id', _STR),
+                              ('operator_name', _STR), ('start', _STR), ('end', _STR), ('num_results', 'i4'),
+                              ('num_failed', 'i4')])
+    RESULT_DTYPE = np.dtype([('session_index', 'i4'), ('timestamp', _STR), ('test_name', _STR),
+                             ('result', _STR), ('data', _STR)])
+
+
+def _require_h5py():
+    if h5py is None:
+        raise RuntimeError("The export needs the 'h5py' and 'numpy' packages (pip install h5py).")
+
+
+def _table(parent, name, dtype, description):
+    """Returns a resizable, compressed one-dimensional table, creating it if needed."""
+    if name in parent:
+        return parent[name]
+    table = parent.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(256,), **_COMPRESSION)
+    table.attrs['description'] = description
+    return table
+
+
+def _append(dataset, values):
+    """Appends values to a resizable dataset and returns the index of the first new row."""
+    start = dataset.shape[0]
+    dataset.resize((start + len(values),))
+    dataset[start:] = values
+    return start
+
+
+def _as_columns(series):
+    """
+    Returns a measurement series as {column: list}, accepting the columnar form of
+    RecordBuffers and the list-of-dicts form of older logs. None for anything else.
+    """
+    if isinstance(series, dict) and series and all(isinstance(v, list) for v in series.values()):
+        lengths = {len(v) for v in series.values()}
+        return series if len(lengths) == 1 else None
+    if isinstance(series, list) and series and all(isinstance(row, dict) for row in series):
+        return {key: [row.get(key) for row in series] for key in series[0]}
+    return None
+
+
+def _column_dtype(values):
+    """The dtype for a column: string if any value is a string, else integer if all are, else float."""
+    values = [v for v in values if v is not None]
+    if any(isinstance(v, str) for v in values):
+        return _STR
+    if all(isinstance(v, (bool, int)) for v in values):
+        return np.dtype('i8')
+    return np.dtype('f8')
+
+
+def _common_dtype(dtype, other):
+    """The dtype both can be stored as: string over float over integer."""
+    kinds = {dtype.kind, other.kind}
+    return _STR if 'O' in kinds else np.dtype('f8') if 'f' in kinds else np.dtype('i8')
+
+
+def _text(value):
+    """A value of a string column. Missing values (None, NaN) are ''."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return value if isinstance(value, str) else str(value)
+
+
+class ArchiveWriter:
+    """
+    Appends log files to an export archive. Use as a context manager:
+
+        with ArchiveWriter('qc_export.h5') as archive:
+            archive.add_log_file('logs/test_log_20250101_120000.csv')
+    """
+
+    def __init__(self, path=DEFAULT_ARCHIVE, serial_numbers=None, include_plots=False):
+        _require_h5py()
+        self.path = path
+        self.serial_numbers = set(serial_numbers) if serial_numbers else None
+        self.include_plots = include_plots
+        self.file = None
+        self.rows_added = 0
+        self.sessions_added = 0
+        self._log_file_path = None  # Log file being added, to find its capture files
+
+    def __enter__(self):
+        self.file = h5py.File(self.path, 'a')
+        root = self.file.attrs
+        if 'format' not in root:
+            root['format'] = FORMAT_NAME
+            root['format_version'] = FORMAT_VERSION
+            root['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            root['description'] = ("QC test results of CIC boards. /sessions and /results are tables, "
+                                   "/measurements holds one dataset per measurement column, linked to "
+                                   "/results by 'result_index'. See lib/export.py.")
+        elif root['format'] != FORMAT_NAME or root['format_version'] > FORMAT_VERSION:
+            raise ValueError(f"'{self.path}' is not a supported {FORMAT_NAME} archive.")
+
+        self.sources = _table(self.file, 'sources', SOURCE_DTYPE, "Exported log files")
+        self.sessions = _table(self.file, 'sessions', SESSION_DTYPE,
+                               "One row per board session (log file and serial number)")
+        self.results = _table(self.file, 'results', RESULT_DTYPE,
+                              "One row per test result. 'data' is the JSON of the non-series test data.")
+        self.measurements = self.file.require_group('measurements')
+
+        # The small index tables are kept in memory to look up existing entries
+        self._source_rows = {row['log_file'].decode(): (i, row['rows_exported'])
+                             for i, row in enumerate(self.sources[:])}
+        self._session_rows = {(row['log_file'].decode(), row['serial_number'].decode()): i
+                              for i, row in enumerate(self.sessions[:])}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.attrs['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.file.close()
+
+    def add_log_file(self, log_file_path):
+        """Streams the rows of a CSV log file that are not in the archive yet. Returns the number added."""
+        log_file = os.path.basename(log_file_path)
+        self._log_file_path = log_file_path
+        source_index, rows_exported = self._source_rows.get(log_file, (None, 0))
+        added = 0
+        row_number = 0
+
+        with open(log_file_path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != LOG_COLUMNS:
+                print(f"Skipping '{log_file_path}': not a test log.")
+                return 0
+            for row_number, row in enumerate(reader, start=1):
+                if row_number <= rows_exported:
+                    continue
+                if self.serial_numbers is None or row['Serial_Number'] in self.serial_numbers:
+                    self._add_row(log_file, row)
+                    added += 1
+
+        if source_index is None:
+            source_index = _append(self.sources, [(log_file, row_number)])
+        else:
+            self.sources[source_index] = (log_file, row_number)
+        self._source_rows[log_file] = (source_index, row_number)
+
+        plot_path = log_file_path.replace('.csv', '_analysis.png')
+        plot_name = os.path.basename(plot_path)
+        if self.include_plots and os.path.exists(plot_path) and plot_name not in self.file.require_group('plots'):
+            with open(plot_path, 'rb') as f:
+                plot = self.file['plots'].create_dataset(plot_name, data=np.frombuffer(f.read(), dtype='u1'))
+            plot.attrs['mime_type'] = 'image/png'
+
+        self.rows_added += added
+        return added
+
+    def _session_index(self, log_file, row):
+        key = (log_file, row['Serial_Number'])
+        index = self._session_rows.get(key)
+        if index is None:
+            index = _append(self.sessions, [(log_file, row['Serial_Number'], row['Master_ID'], row['Operator_Name'],
+                                             row['Timestamp'], row['Timestamp'], 0, 0)])
+            self._session_rows[key] = index
+            self.sessions_added += 1
+        return index
+
+    def _add_row(self, log_file, row):
+        session_index = self._session_index(log_file, row)
+        data = parse_test_data(row['Test_Specific_Data'])
+        series = {}
+        if isinstance(data, dict):
+            for key in SERIES_KEYS:
+                columns = _as_columns(data.get(key))
+                if columns is not None:
+                    series[key] = columns
+                    del data[key]
+
+        result_index = _append(self.results, [(session_index, row['Timestamp'], row['Test_Name'],
+                                               row['Overall_Result'], json.dumps(data))])
+        for key, columns in series.items():
+            self._add_series(row['Test_Name'], key, result_index, columns)
+        if isinstance(data, dict) and isinstance(data.get('captures'), dict):
+            for key, path in data['captures'].items():
+                self._add_capture(row['Test_Name'], key, result_index, path)
+
+        session = self.sessions[session_index]
+        session['end'] = row['Timestamp']
+        session['num_results'] += 1
+        session['num_failed'] += row['Overall_Result'] == 'FAIL'
+        self.sessions[session_index] = session
+
+    def _add_series(self, test_name, key, result_index, columns):
+        group = self.measurements.require_group(test_name.replace('/', '_')).require_group(key)
+        length = len(next(iter(columns.values())))
+        before = group['result_index'].shape[0] if 'result_index' in group else 0
+        columns = dict(columns, result_index=[result_index] * length)
+        for name, values in columns.items():
+            dtype = _column_dtype(values)
+            if name not in group:
+                _create_column(group, name, dtype)
+            elif _common_dtype(group[name].dtype, dtype) != group[name].dtype:
+                # E.g. 'PASS'/'FAIL' where earlier logs had 0/1: widen the column instead of failing the append
+                _convert_column(group, name, _common_dtype(group[name].dtype, dtype))
+            dataset = group[name]
+            _pad(dataset, before)
+            if dataset.dtype.kind == 'O':
+                values = [_text(v) for v in values]
+            else:
+                values = [_missing(dataset) if v is None else v for v in values]
+            _append(dataset, np.asarray(values, dtype=dataset.dtype))
+        # Columns missing from this series (e.g. from an older log version) are padded, so all stay aligned
+        for dataset in group.values():
+            _pad(dataset, before + length)
+
+    def _add_capture(self, test_name, key, result_index, path):
+        """Adds the records of a capture file as a measurement series, one block at a time."""
+        if not os.path.exists(path):
+            # Log and captures may have been moved together, captures live in <log dir>/captures
+            path = os.path.join(os.path.dirname(self._log_file_path), 'captures', os.path.basename(path))
+        if not os.path.exists(path):
+            print(f"  Capture file '{os.path.basename(path)}' not found, its {key} are not exported.")
+            return
+        records = capture.load(path)
+        for start in range(0, len(records), CAPTURE_BLOCK_ROWS):
+            block = records[start:start + CAPTURE_BLOCK_ROWS]
+            self._add_series(test_name, key, result_index, {name: block[name].tolist() for name in block.dtype.names})
+
+
+def _create_column(group, name, dtype):
+    return group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(4096,), **_COMPRESSION)
+
+
+def _convert_column(group, name, dtype):
+    """Rewrites a measurement column with a wider dtype (see _common_dtype), keeping its values."""
+    values = group[name][:]
+    del group[name]
+    dataset = _create_column(group, name, dtype)
+    if len(values):
+        if dataset.dtype.kind == 'O':
+            values = [_text(v) for v in values.tolist()]
+        _append(dataset, np.asarray(values, dtype=dataset.dtype))
+
+
+def _missing(dataset):
+    """Fill value for a missing entry: '' for strings, -1 for integers, NaN for floats."""
+    kind = dataset.dtype.kind
+    return '' if kind == 'O' else -1 if kind == 'i' else np.nan
+
+
+def _pad(dataset, length):
+    if dataset.shape[0] < length:
+        _append(dataset, np.full(length - dataset.shape[0], _missing(dataset), dtype=dataset.dtype))
+
+
+def find_log_files(paths):
+    """Expands files and directories to the CSV test logs they contain, oldest first."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, 'test_log_*.csv')))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def export_logs(paths, archive_path=DEFAULT_ARCHIVE, serial_numbers=None, include_plots=False):
+    """Exports the given log files/directories into the archive. Returns the ArchiveWriter for its counters."""
+    with ArchiveWriter(archive_path, serial_numbers, include_plots) as archive:
+        for log_file_path in find_log_files(paths):
+            added = archive.add_log_file(log_file_path)
+            if added:
+                print(f"  {log_file_path}: {added} new result(s)")
+    print(f"Exported {archive.rows_added} result(s) of {archive.sessions_added} new session(s) to '{archive_path}'.")
+    return archive
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports test logs into one compressed HDF5 archive.")
+    parser.add_argument('paths', nargs='*', default=[LOG_DIR], help="Log files or directories (default: logs).")
+    parser.add_argument('-o', '--output', default=DEFAULT_ARCHIVE, help="Archive to create or append to.")
+    parser.add_argument('--serial', action='append',
+                        help="Only export this serial number (repeatable). Other boards are not added to the "
+                             "archive later either.")
+    parser.add_argument('--plots', action='store_true', help="Include the analysis plots.")
+    args = parser.parse_args()
+    try:
+        export_logs(args.paths, args.output, args.serial, args.plots)
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
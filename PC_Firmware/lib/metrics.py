@@ -0,0 +1,152 @@
+"""
+Prometheus metrics of a test station.
+
+When started, a local HTTP endpoint (default http://127.0.0.1:9108/metrics)
+exposes the throughput and timing of the station, so a Prometheus server (or a
+plain 'curl') can scrape it while boards are being tested:
+
+    qc_boards_tested_total{station, result}           boards per overall result (pass, fail, interrupted)
+    qc_stage_results_total{station, stage, result}    stage results (pass, fail, pre_check_failed)
+    qc_stage_duration_seconds{station, stage}         histogram of stage run times
+    qc_serial_command_seconds{station, command}       histogram of command round trips
+    qc_serial_reconnects_total{station}               USB reconnects
+    qc_current_stage{station, stage}                  1 for the stage that is running now
+
+Metrics are off until start() is called, or if the 'prometheus_client' package
+is not installed. The functions below then return at once, so instrumented code
+needs no checks of its own.
+"""
+import contextlib
+import time
+
+try:
+    import prometheus_client
+except ImportError:  # Optional dependency, only needed for the metrics endpoint
+    prometheus_client = None
+
+DEFAULT_PORT = 9108
+DEFAULT_ADDRESS = '127.0.0.1'
+
+# Stage runs take seconds (initial checks) to hours (burnout)
+_STAGE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+# Command round trips take milliseconds, CAN tests and sequences seconds
+_COMMAND_BUCKETS = (0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NO_TIMER = contextlib.nullcontext()
+_metrics = None
+
+
+class StationMetrics:
+    """The metrics of one station, registered in a registry of their own."""
+
+    def __init__(self, station):
+        self.station = station
+        self.registry = prometheus_client.CollectorRegistry()
+        self.boards = prometheus_client.Counter(
+            'qc_boards_tested', "Boards run through the full test sequence.",
+            ('station', 'result'), registry=self.registry)
+        self.stage_results = prometheus_client.Counter(
+            'qc_stage_results', "Results of the test stages.",
+            ('station', 'stage', 'result'), registry=self.registry)
+        self.stage_duration = prometheus_client.Histogram(
+            'qc_stage_duration_seconds', "Run time of the test stages.",
+            ('station', 'stage'), buckets=_STAGE_BUCKETS, registry=self.registry)
+        self.command_latency = prometheus_client.Histogram(
+            'qc_serial_command_seconds', "Round trip of serial commands, from sending to the reply.",
+            ('station', 'command'), buckets=_COMMAND_BUCKETS, registry=self.registry)
+        self.reconnects = prometheus_client.Counter(
+            'qc_serial_reconnects', "USB reconnects of the serial connection.",
+            ('station',), registry=self.registry)
+        self.current_stage = prometheus_client.Gauge(
+            'qc_current_stage', "1 for the stage the station is running, no sample when idle.",
+            ('station', 'stage'), registry=self.registry)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+def start(config, station):
+    """
+    Starts the metrics endpoint as configured in the 'metrics' section of the
+    config ('enabled', 'port', 'address'). Returns its URL, or None if metrics
+    are disabled, 'prometheus_client' is missing or the port is in use.
+    """
+    global _metrics
+    settings = config.get('metrics', {})
+    if not settings.get('enabled', False):
+        return None
+    if prometheus_client is None:
+        print("Metrics are enabled, but the 'prometheus_client' package is not installed.")
+        return None
+    port = settings.get('port', DEFAULT_PORT)
+    address = settings.get('address', DEFAULT_ADDRESS)
+    metrics = StationMetrics(station)
+    try:
+        prometheus_client.start_http_server(port, addr=address, registry=metrics.registry)
+    except OSError as e:
+        print(f"Warning: Cannot serve metrics on {address}:{port}: {e}")
+        return None
+    _metrics = metrics
+    return f"http://{address}:{port}/metrics"
+
+
+def is_enabled():
+    return _metrics is not None
+
+
+def set_station(station):
+    """Labels the following samples with 'station', e.g. once the device reported its Master ID."""
+    if _metrics is not None:
+        _metrics.station = station
+
+
+def command(name):
+    """Context manager timing a serial command round trip. Only the command word is used as label."""
+    if _metrics is None:
+        return _NO_TIMER
+    return _Timer(_metrics.command_latency.labels(_metrics.station, name.split(' ', 1)[0]))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Marks 'name' as the current stage and times it, e.g. 'with metrics.stage("Burnout Test"):'."""
+    if _metrics is None:
+        yield
+        return
+    station = _metrics.station
+    _metrics.current_stage.labels(station, name).set(1)
+    try:
+        with _Timer(_metrics.stage_duration.labels(station, name)):
+            yield
+    finally:
+        _metrics.current_stage.remove(station, name)
+
+
+def stage_result(name, result):
+    """Counts a stage result: True/False for pass/fail or a string such as 'pre_check_failed'."""
+    if _metrics is not None:
+        label = result if isinstance(result, str) else ('pass' if result else 'fail')
+        _metrics.stage_results.labels(_metrics.station, name, label).inc()
+
+
+def board_finished(result):
+    """Counts a board at the end of the full sequence: 'pass', 'fail' or 'interrupted'."""
+    if _metrics is not None:
+        _metrics.boards.labels(_metrics.station, result).inc()
+
+
+def reconnected():
+    if _metrics is not None:
+        _metrics.reconnects.labels(_metrics.station).inc()
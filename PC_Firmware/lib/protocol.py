@@ -0,0 +1,143 @@
+"""
+Codec for the line-based protocol spoken by the master ESP32.
+
+Every reply has the form '<TYPE>:<payload>[;T=<device_us>]'. Parsing is table
+driven: the type prefix selects a precompiled pattern, a converter per field and
+the record type to build. All decoders return None for lines that do not parse,
+and numeric readings that could not be obtained are reported as INVALID.
+"""
+import math
+import re
+import time
+from collections import namedtuple
+
+from lib import metrics, timeline
+
+# The single sentinel for a reading that could not be obtained or parsed
+INVALID = -999.0
+
+AdcData = namedtuple('AdcData', 'cic_v cic_i vcan_v vcan_i t_device_us')
+# Reply to 'CHECK_SPI_ADC <n>': n conversions aggregated per channel. The channel names
+# hold the means, so the record can be used where an AdcData is expected.
+AdcAggregate = namedtuple('AdcAggregate', 'n cic_v cic_v_min cic_v_max cic_v_std cic_i cic_i_min cic_i_max cic_i_std '
+                                          'vcan_v vcan_v_min vcan_v_max vcan_v_std '
+                                          'vcan_i vcan_i_min vcan_i_max vcan_i_std t_device_us')
+MasterSpi = namedtuple('MasterSpi', 'v i t_device_us')
+VcanData = namedtuple('VcanData', 'v_a v_b t_device_us')
+I2cVoltage = namedtuple('I2cVoltage', 'channel v t_device_us')
+# Replies to 'READ_I2C_VOLTAGES' and 'READ_ALL_SPI': both boards read at the same time, nan for board B without reading
+I2cVoltages = namedtuple('I2cVoltages', 'v_a v_b t_device_us')
+AllSpi = namedtuple('AllSpi', 'v_a i_a v_b i_b t_device_us')
+Temperatures = namedtuple('Temperatures', 'master slave t_device_us')
+TestInfo = namedtuple('TestInfo', 'master_id psu_voltage t_device_us')
+DeviceTime = namedtuple('DeviceTime', 't_device_us')
+Ack = namedtuple('Ack', 'name t_device_us')
+Capabilities = namedtuple('Capabilities', 'protocol_version max_batch baud framing commands t_device_us')
+DeviceError = namedtuple('DeviceError', 'code detail t_device_us')
+CurrentRecord = namedtuple('CurrentRecord',
+                           'code v_spi_a v_spi_b v_i2c_a v_i2c_b current_set i_a i_b settled_ms t_device_us')
+CurrentSeqDone = namedtuple('CurrentSeqDone', 'count t_device_us')
+# Reply to 'GET_LATENCY': the firmware's turnaround per command name, as CommandLatency in microseconds
+FirmwareLatency = namedtuple('FirmwareLatency', 'commands t_device_us')
+CommandLatency = namedtuple('CommandLatency', 'count mean_us max_us')
+
+_NUM = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf|-inf)'
+_STAMP = r'(?:;T=(\d+))?'
+
+
+def _latencies(payload):
+    entries = (entry.split(':') for entry in payload.split(',') if entry)
+    return {name: CommandLatency(int(count), int(mean_us), int(max_us)) for name, count, mean_us, max_us in entries}
+
+
+# Type prefix -> (record factory, compiled payload pattern, converters for the pattern groups)
+# The last group of every pattern is the optional device timestamp.
+_PARSERS = {
+    'DATA': (AdcData, re.compile(rf'{_NUM},{_NUM},{_NUM},{_NUM}{_STAMP}'), (float, float, float, float)),
+    'DATA_AGG': (AdcAggregate, re.compile(rf'(\d+):{",".join([_NUM] * 16)}{_STAMP}'), (int,) + (float,) * 16),
+    'MASTER_SPI': (MasterSpi, re.compile(rf'{_NUM},{_NUM}{_STAMP}'), (float, float)),
+    'VCAN_DATA': (VcanData, re.compile(rf'{_NUM},{_NUM}{_STAMP}'), (float, float)),
+    'I2C_VOLTAGE_A': (lambda v, t: I2cVoltage('A', v, t), re.compile(rf'{_NUM}{_STAMP}'), (float,)),
+    'I2C_VOLTAGE_B': (lambda v, t: I2cVoltage('B', v, t), re.compile(rf'{_NUM}{_STAMP}'), (float,)),
+    'I2C_VOLTAGES': (I2cVoltages, re.compile(rf'{_NUM},{_NUM}{_STAMP}'), (float, float)),
+    'ALL_SPI': (AllSpi, re.compile(rf'{_NUM},{_NUM},{_NUM},{_NUM}{_STAMP}'), (float, float, float, float)),
+    'TEMPERATURES': (Temperatures, re.compile(rf'Master={_NUM},Slave={_NUM}{_STAMP}'), (float, float)),
+    'TEST_INFO': (TestInfo, re.compile(rf'([^:]*):{_NUM}{_STAMP}'), (str, float)),
+    'TIME': (DeviceTime, re.compile(r'(\d+)'), ()),
+    'CAPABILITIES': (Capabilities, re.compile(rf'(\d+):(\d+):(\d+):(\w+):([\w,]*){_STAMP}'),
+                     (int, int, int, str, lambda names: frozenset(filter(None, names.split(','))))),
+    'CURRENT_REC': (CurrentRecord, re.compile(rf'(\d+),{_NUM},{_NUM},{_NUM},{_NUM},([01]),{_NUM},{_NUM},(\d+){_STAMP}'),
+                    (int, float, float, float, float, lambda flag: flag == '1', float, float, int)),
+    'CURRENT_SEQ_DONE': (CurrentSeqDone, re.compile(rf'(\d+){_STAMP}'), (int,)),
+    'LATENCY': (FirmwareLatency, re.compile(rf'((?:\w+:\d+:\d+:\d+)?(?:,\w+:\d+:\d+:\d+)*){_STAMP}'),
+                (_latencies,)),
+    'ERR': (DeviceError, re.compile(rf'(\w+):?(.*?){_STAMP}'), (str, str)),
+}
+
+# Replies without payload
+_ACKS = {'ACK_CURRENT_SET'}
+
+
+def or_invalid(value):
+    """Maps a reading the firmware reported as nan to INVALID."""
+    return INVALID if math.isnan(value) else value
+
+
+def decode(line):
+    """
+    Decodes one reply line (str or bytes, with or without line ending) into its record.
+    Returns None if the line is not a known, well-formed reply.
+    """
+    if isinstance(line, (bytes, bytearray)):
+        line = line.decode('utf-8', errors='replace')
+    line = line.strip()
+    prefix, sep, payload = line.partition(':')
+    if not sep:
+        payload, _, stamp = line.partition(';T=')
+        if payload in _ACKS:
+            return Ack(payload, int(stamp) if stamp.isdigit() else None)
+        return None
+
+    parser = _PARSERS.get(prefix)
+    if parser is None:
+        return None
+    factory, pattern, converters = parser
+    match = pattern.fullmatch(payload)
+    if match is None:
+        return None
+    groups = match.groups()
+    try:
+        values = [convert(value) for convert, value in zip(converters, groups)]
+    except ValueError:
+        return None
+    stamp = groups[-1]
+    values.append(int(stamp) if stamp is not None else None)
+    return factory(*values)
+
+
+def read_record(ser, record_type, timeout=2.0):
+    """
+    Reads lines until a reply of the given record type arrives or the timeout expires.
+    Unrelated lines (e.g. relayed slave messages) are skipped. Returns None on timeout,
+    or at once if the device rejects the command with an 'ERR:' reply.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        line = ser.readline()
+        if not line:
+            continue
+        record = decode(line)
+        if isinstance(record, record_type):
+            return record
+        if isinstance(record, DeviceError):
+            print(f"Device error: {record.code} {record.detail}".rstrip())
+            return None
+    return None
+
+
+def query(ser, command, record_type, timeout=2.0):
+    """Sends a command after clearing stale input and returns the matching reply record, or None."""
+    with timeline.span(command, 'serial'), metrics.command(command):
+        ser.reset_input_buffer()
+        ser.write(f"{command}\n".encode('utf-8'))
+        return read_record(ser, record_type, timeout)
@@ -0,0 +1,382 @@
+"""
+Control of the programmable lab power supply over SCPI.
+
+ScpiPsu speaks the common SCPI subset of bench supplies (VOLT, CURR, OUTP,
+MEAS:VOLT?, MEAS:CURR?, SYST:ERR?) over a serial port or a TCP socket (raw
+SCPI, usually port 5025). The full test sequence uses it to ramp the board up,
+to check the supply's own voltage/current readback before the initial checks,
+to cross-check the supply current against the board's own current readings
+after them and to switch the board off as soon as the sequence ends or fails.
+
+PsuSimulator models a supply with a resistive load, for testing without a rig:
+in-process with "interface": "simulator", or as a TCP server for the 'tcp'
+interface with
+
+    python -m lib.psu --simulate [--port 5025]
+"""
+import argparse
+import socket
+import socketserver
+from collections import deque, namedtuple
+
+import serial
+
+from lib import timeline
+
+DEFAULT_TCP_PORT = 5025
+
+PsuReading = namedtuple('PsuReading', 'voltage current')
+
+# Long forms and optional prefixes of SCPI headers -> the short form used by the simulator
+_LONG_FORMS = (('SOURCE:', ''), ('SOUR:', ''), ('VOLTAGE', 'VOLT'), ('CURRENT', 'CURR'), ('OUTPUT', 'OUTP'),
+               ('MEASURE', 'MEAS'), ('SYSTEM', 'SYST'), ('ERROR', 'ERR'), ('INSTRUMENT', 'INST'),
+               ('NSELECT', 'NSEL'), (':LEVEL', ''), (':LEV', ''), (':IMMEDIATE', ''), (':IMM', ''),
+               (':STATE', ''), (':STAT', ''))
+
+
+class PsuError(Exception):
+    """Raised when the power supply does not answer or reports an error."""
+
+
+class SerialTransport:
+    """SCPI lines over a serial port (RS-232 or USB virtual COM port)."""
+
+    def __init__(self, port, baud_rate=9600, timeout=1.0):
+        try:
+            self.ser = serial.Serial(port, baud_rate, timeout=timeout)
+        except serial.SerialException as e:
+            raise PsuError(f"Cannot open power supply port {port}: {e}") from e
+        self.name = port
+
+    def write_line(self, line):
+        self.ser.write(f"{line}\n".encode('ascii'))
+
+    def read_line(self):
+        return self.ser.readline().decode('ascii', errors='replace').strip()
+
+    def close(self):
+        self.ser.close()
+
+
+class TcpTransport:
+    """SCPI lines over a raw TCP socket."""
+
+    def __init__(self, host, port=DEFAULT_TCP_PORT, timeout=1.0):
+        try:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        except OSError as e:
+            raise PsuError(f"Cannot connect to the power supply at {host}:{port}: {e}") from e
+        self.name = f"{host}:{port}"
+        self._buffer = b''
+
+    def write_line(self, line):
+        self.sock.sendall(f"{line}\n".encode('ascii'))
+
+    def read_line(self):
+        while b'\n' not in self._buffer:
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return ''
+            if not data:
+                return ''
+            self._buffer += data
+        line, _, self._buffer = self._buffer.partition(b'\n')
+        return line.decode('ascii', errors='replace').strip()
+
+    def close(self):
+        self.sock.close()
+
+
+class SimulatorTransport:
+    """Connects a ScpiPsu to an in-process PsuSimulator."""
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.name = "simulator"
+        self._replies = deque()
+
+    def write_line(self, line):
+        reply = self.simulator.handle(line)
+        if reply is not None:
+            self._replies.append(reply)
+
+    def read_line(self):
+        return self._replies.popleft() if self._replies else ''
+
+    def close(self):
+        pass
+
+
+class ScpiPsu:
+    """A single-output SCPI power supply (or one selected output with 'channel')."""
+
+    def __init__(self, transport, channel=None):
+        self.transport = transport
+        self.is_on = False
+        if channel is not None:
+            self.write(f"INST:NSEL {channel}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, command):
+        self.transport.write_line(command)
+
+    def query(self, command):
+        self.transport.write_line(command)
+        reply = self.transport.read_line()
+        if not reply:
+            raise PsuError(f"No reply from the power supply to '{command}'.")
+        return reply
+
+    def query_float(self, command):
+        reply = self.query(command)
+        try:
+            return float(reply)
+        except ValueError:
+            raise PsuError(f"Unexpected reply from the power supply to '{command}': '{reply}'") from None
+
+    def identify(self):
+        return self.query("*IDN?")
+
+    def check_errors(self):
+        """Reads the error queue. Raises PsuError with all queued errors, if any."""
+        errors = []
+        for _ in range(16):
+            reply = self.query("SYST:ERR?")
+            if reply.lstrip('+').startswith('0'):
+                break
+            errors.append(reply)
+        if errors:
+            raise PsuError(f"Power supply reports: {'; '.join(errors)}")
+
+    def set_voltage(self, voltage):
+        self.write(f"VOLT {voltage:.3f}")
+
+    def set_current_limit(self, current):
+        self.write(f"CURR {current:.4f}")
+
+    def output(self, on):
+        self.write(f"OUTP {'ON' if on else 'OFF'}")
+        self.is_on = on
+
+    def measure(self):
+        """Returns the voltage and current measured by the supply at its output."""
+        return PsuReading(self.query_float("MEAS:VOLT?"), self.query_float("MEAS:CURR?"))
+
+    def ramp(self, voltage, step_v=1.0, step_s=0.05):
+        """Moves the voltage setpoint to 'voltage' in steps of at most 'step_v' every 'step_s'."""
+        present = self.query_float("VOLT?") if self.is_on else 0.0
+        steps = max(1, int(abs(voltage - present) / step_v + 0.999)) if step_v > 0 else 1
+        for step in range(1, steps + 1):
+            self.set_voltage(present + (voltage - present) * step / steps)
+            if step < steps:
+                timeline.sleep(step_s, "PSU ramp step")
+
+    def power_on(self, voltage, current_limit, step_v=1.0, step_s=0.05, settle_s=0.5):
+        """
+        Sets the current limit, switches the output on at 0 V and ramps it to 'voltage'.
+        Returns the readback after 'settle_s'.
+        """
+        self.set_current_limit(current_limit)
+        if not self.is_on:
+            self.set_voltage(0.0)
+            self.output(True)
+        self.ramp(voltage, step_v, step_s)
+        self.check_errors()
+        timeline.sleep(settle_s, "PSU settle")
+        return self.measure()
+
+    def power_off(self):
+        self.output(False)
+        self.set_voltage(0.0)
+
+    def close(self):
+        self.transport.close()
+
+
+def open_psu(config):
+    """
+    Connects to the power supply configured in the 'psu' section of the config.
+    Returns None if no supply is configured. Raises PsuError if it cannot be reached.
+    """
+    settings = config.get('psu', {})
+    if not settings.get('enabled', False):
+        return None
+    interface = settings.get('interface', 'serial')
+    timeout = settings.get('timeout_s', 1.0)
+    if interface == 'serial':
+        transport = SerialTransport(settings['serial_port'], settings.get('baud_rate', 9600), timeout)
+    elif interface == 'tcp':
+        transport = TcpTransport(settings['host'], settings.get('tcp_port', DEFAULT_TCP_PORT), timeout)
+    elif interface == 'simulator':
+        transport = SimulatorTransport(PsuSimulator())
+    else:
+        raise PsuError(f"Unknown power supply interface '{interface}' (serial, tcp or simulator).")
+    psu = ScpiPsu(transport, settings.get('channel'))
+    try:
+        print(f"Power supply on {transport.name}: {psu.identify()}")
+        psu.power_off()
+    except PsuError:
+        psu.close()
+        raise
+    return psu
+
+
+def check_readback(reading, voltage, settings):
+    """
+    Cross-checks the supply's readback after power-on: the output voltage within
+    'readback_tolerance_v' of the setpoint (a supply in current limiting fails here),
+    and the board's supply current up to 'current_max_a'. Returns (passed, log data).
+    """
+    tolerance_v = settings.get('readback_tolerance_v', 0.1)
+    current_max_a = settings.get('current_max_a', settings['current_limit_a'])
+    voltage_ok = abs(reading.voltage - voltage) <= tolerance_v
+    current_ok = 0.0 <= reading.current <= current_max_a
+    data = {'setpoint_v': voltage, 'voltage_v': reading.voltage, 'current_a': reading.current,
+            'readback_tolerance_v': tolerance_v, 'current_max_a': current_max_a,
+            'voltage_ok': voltage_ok, 'current_ok': current_ok}
+    return voltage_ok and current_ok, data
+
+
+def cross_check_current(reading, board_readings, settings):
+    """
+    Compares the supply current with the board's input current measured in the
+    initial checks: the sum of the 'board_current_channels' means (e.g. cic_i).
+    Passes if they differ by at most 'board_current_tolerance_a'. Returns (passed, log data).
+    """
+    channels = settings.get('board_current_channels', ['cic_i'])
+    tolerance_a = settings.get('board_current_tolerance_a', 0.02)
+    if not all(isinstance(board_readings.get(channel), (int, float)) for channel in channels):
+        return False, {'supply_current_a': reading.current, 'board_current_channels': channels,
+                       'board_current_a': None, 'error': "board readings missing"}
+    board_current_a = sum(board_readings[channel] for channel in channels)
+    difference_a = reading.current - board_current_a
+    passed = abs(difference_a) <= tolerance_a
+    data = {'supply_current_a': reading.current, 'board_current_channels': channels,
+            'board_current_a': board_current_a, 'difference_a': difference_a,
+            'board_current_tolerance_a': tolerance_a, 'current_match': passed}
+    return passed, data
+
+
+class PsuSimulator:
+    """
+    A SCPI power supply driving a resistive load. The output goes into current
+    limiting when the load would draw more than the limit. Unknown commands are
+    queued as errors, as a real supply does.
+    """
+
+    def __init__(self, load_ohms=160.0, idn="CIC-QC,PSU-SIM,0,1.0"):
+        self.load_ohms = load_ohms
+        self.idn = idn
+        self.voltage = 0.0
+        self.current_limit = 1.0
+        self.on = False
+        self.errors = deque()
+
+    def output_state(self):
+        """Returns the (voltage, current) at the output terminals."""
+        if not self.on:
+            return 0.0, 0.0
+        current = self.voltage / self.load_ohms
+        if current > self.current_limit:
+            return self.current_limit * self.load_ohms, self.current_limit
+        return self.voltage, current
+
+    @staticmethod
+    def _normalise(header):
+        header = header.upper()
+        for long_form, short_form in _LONG_FORMS:
+            header = header.replace(long_form, short_form)
+        return header
+
+    def handle(self, line):
+        """Executes one SCPI line. Returns the reply for queries, None otherwise."""
+        header, _, argument = line.strip().partition(' ')
+        header = self._normalise(header)
+        argument = argument.strip().upper()
+        try:
+            if header == '*IDN?':
+                return self.idn
+            if header in ('*RST', '*CLS'):
+                if header == '*RST':
+                    self.voltage, self.current_limit, self.on = 0.0, 1.0, False
+                self.errors.clear()
+                return None
+            if header == '*OPC?':
+                return '1'
+            if header == 'VOLT':
+                self.voltage = float(argument)
+                return None
+            if header == 'VOLT?':
+                return f"{self.voltage:.3f}"
+            if header == 'CURR':
+                self.current_limit = float(argument)
+                return None
+            if header == 'CURR?':
+                return f"{self.current_limit:.4f}"
+            if header == 'OUTP':
+                if argument not in ('ON', 'OFF', '1', '0'):
+                    raise ValueError(argument)
+                self.on = argument in ('ON', '1')
+                return None
+            if header == 'OUTP?':
+                return '1' if self.on else '0'
+            if header == 'MEAS:VOLT?':
+                return f"{self.output_state()[0]:.4f}"
+            if header == 'MEAS:CURR?':
+                return f"{self.output_state()[1]:.5f}"
+            if header == 'SYST:ERR?':
+                return self.errors.popleft() if self.errors else '0,"No error"'
+            if header == 'INST:NSEL':
+                int(argument)
+                return None
+        except ValueError:
+            self.errors.append(f'-224,"Illegal parameter value: {line.strip()}"')
+            return None
+        self.errors.append(f'-113,"Undefined header: {line.strip()}"')
+        return '' if header.endswith('?') else None
+
+
+class _SimulatorHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            reply = self.server.simulator.handle(raw.decode('ascii', errors='replace'))
+            if reply is not None:
+                self.wfile.write(f"{reply}\n".encode('ascii'))
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    """Serves a PsuSimulator over raw TCP, like the SCPI socket of a networked supply."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_TCP_PORT, simulator=None):
+        self.simulator = simulator or PsuSimulator()
+        super().__init__((host, port), _SimulatorHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SCPI power supply simulator.")
+    parser.add_argument('--simulate', action='store_true', help="Serve a simulated supply over TCP.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument('--port', type=int, default=DEFAULT_TCP_PORT, help="TCP port (default: 5025).")
+    parser.add_argument('--load-ohms', type=float, default=160.0, help="Simulated load resistance.")
+    args = parser.parse_args()
+    if not args.simulate:
+        parser.print_help()
+        return
+    with SimulatorServer(args.host, args.port, PsuSimulator(args.load_ohms)) as server:
+        print(f"Simulated SCPI power supply listening on {args.host}:{args.port} (Ctrl+C to stop).")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
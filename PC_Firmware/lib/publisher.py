@@ -0,0 +1,292 @@
+"""
+Live result events of a test station on a ZeroMQ PUB socket.
+
+When started, every event is published as a two-frame message: the topic
+(e.g. b'qc.stage_result') and a JSON object with the station, the board's
+serial number, the PC time ('time', Unix seconds) and the fields below.
+Readings without a valid value are null.
+
+    qc.session_start   operator_name, master_id, psu_voltage     full sequence starts
+    qc.stage_result    stage, result ('PASS', 'FAIL', 'PRE_CHECK_FAILED')
+    qc.sweep_batch     stage, rows {column: [values]}            every batch_size codes of a sweep
+    qc.verdict         result ('PASS', 'FAIL', 'INTERRUPTED'), stages {stage: result}
+
+Events are put on a bounded queue and sent by a background thread, so the test
+loop never waits for the network or a slow subscriber. If the queue is full,
+the event is dropped and counted. A local subscriber prints the events with
+
+    python -m lib.publisher --listen [--endpoint tcp://127.0.0.1:5556]
+
+and '--check' publishes a test event on the endpoint and receives it with the
+same subscriber, to check the round trip on a station (while main.py is not running).
+
+Publishing is off until start() is called, or if the 'pyzmq' package is not
+installed. The functions below then return at once.
+"""
+import argparse
+import json
+import math
+import queue
+import sys
+import threading
+import time
+
+try:
+    import zmq
+except ImportError:  # Optional dependency, only needed for the live results
+    zmq = None
+
+DEFAULT_ENDPOINT = 'tcp://127.0.0.1:5556'
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 16
+TOPIC_PREFIX = 'qc.'
+
+_STOP = object()
+_publisher = None
+
+
+def _json_value(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {key: _json_value(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return value
+
+
+class ResultPublisher:
+    """
+    A PUB socket owned by a background thread, fed through a bounded queue.
+    ZeroMQ sockets must stay in the thread that uses them, so the socket is
+    created, used and closed by the sender thread only.
+    """
+
+    def __init__(self, endpoint, station, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.endpoint = endpoint
+        self.station = station
+        self.batch_size = batch_size
+        self.serial_number = None
+        self.dropped = 0
+        # Stage -> rows of its sweep already sent, see sweep_start()
+        self.sweep_sent = {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._bound = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='ResultPublisher', daemon=True)
+
+    def start(self, timeout_s=2.0):
+        """Starts the sender thread. Raises zmq.ZMQError if the endpoint cannot be bound."""
+        self._thread.start()
+        self._bound.wait(timeout_s)
+        if self._error is not None:
+            raise self._error
+
+    def publish(self, topic, **fields):
+        """Queues an event without blocking. Returns False if it was dropped."""
+        fields.update(station=self.station, serial_number=self.serial_number, time=time.time())
+        try:
+            self._queue.put_nowait((topic, fields))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self, timeout_s=2.0):
+        """Sends what is queued (for at most 'timeout_s') and closes the socket."""
+        try:
+            self._queue.put(_STOP, timeout=timeout_s)
+        except queue.Full:
+            pass
+        self._thread.join(timeout_s)
+
+    def _run(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.PUB)
+        socket.setsockopt(zmq.SNDHWM, self._queue.maxsize)
+        socket.setsockopt(zmq.LINGER, 500)
+        try:
+            socket.bind(self.endpoint)
+        except zmq.ZMQError as e:
+            self._error = e
+            socket.close()
+            self._bound.set()
+            return
+        self._bound.set()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                topic, fields = item
+                body = json.dumps(_json_value(fields)).encode()
+                try:
+                    # PUB drops messages for subscribers above their high-water mark, it never blocks
+                    socket.send_multipart((f"{TOPIC_PREFIX}{topic}".encode(), body), flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    self.dropped += 1
+        finally:
+            socket.close()
+
+
+def start(config, station):
+    """
+    Starts publishing as configured in the 'publisher' section of the config
+    ('enabled', 'endpoint', 'queue_size', 'batch_size'). Returns the endpoint, or
+    None if publishing is disabled, 'pyzmq' is missing or the endpoint is in use.
+    """
+    global _publisher
+    settings = config.get('publisher', {})
+    if not settings.get('enabled', False):
+        return None
+    if zmq is None:
+        print("Live result publishing is enabled, but the 'pyzmq' package is not installed.")
+        return None
+    endpoint = settings.get('endpoint', DEFAULT_ENDPOINT)
+    publisher = ResultPublisher(endpoint, station, settings.get('queue_size', DEFAULT_QUEUE_SIZE),
+                                settings.get('batch_size', DEFAULT_BATCH_SIZE))
+    try:
+        publisher.start()
+    except zmq.ZMQError as e:
+        print(f"Warning: Cannot publish results on {endpoint}: {e}")
+        return None
+    _publisher = publisher
+    return endpoint
+
+
+def stop():
+    """Sends the queued events and closes the socket."""
+    global _publisher
+    if _publisher is not None:
+        _publisher.stop()
+        if _publisher.dropped:
+            print(f"Warning: {_publisher.dropped} result events were dropped.")
+        _publisher = None
+
+
+def is_enabled():
+    return _publisher is not None
+
+
+def set_station(station):
+    """Labels the following events with 'station', e.g. once the device reported its Master ID."""
+    if _publisher is not None:
+        _publisher.station = station
+
+
+def session_start(session_details):
+    if _publisher is not None:
+        _publisher.serial_number = session_details.get('serial_number')
+        _publisher.publish('session_start', operator_name=session_details.get('operator_name'),
+                           master_id=session_details.get('master_id'),
+                           psu_voltage=session_details.get('psu_voltage'))
+
+
+def stage_result(name, result):
+    """Publishes a stage result: True/False for pass/fail or a string such as 'pre_check_failed'."""
+    if _publisher is not None:
+        label = result if isinstance(result, str) else ('pass' if result else 'fail')
+        _publisher.publish('stage_result', stage=name, result=label.upper())
+
+
+def sweep_start(stage, records):
+    """
+    Starts publishing the sweep of 'stage' into 'records' (a RecordBuffer). Rows already
+    in 'records' are restored from a checkpoint and not sent again: after a reconnect,
+    only those that were still waiting for their batch are sent. On a resume after a
+    restart, they are taken as sent before the interruption.
+    """
+    if _publisher is not None:
+        _publisher.sweep_sent[stage] = min(len(records), _publisher.sweep_sent.get(stage, len(records)))
+
+
+def sweep_progress(stage, records, flush=False):
+    """
+    Publishes the rows appended to 'records' since the last batch as one
+    'sweep_batch' event, once batch_size rows are waiting or with 'flush'.
+    Call sweep_start() first, this after every code and with flush=True when the sweep ends.
+    """
+    if _publisher is None:
+        return
+    sent = _publisher.sweep_sent.get(stage, 0)
+    if len(records) - sent >= (1 if flush else _publisher.batch_size):
+        _publisher.publish('sweep_batch', stage=stage, rows=records.to_columns(start=sent))
+        _publisher.sweep_sent[stage] = len(records)
+
+
+def verdict(result, test_results=()):
+    """Publishes the overall result of a board: 'pass', 'fail' or 'interrupted'."""
+    if _publisher is not None:
+        _publisher.publish('verdict', result=result.upper(),
+                           stages={name: 'PASS' if passed else 'FAIL' for name, passed in test_results})
+        _publisher.sweep_sent = {}
+
+
+def subscribe(endpoint, topic=TOPIC_PREFIX):
+    """Returns a SUB socket connected to 'endpoint' for the events whose topic starts with 'topic'."""
+    socket = zmq.Context.instance().socket(zmq.SUB)
+    socket.connect(endpoint)
+    socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+    return socket
+
+
+def check(endpoint, timeout_s=5.0):
+    """
+    Publishes test events on 'endpoint' and receives them with a local subscriber.
+    Returns the received (topic, event), or None if nothing arrived within 'timeout_s'.
+    """
+    publisher = ResultPublisher(endpoint, station='check')
+    publisher.start()
+    socket = subscribe(endpoint, f"{TOPIC_PREFIX}check")
+    try:
+        deadline = time.time() + timeout_s
+        # A new subscriber misses the events sent before its subscription arrives, so send until one is received
+        while time.time() < deadline:
+            publisher.publish('check', endpoint=endpoint)
+            if socket.poll(200):
+                topic, body = socket.recv_multipart()
+                return topic.decode(), json.loads(body)
+        return None
+    finally:
+        socket.close()
+        publisher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the live result events of a test station.")
+    parser.add_argument('--listen', action='store_true', help="Subscribe and print the events.")
+    parser.add_argument('--check', action='store_true', help="Publish a test event and receive it locally.")
+    parser.add_argument('--endpoint', default=DEFAULT_ENDPOINT, help=f"Publisher endpoint (default: {DEFAULT_ENDPOINT}).")
+    parser.add_argument('--topic', default=TOPIC_PREFIX, help="Topic prefix to subscribe to (default: all events).")
+    args = parser.parse_args()
+    if not (args.listen or args.check):
+        parser.print_help()
+        return
+    if zmq is None:
+        print("The 'pyzmq' package is not installed.")
+        return
+    if args.check:
+        try:
+            received = check(args.endpoint)
+        except zmq.ZMQError as e:
+            print(f"Cannot publish on {args.endpoint}: {e}")
+            sys.exit(1)
+        if received is None:
+            print(f"FAIL: No event received from {args.endpoint}.")
+            sys.exit(1)
+        print(f"OK: {received[0]} {json.dumps(received[1])}")
+        return
+    socket = subscribe(args.endpoint, args.topic)
+    print(f"Listening for result events on {args.endpoint} (Ctrl+C to stop).")
+    try:
+        while True:
+            topic, body = socket.recv_multipart()
+            print(f"{topic.decode()} {body.decode()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socket.close()
+
+
+if __name__ == '__main__':
+    main()
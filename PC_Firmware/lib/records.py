@@ -0,0 +1,97 @@
+from array import array
+from collections import namedtuple
+
+# One column of a record schema. 'typecode' is an array module typecode, and
+# 'to_python' optionally converts the stored number back to its public form
+# (e.g. 1 -> 'PASS') when rows are turned into dictionaries.
+Field = namedtuple('Field', 'name typecode to_python', defaults=(None,))
+
+NAN = float('nan')
+
+
+def pass_fail(value):
+    return 'PASS' if value else 'FAIL'
+
+
+class RecordBuffer:
+    """
+    Fixed-schema result storage with one array.array per column.
+
+    Sweeps append one row per code. Rows are not stored as dictionaries, so the
+    keys are not repeated and every number takes 1-8 bytes instead of a Python
+    object. Use to_dicts() where the old list-of-dicts form is needed and
+    to_columns() to serialise (the CSV logger and checkpoints do this directly).
+    """
+
+    def __init__(self, schema):
+        self.schema = tuple(Field(*field) for field in schema)
+        self.fields = tuple(field.name for field in self.schema)
+        self.columns = {field.name: array(field.typecode) for field in self.schema}
+        self._appenders = tuple(self.columns[name].append for name in self.fields)
+
+    def append(self, *values):
+        """Appends one row. Values must be given in schema order."""
+        for append, value in zip(self._appenders, values):
+            append(value)
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]])
+
+    def column(self, name):
+        return self.columns[name]
+
+    def extend(self, other):
+        """Appends all rows of another buffer with the same schema."""
+        for name in self.fields:
+            self.columns[name].extend(other.columns[name])
+
+    def count(self, name, value):
+        """Counts the rows where a column equals a value, e.g. count('result', 0) for failures."""
+        return self.columns[name].count(value)
+
+    def to_dicts(self):
+        """Converts the rows to the list-of-dicts form."""
+        converted = []
+        for field in self.schema:
+            values = self.columns[field.name].tolist()
+            converted.append([field.to_python(v) for v in values] if field.to_python else values)
+        return [dict(zip(self.fields, row)) for row in zip(*converted)]
+
+    def to_columns(self, start=0):
+        """
+        Returns {column name: list of values}, the compact form used for serialisation.
+        With 'start', only the rows from that index on are returned.
+        """
+        if start:
+            return {name: column[start:].tolist() for name, column in self.columns.items()}
+        return {name: column.tolist() for name, column in self.columns.items()}
+
+    @classmethod
+    def from_columns(cls, schema, columns):
+        """Rebuilds a buffer from to_columns() output, e.g. when resuming from a checkpoint."""
+        buffer = cls(schema)
+        for name in buffer.fields:
+            buffer.columns[name].extend(columns.get(name, []))
+        return buffer
+
+    @classmethod
+    def restore(cls, schema, saved):
+        """
+        Returns a buffer for checkpointed progress: the buffer itself if it is still
+        in memory, a rebuilt one if it was loaded from disk, or an empty one.
+        """
+        if isinstance(saved, cls):
+            return saved
+        if saved:
+            return cls.from_columns(schema, saved)
+        return cls(schema)
+
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self.columns.values())
+
+
+def json_default(obj):
+    """'default' hook for json.dump so buffers are written in their columnar form."""
+    if isinstance(obj, RecordBuffer):
+        return obj.to_columns()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,366 @@
+"""
+Re-judges logged results against a candidate config, without re-testing boards.
+
+Before changing the tolerances in 'settings', the 'current_test_settings' or the
+'initial_check_ranges'/'initial_check_stability' of config.json, this shows which
+of the boards tested so far would change verdict. The measurements of the voltage
+sweep, the current test and the initial checks are read from the test logs or an
+export archive (lib/export.py) into numpy columns, and the decision rules of
+voltage_test.run_test_cycle, current_test.run and initial_checks.run are applied
+to all of them at once:
+
+    Voltage Channels   every code within its SPI/I2C tolerance (voltage_test.voltage_tolerances)
+    Current Channels   voltages within 'voltage_tolerance_v', current set, both currents in range
+    Initial Checks     no read errors, the window min/max within the ranges and, with
+                       enough samples, std/ripple/slope within the stability limits
+
+Codes whose current was not measured because their voltage failed stay failed when
+a looser voltage tolerance would now pass them, as there is no current to judge.
+Results without logged measurements (e.g. a failed pre-check) are not re-judged.
+
+Usage (from the PC_Firmware directory):
+    python -m lib.rejudge candidate.json [logs or archives ...] [--baseline config.json] [--changes changes.csv]
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import time
+
+try:
+    import h5py
+except ImportError:  # Optional dependency, only needed to read export archives
+    h5py = None
+import numpy as np
+
+from lib import utils
+from lib.csv_logger import LOG_COLUMNS, LOG_DIR, parse_test_data
+from lib.export import _as_columns, find_log_files
+from test_functions import initial_checks, voltage_test
+
+# Logged test name -> measurement columns its verdict depends on
+SERIES_COLUMNS = {
+    "Voltage Channels": ('expected_v', 'spi_v_a', 'spi_v_b', 'i2c_v_a', 'i2c_v_b'),
+    "Current Channels": ('expected_v', 'v_spi_a', 'v_spi_b', 'v_i2c_a', 'v_i2c_b', 'current_set_ack',
+                         'meas_i_a', 'meas_i_b'),
+}
+INITIAL_CHECKS = "Initial Checks"
+TESTS = tuple(SERIES_COLUMNS) + (INITIAL_CHECKS,)
+
+# Verdict codes
+FAIL, PASS, NOT_JUDGED = 0, 1, -1
+
+# Default relative tolerance of math.isclose
+_REL_TOL = 1e-9
+
+# Logged test data can be large, see lib/export.py
+csv.field_size_limit(2 ** 31 - 1)
+
+
+class History:
+    """
+    The logged results of the re-judged tests. 'results' holds one tuple per result,
+    (source, serial_number, master_id, timestamp, test_name, recorded result), and
+    'series' the measurement columns per test with a 'result_index' into 'results'.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.initial_checks = {}  # Result index -> logged data of an initial check
+        self._columns = {test: {name: [] for name in columns + ('result_index',)}
+                         for test, columns in SERIES_COLUMNS.items()}
+        self._series = None
+
+    def _add_result(self, source, serial_number, master_id, timestamp, test_name, result, data):
+        index = len(self.results)
+        self.results.append((source, serial_number, master_id, timestamp, test_name, result))
+        if test_name == INITIAL_CHECKS and isinstance(data, dict) and isinstance(data.get('stats'), dict):
+            self.initial_checks[index] = data
+        return index
+
+    def _add_series(self, test_name, columns, result_index):
+        """Adds the columns of one series, or of many with 'result_index' as an array."""
+        target = self._columns[test_name]
+        length = len(next(iter(columns.values())))
+        for name in SERIES_COLUMNS[test_name]:
+            values = columns.get(name)
+            target[name].append(np.full(length, np.nan) if values is None else np.asarray(values, dtype=float))
+        target['result_index'].append(np.broadcast_to(np.asarray(result_index, dtype=np.int64), (length,)))
+        self._series = None
+
+    def add_log_file(self, path):
+        """Adds the results of the re-judged tests in a CSV test log. Returns the number added."""
+        added = 0
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != LOG_COLUMNS:
+                print(f"Skipping '{path}': not a test log.")
+                return 0
+            for row in reader:
+                test_name = row['Test_Name']
+                if test_name not in TESTS:
+                    continue
+                data = parse_test_data(row['Test_Specific_Data'])
+                index = self._add_result(path, row['Serial_Number'], row['Master_ID'], row['Timestamp'],
+                                         test_name, row['Overall_Result'], data)
+                columns = _as_columns(data.get('records')) if isinstance(data, dict) else None
+                if test_name in SERIES_COLUMNS and columns is not None:
+                    self._add_series(test_name, columns, index)
+                added += 1
+        return added
+
+    def add_archive(self, path):
+        """Adds the results of the re-judged tests in an export archive. Returns the number added."""
+        if h5py is None:
+            raise RuntimeError("Reading export archives needs the 'h5py' package.")
+        with h5py.File(path, 'r') as archive:
+            sessions = archive['sessions'][:]
+            results = archive['results'][:]
+            # Archive result index -> index in this history, -1 for tests that are not re-judged
+            index_map = np.full(len(results), -1, dtype=np.int64)
+            for archive_index, row in enumerate(results):
+                test_name = row['test_name'].decode()
+                if test_name not in TESTS:
+                    continue
+                session = sessions[row['session_index']]
+                data = json.loads(row['data']) if test_name == INITIAL_CHECKS else None
+                index_map[archive_index] = self._add_result(
+                    f"{path}:{session['log_file'].decode()}", session['serial_number'].decode(),
+                    session['master_id'].decode(), row['timestamp'].decode(), test_name, row['result'].decode(), data)
+            for test_name in SERIES_COLUMNS:
+                group = archive.get(f"measurements/{test_name}/records")
+                if group is None:
+                    continue
+                columns = {name: group[name][:] for name in SERIES_COLUMNS[test_name] if name in group}
+                rows = index_map[group['result_index'][:]]
+                columns = {name: values[rows >= 0] for name, values in columns.items()}
+                if columns and len(next(iter(columns.values()))):
+                    self._add_series(test_name, columns, rows[rows >= 0])
+        return int(np.count_nonzero(index_map >= 0))
+
+    @property
+    def series(self):
+        """Test name -> {column: numpy array}, all series of the test concatenated."""
+        if self._series is None:
+            self._series = {test: {name: np.concatenate(parts) if parts else np.empty(0)
+                                   for name, parts in columns.items()}
+                            for test, columns in self._columns.items()}
+        return self._series
+
+
+def load_history(paths):
+    """Reads CSV test logs, directories of them and export archives (*.h5) into a History."""
+    history = History()
+    for path in paths:
+        if path.endswith(('.h5', '.hdf5')):
+            history.add_archive(path)
+        else:
+            for log_file in find_log_files([path]):
+                history.add_log_file(log_file)
+    return history
+
+
+# --- The decision rules of the tests on columns ---
+
+def isclose(a, b, abs_tol):
+    """Element-wise math.isclose(a, b, abs_tol=abs_tol) with its default rel_tol, NaN is never close."""
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    with np.errstate(invalid='ignore'):
+        diff = np.abs(b - a)
+        close = (diff <= np.abs(_REL_TOL * b)) | (diff <= np.abs(_REL_TOL * a)) | (diff <= abs_tol)
+    return (a == b) | (close & np.isfinite(a) & np.isfinite(b))
+
+
+def in_range(values, low, high):
+    """low <= values <= high element-wise, False for NaN."""
+    return (low <= values) & (values <= high)
+
+
+def voltage_sweep_failures(series, settings):
+    """Per code: True if it fails the voltage sweep with the given 'settings' section."""
+    expected = series['expected_v']
+    zero = isclose(expected, 0.0, 0.0)
+    high = expected > voltage_test.HIGH_VOLTAGE_V
+    spi_tol = np.where(zero, settings['zero_threshold_v'],
+                       np.where(high, settings['high_voltage_tolerance_v'], settings['voltage_test_tolerance_v']))
+    i2c_tol = np.where(zero, settings['zero_threshold_v'],
+                       np.where(high, settings['i2c_high_voltage_tolerance_v'], settings['i2c_voltage_tolerance_v']))
+    passed = (isclose(series['spi_v_a'], expected, spi_tol) & isclose(series['spi_v_b'], expected, spi_tol) &
+              isclose(series['i2c_v_a'], expected, i2c_tol) & isclose(series['i2c_v_b'], expected, i2c_tol))
+    return ~passed
+
+
+def current_test_failures(series, settings):
+    """Per code: True if it fails the current test with the given 'current_test_settings'."""
+    expected = series['expected_v']
+    tol = settings['voltage_tolerance_v']
+    voltages_ok = (isclose(series['v_spi_a'], expected, tol) & isclose(series['v_spi_b'], expected, tol) &
+                   isclose(series['v_i2c_a'], expected, tol) & isclose(series['v_i2c_b'], expected, tol))
+    low, high = settings['current_min_a'], settings['current_max_a']
+    passed = (voltages_ok & (series['current_set_ack'] == 1) &
+              in_range(series['meas_i_a'], low, high) & in_range(series['meas_i_b'], low, high))
+    return ~passed
+
+
+def initial_check_failures(logged, ranges, stability):
+    """
+    Per logged initial check (its data with 'stats' per channel): True if it fails
+    with the given 'initial_check_ranges' and 'initial_check_stability'.
+    The per-sample range check fails exactly when the window minimum or maximum is
+    out of range, so it is judged from the logged statistics.
+    """
+    def column(channel, key):
+        return np.array([_number(data['stats'].get(channel, {}).get(key)) for data in logged])
+
+    failed = np.array([_number(data.get('read_errors', 0)) > 0 for data in logged], dtype=bool)
+    n = column(initial_checks.CHANNELS[0], 'n')
+    judge_stability = n >= stability.get('min_samples', 3)
+    for channel in initial_checks.CHANNELS:
+        sampled = column(channel, 'n') > 0
+        failed |= sampled & ~(in_range(column(channel, 'min'), ranges[f'{channel}_min'], ranges[f'{channel}_max']) &
+                              in_range(column(channel, 'max'), ranges[f'{channel}_min'], ranges[f'{channel}_max']))
+        limits = stability.get(channel, {})
+        for limit, key, transform in (('max_std', 'std', None), ('max_ripple', 'ripple', None),
+                                      ('max_slope_per_s', 'slope_per_s', np.abs)):
+            if limit in limits:
+                values = column(channel, key)
+                failed |= judge_stability & ((transform(values) if transform else values) > limits[limit])
+    return failed
+
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+def judge(history, config):
+    """Returns the verdict of every result in the history under 'config': PASS, FAIL or NOT_JUDGED."""
+    count = len(history.results)
+    verdicts = np.full(count, NOT_JUDGED, dtype=np.int8)
+    rules = {
+        "Voltage Channels": lambda series: voltage_sweep_failures(series, config['settings']),
+        "Current Channels": lambda series: current_test_failures(series, config['current_test_settings']),
+    }
+    for test_name, failures in rules.items():
+        series = history.series[test_name]
+        rows = series['result_index']
+        if not len(rows):
+            continue
+        judged = np.bincount(rows, minlength=count) > 0
+        failed = np.bincount(rows, weights=failures(series), minlength=count) > 0
+        verdicts[judged] = np.where(failed[judged], FAIL, PASS)
+
+    if history.initial_checks:
+        indices = np.fromiter(history.initial_checks, dtype=np.int64, count=len(history.initial_checks))
+        failed = initial_check_failures(list(history.initial_checks.values()), config['initial_check_ranges'],
+                                        config.get('initial_check_stability', {}))
+        verdicts[indices] = np.where(failed, FAIL, PASS)
+    return verdicts
+
+
+def recorded_verdicts(history):
+    codes = {'PASS': PASS, 'FAIL': FAIL}
+    return np.array([codes.get(result[5], NOT_JUDGED) for result in history.results], dtype=np.int8)
+
+
+def board_verdicts(history, verdicts):
+    """Serial number -> True if the latest judged result of every test passed."""
+    latest = {}
+    for index in np.flatnonzero(verdicts != NOT_JUDGED):
+        _, serial_number, _, timestamp, test_name, _ = history.results[index]
+        key = (serial_number, test_name)
+        if key not in latest or timestamp >= latest[key][0]:
+            latest[key] = (timestamp, verdicts[index] == PASS)
+    boards = {}
+    for (serial_number, _), (_, passed) in latest.items():
+        boards[serial_number] = boards.get(serial_number, True) and passed
+    return boards
+
+
+def _name(verdict):
+    return {PASS: 'PASS', FAIL: 'FAIL'}.get(verdict, '-')
+
+
+def report(history, before, after, show=20):
+    """Prints the changed verdicts per test and per board. Returns the indices of the changed results."""
+    both = (before != NOT_JUDGED) & (after != NOT_JUDGED)
+    changed = np.flatnonzero(both & (before != after))
+    tests = np.array([result[4] for result in history.results], dtype=object)
+
+    print(f"\n{'Test':<20}{'Judged':>8}{'PASS->FAIL':>12}{'FAIL->PASS':>12}")
+    for test_name in TESTS:
+        of_test = both & (tests == test_name)
+        print(f"{test_name:<20}{np.count_nonzero(of_test):>8}"
+              f"{np.count_nonzero(of_test & (before == PASS) & (after == FAIL)):>12}"
+              f"{np.count_nonzero(of_test & (before == FAIL) & (after == PASS)):>12}")
+
+    boards_before = board_verdicts(history, np.where(both, before, NOT_JUDGED))
+    boards_after = board_verdicts(history, np.where(both, after, NOT_JUDGED))
+    flipped = sorted(serial for serial, passed in boards_after.items() if boards_before.get(serial) != passed)
+    to_fail = sum(1 for serial in flipped if not boards_after[serial])
+    print(f"\nBoards judged: {len(boards_after)}, changing verdict: {len(flipped)} "
+          f"(PASS->FAIL {to_fail}, FAIL->PASS {len(flipped) - to_fail})")
+    for serial in flipped[:show]:
+        print(f"  S/N {serial}: {'PASS -> FAIL' if not boards_after[serial] else 'FAIL -> PASS'}")
+    if len(flipped) > show:
+        print(f"  ... and {len(flipped) - show} more (see --changes)")
+    return changed
+
+
+def write_changes(path, history, before, after, changed):
+    """Writes one CSV row per result whose verdict changed."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Serial_Number', 'Master_ID', 'Timestamp', 'Test_Name', 'Before', 'After', 'Source'])
+        for index in changed:
+            source, serial_number, master_id, timestamp, test_name, _ = history.results[index]
+            writer.writerow([serial_number, master_id, timestamp, test_name, _name(before[index]),
+                             _name(after[index]), source])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-judges logged test results against a candidate config.")
+    parser.add_argument('candidate', help="Config file with the candidate tolerances and ranges.")
+    parser.add_argument('paths', nargs='*', default=[LOG_DIR],
+                        help="Log files, log directories or export archives (*.h5, default: logs).")
+    parser.add_argument('--baseline', metavar='CONFIG',
+                        help="Compare with the verdicts under this config instead of the logged verdicts.")
+    parser.add_argument('--changes', metavar='CSV', help="Write every changed result to this CSV file.")
+    parser.add_argument('--show', type=int, default=20, help="Boards with a changed verdict to list (default: 20).")
+    args = parser.parse_args()
+
+    candidate = utils.load_config(args.candidate)
+    baseline = utils.load_config(args.baseline) if args.baseline else None
+    if candidate is None or (args.baseline and baseline is None):
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        history = load_history(args.paths)
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    loaded = time.perf_counter()
+    try:
+        before = judge(history, baseline) if baseline else recorded_verdicts(history)
+        after = judge(history, candidate)
+    except KeyError as e:
+        print(f"Error: Missing key in a config file: {e}")
+        sys.exit(1)
+    judged = time.perf_counter()
+
+    series_rows = sum(len(series['result_index']) for series in history.series.values())
+    print(f"Loaded {len(history.results)} result(s) with {series_rows} measured codes in {loaded - start:.2f}s, "
+          f"re-judged in {judged - loaded:.3f}s. {np.count_nonzero(after == NOT_JUDGED)} result(s) have no "
+          f"logged measurements to judge.")
+    print(f"Comparing '{os.path.basename(args.candidate)}' with "
+          f"{repr(os.path.basename(args.baseline)) if args.baseline else 'the logged verdicts'}.")
+    changed = report(history, before, after, args.show)
+    if args.changes:
+        write_changes(args.changes, history, before, after, changed)
+        print(f"{len(changed)} changed result(s) written to '{args.changes}'.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import math
+
+
+class RunningStats:
+    """
+    Incremental statistics over a stream of (time, value) samples, updated in O(1)
+    per sample without storing the samples.
+
+    - mean and variance with Welford's algorithm
+    - slope (least-squares drift per second) from the running co-moment of time and value
+    - ripple as peak-to-peak (max - min)
+    """
+
+    __slots__ = ('n', 'mean', '_m2', 'min', 'max', '_t_mean', '_t_m2', '_c_tx')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._t_mean = 0.0
+        self._t_m2 = 0.0
+        self._c_tx = 0.0
+
+    def add(self, value, t=None):
+        """Adds a sample. Without a time, the sample index is used as time axis."""
+        if t is None:
+            t = float(self.n)
+        self.n += 1
+        dx = value - self.mean
+        dt = t - self._t_mean
+        self.mean += dx / self.n
+        self._t_mean += dt / self.n
+        self._m2 += dx * (value - self.mean)
+        self._t_m2 += dt * (t - self._t_mean)
+        self._c_tx += dt * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def variance(self):
+        """Sample variance (n - 1), 0.0 for fewer than two samples."""
+        return self._m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @property
+    def slope(self):
+        """Least-squares slope of value over time, 0.0 if time did not advance."""
+        return self._c_tx / self._t_m2 if self._t_m2 > 0 else 0.0
+
+    @property
+    def ripple(self):
+        return self.max - self.min if self.n else 0.0
+
+    def as_dict(self):
+        return {
+            'n': self.n,
+            'mean': self.mean,
+            'std': self.std,
+            'min': self.min if self.n else None,
+            'max': self.max if self.n else None,
+            'ripple': self.ripple,
+            'slope_per_s': self.slope
+        }
+
+
+def check_stability(stats, limits):
+    """
+    Compares running statistics against 'max_std', 'max_ripple' and 'max_slope_per_s'
+    limits (each optional). Returns a list of the violated limit names.
+    """
+    violations = []
+    if 'max_std' in limits and stats.std > limits['max_std']:
+        violations.append('std')
+    if 'max_ripple' in limits and stats.ripple > limits['max_ripple']:
+        violations.append('ripple')
+    if 'max_slope_per_s' in limits and abs(stats.slope) > limits['max_slope_per_s']:
+        violations.append('slope')
+    return violations
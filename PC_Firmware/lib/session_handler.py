@@ -1,6 +1,18 @@
 import re
 
 
+def validate_serial_number(serial_number, config):
+    """Checks a serial number against the validation rules, printing the reason if it is invalid."""
+    validation_rules = config['tester_info']['validation_rules']
+    if len(serial_number) != validation_rules.get('serial_number_length', 0):
+        print(f"Error: Serial number must be {validation_rules['serial_number_length']} characters.")
+        return False
+    if validation_rules.get('serial_number_numeric_only', False) and not serial_number.isdigit():
+        print("Error: Serial number must contain only numbers.")
+        return False
+    return True
+
+
 def get_and_confirm_details(config):
     """
     Prompts the user for session details (operator name, serial number, power supply voltage)
@@ -15,14 +27,7 @@ def get_and_confirm_details(config):
 
     # Get serial number
     serial_number = input("Device Serial Number: ")
-    validation_rules = config['tester_info']['validation_rules']
-
-    # Validate serial number
-    if len(serial_number) != validation_rules.get('serial_number_length', 0):
-        print(f"Error: Serial number must be {validation_rules['serial_number_length']} characters.")
-        return None
-    if validation_rules.get('serial_number_numeric_only', False) and not serial_number.isdigit():
-        print("Error: Serial number must contain only numbers.")
+    if not validate_serial_number(serial_number, config):
         return None
 
     # Get lab power supply voltage
@@ -51,3 +56,17 @@ def get_and_confirm_details(config):
         }
     else:
         return None
+
+
+def get_next_board_details(config, session_details):
+    """
+    Prompts only for the serial number of the next board on the same rig.
+    Operator and power supply voltage are kept. Returns the new session details,
+    or None if the input was empty or invalid.
+    """
+    serial_number = input("Next Device Serial Number (Enter to cancel): ")
+    if not serial_number or not validate_serial_number(serial_number, config):
+        return None
+    if serial_number == session_details.get('serial_number'):
+        print(f"Warning: S/N {serial_number} is the board that was just tested.")
+    return dict(session_details, serial_number=serial_number)
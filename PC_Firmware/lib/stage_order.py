@@ -0,0 +1,253 @@
+"""
+History-driven order of the stages of the full test sequence.
+
+The sequence stops at the first critical stage that fails, so a bad board leaves
+the fixture sooner when the stages that fail often and run quickly come first.
+From the CSV test logs, every stage's failure probability p (the share of its
+runs that failed, with one pseudo-failure and one pseudo-pass so rare stages are
+not taken as certain) and its median duration t are estimated. The expected
+time until the sequence stops is then
+
+    E = t_1 + (1 - p_1) t_2 + (1 - p_1)(1 - p_2) t_3 + ...
+
+Without constraints, E is smallest with the stages in decreasing p/t (Smith's
+rule). With the constraints below, all orders that keep them are compared, which
+is cheap for the handful of stages of the sequence:
+
+    - the initial checks run first (they are not part of the reordered stages)
+    - 'Burnout Test' runs before 'CAN Communication (Post-Burnout)'
+    - 'CAN Communication (Short)' runs before 'Burnout Test'. Both CAN runs are
+      logged as 'CAN Communication' and told apart by whether the burnout was
+      logged before. The short run takes seconds and the burnout hours, so the
+      best order keeps this anyway.
+    - stages that need the operator (the DIL switch prompts of 'Voltage Channels')
+      run before 'Burnout Test', so the operator is not called back mid-run
+
+A stage's duration is the time from the previous logged result of the same board
+to its own result, so it includes the pre-check. Only results within a run of the
+sequence are timed: a stage logged again in the same run, other than directly
+after itself, was run on its own from the menu. A result logged directly before
+another result of the same stage is an attempt that was retried after a reconnect.
+It is not counted, and the retried stage is timed from the start of its first attempt.
+The default order is kept while a stage has fewer than 'min_runs' logged runs.
+
+Usage (from the PC_Firmware directory), to show the estimates and the order:
+    python -m lib.stage_order [logs ...]
+"""
+import argparse
+import csv
+import itertools
+import os
+import statistics
+import time
+from collections import namedtuple
+
+from lib import utils
+from lib.csv_logger import LOG_COLUMNS, LOG_DIR
+from lib.export import find_log_files
+
+BURNOUT = "Burnout Test"
+CAN_SHORT = "CAN Communication (Short)"
+CAN_POST_BURNOUT = "CAN Communication (Post-Burnout)"
+# Stages that prompt the operator, kept before the hours-long burnout
+OPERATOR_STAGES = ("Voltage Channels",)
+# (earlier, later) stage pairs that must keep their order
+PRECEDENCE = ((BURNOUT, CAN_POST_BURNOUT), (CAN_SHORT, BURNOUT)) + tuple((name, BURNOUT) for name in OPERATOR_STAGES)
+# Stages whose failure is reported but does not stop the sequence
+NON_CRITICAL = frozenset({"Temperature Communication"})
+# Logged results that start a new run of the sequence for a board
+SEQUENCE_START = frozenset({"PSU Power-Up", "Initial Checks"})
+# Logged results of the sequence that are not part of the reordered stages
+FIXED_STAGES = SEQUENCE_START | {"PSU Cross-Check"}
+
+# The order of the full sequence without a history
+DEFAULT_ORDER = ("Voltage Channels", "Current Channels", "Temperature Communication", CAN_SHORT, BURNOUT,
+                 CAN_POST_BURNOUT)
+DEFAULT_MIN_RUNS = 20
+
+StageStats = namedtuple('StageStats', 'runs failures duration_s')
+
+# Log file -> (size, mtime, {stage: (runs, failures, [durations])}), so logs are only read again when they change
+_file_cache = {}
+
+# Logged test data can be large, see lib/export.py
+csv.field_size_limit(2 ** 31 - 1)
+
+
+def _parse_time(timestamp):
+    try:
+        return time.mktime(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _count(counts, result):
+    """Adds a (name, failed, duration, start time) result to the per-stage counts."""
+    name, failed, duration, _ = result
+    entry = counts.setdefault(name, [0, 0, []])
+    entry[0] += 1
+    if failed:
+        entry[1] += 1
+    if duration is not None:
+        entry[2].append(duration)
+
+
+def _read_log_file(path):
+    """Counts the runs and failures and collects the durations of every stage in one CSV test log."""
+    counts = {}
+    # Serial number -> state of the board's current run of the sequence
+    boards = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != LOG_COLUMNS:
+            return counts
+        for row in reader:
+            name = row['Test_Name']
+            t = _parse_time(row['Timestamp'])
+            board = boards.setdefault(row['Serial_Number'], {
+                'previous_t': None, 'burnout_seen': False, 'in_sequence': False, 'stages': set(), 'pending': None})
+            pending = board['pending']
+            if name in SEQUENCE_START:
+                board.update(burnout_seen=False, in_sequence=True, stages=set())
+            elif name == "CAN Communication":
+                name = CAN_POST_BURNOUT if board['burnout_seen'] else CAN_SHORT
+            elif name == BURNOUT:
+                board['burnout_seen'] = True
+
+            # The pending result was retried, so it is dropped and the stage keeps its start time
+            if pending is not None and pending[0] == name and board['in_sequence']:
+                previous_t = pending[3]
+            else:
+                if pending is not None:
+                    _count(counts, pending)
+                if name in board['stages']:
+                    board['in_sequence'] = False
+                previous_t = board['previous_t']
+            board['pending'] = None
+            board['previous_t'] = t
+
+            # A failed pre-check is logged under the stage, but the stage did not run
+            if name in FIXED_STAGES or '"pre_check_failed"' in row['Test_Specific_Data']:
+                continue
+            duration = None
+            if board['in_sequence'] and t is not None and previous_t is not None and t >= previous_t:
+                duration = t - previous_t
+            board['stages'].add(name)
+            board['pending'] = (name, row['Overall_Result'] == 'FAIL', duration, previous_t)
+    for board in boards.values():
+        if board['pending'] is not None:
+            _count(counts, board['pending'])
+    return counts
+
+
+def load_stage_stats(paths=(LOG_DIR,)):
+    """Reads CSV test logs and directories of them into {stage: StageStats}."""
+    totals = {}
+    for path in find_log_files(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        cached = _file_cache.get(path)
+        if cached is None or cached[:2] != (stat.st_size, stat.st_mtime):
+            cached = (stat.st_size, stat.st_mtime, _read_log_file(path))
+            _file_cache[path] = cached
+        for name, (runs, failures, durations) in cached[2].items():
+            total = totals.setdefault(name, [0, 0, []])
+            total[0] += runs
+            total[1] += failures
+            total[2].extend(durations)
+    return {name: StageStats(runs, failures, statistics.median(durations) if durations else None)
+            for name, (runs, failures, durations) in totals.items()}
+
+
+def failure_probability(name, stats):
+    """The estimated probability that the stage stops the sequence, given it is reached."""
+    if name in NON_CRITICAL:
+        return 0.0
+    return (stats.failures + 1) / (stats.runs + 2)
+
+
+def expected_time(order, estimates):
+    """The expected time in seconds until a sequence with the stages in 'order' stops."""
+    total, reached = 0.0, 1.0
+    for name in order:
+        p, t = estimates[name]
+        total += reached * t
+        reached *= 1.0 - p
+    return total
+
+
+def _allowed(order):
+    position = {name: index for index, name in enumerate(order)}
+    return all(position[earlier] < position[later] for earlier, later in PRECEDENCE
+               if earlier in position and later in position)
+
+
+def best_order(names, stats, min_runs=DEFAULT_MIN_RUNS):
+    """
+    Returns the order of the stage 'names' with the smallest expected time until the
+    sequence stops, and the (p, t) estimates per stage. The given order is kept
+    (estimates None) while a stage has fewer than 'min_runs' logged runs with durations.
+    """
+    names = list(names)
+    if any(name not in stats or stats[name].runs < min_runs or not stats[name].duration_s for name in names):
+        return names, None
+    estimates = {name: (failure_probability(name, stats[name]), stats[name].duration_s) for name in names}
+    # Candidates in Smith's order, so ties keep the rule's order
+    smith = sorted(names, key=lambda name: -estimates[name][0] / estimates[name][1])
+    best = min((order for order in itertools.permutations(smith) if _allowed(order)),
+               key=lambda order: expected_time(order, estimates))
+    return list(best), estimates
+
+
+def order_stages(test_suite, config):
+    """
+    Reorders the (name, function, kwargs) stages of the full sequence as configured in
+    the 'stage_order' section of the config ('enabled', 'log_dir', 'min_runs').
+    Returns the suite unchanged when ordering is disabled or the history is too short.
+    """
+    settings = config.get('stage_order', {})
+    if not settings.get('enabled', False):
+        return test_suite
+    stats = load_stage_stats([settings.get('log_dir', LOG_DIR)])
+    order, estimates = best_order([name for name, _, _ in test_suite], stats,
+                                  settings.get('min_runs', DEFAULT_MIN_RUNS))
+    if estimates is None:
+        print("Stage order: not enough logged runs yet, keeping the default order.")
+        return test_suite
+    by_name = {stage[0]: stage for stage in test_suite}
+    print(f"Stage order by failure history (expected {expected_time(order, estimates) / 60:.1f} min "
+          f"to the first failure, default {expected_time(list(by_name), estimates) / 60:.1f} min):")
+    print("  " + " -> ".join(order))
+    return [by_name[name] for name in order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimates stage failure rates and durations from the test logs.")
+    parser.add_argument('paths', nargs='*', help="Log files or directories (default: the configured log_dir).")
+    parser.add_argument('--min-runs', type=int, help="Logged runs needed per stage (default: from config.json).")
+    args = parser.parse_args()
+    settings = (utils.load_config() or {}).get('stage_order', {})
+    min_runs = args.min_runs if args.min_runs is not None else settings.get('min_runs', DEFAULT_MIN_RUNS)
+    stats = load_stage_stats(args.paths or [settings.get('log_dir', LOG_DIR)])
+    if not stats:
+        print("No logged stage results found.")
+        return
+
+    print(f"{'Stage':<34} {'Runs':>6} {'Failed':>7} {'p(fail)':>8} {'Median':>9}")
+    for name, stage in sorted(stats.items()):
+        duration = f"{stage.duration_s:.0f} s" if stage.duration_s is not None else '-'
+        print(f"{name:<34} {stage.runs:>6} {stage.failures:>7} {failure_probability(name, stage):>8.3f} {duration:>9}")
+
+    order, estimates = best_order(DEFAULT_ORDER, stats, min_runs)
+    if estimates is None:
+        print(f"\nFewer than {min_runs} logged runs for some stages, the default order is kept.")
+        return
+    print(f"\nOrder: {' -> '.join(order)}")
+    print(f"Expected time to the first failure: {expected_time(order, estimates) / 60:.1f} min "
+          f"(default order: {expected_time(DEFAULT_ORDER, estimates) / 60:.1f} min)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Timeline of a test session in the Chrome trace-event format.
+
+Test code wraps its work in nested spans: session -> stage -> code iteration ->
+serial command, with sleeps, settle waits and operator prompts as spans of their
+own. The JSON file written by stop() opens in chrome://tracing or
+https://ui.perfetto.dev and shows where the time of a board went, e.g. waits
+that run one after another or idle gaps between commands.
+
+Recording is off until start() is called. span() then returns a shared no-op
+context manager, so instrumented code costs a global lookup and a call.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+TIMELINE_DIR = os.path.join('logs', 'timelines')
+
+_NO_SPAN = contextlib.nullcontext()
+_timeline = None
+
+
+class Timeline:
+    """Collects complete ('X') trace events, timed with time.perf_counter in microseconds."""
+
+    def __init__(self, path, metadata=None):
+        self.path = path
+        self.metadata = dict(metadata or {}, created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        self.events = []
+        self._threads = {}
+        self._start = time.perf_counter()
+
+    def now_us(self):
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _thread_id(self):
+        # Small, stable thread ids with their names as metadata events
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            tid = self._threads[ident] = len(self._threads) + 1
+            self.events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid,
+                                'args': {'name': threading.current_thread().name}})
+        return tid
+
+    def add(self, name, category, start_us, end_us, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round(start_us, 1),
+                 'dur': round(end_us - start_us, 1), 'pid': 1, 'tid': self._thread_id()}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        process = {'ph': 'M', 'name': 'process_name', 'pid': 1, 'args': {'name': 'QC test station'}}
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': [process] + self.events, 'displayTimeUnit': 'ms',
+                       'otherData': self.metadata}, f)
+
+
+class _Span:
+    __slots__ = ('timeline', 'name', 'category', 'args', 'start_us')
+
+    def __init__(self, timeline, name, category, args):
+        self.timeline = timeline
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start_us = self.timeline.now_us()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args = dict(self.args, error=exc_type.__name__)
+        self.timeline.add(self.name, self.category, self.start_us, self.timeline.now_us(), self.args)
+        return False
+
+
+def start(path, metadata=None):
+    """Starts recording spans. They are written to 'path' by stop()."""
+    global _timeline
+    _timeline = Timeline(path, metadata)
+    return _timeline
+
+
+def stop():
+    """Writes the recorded timeline and stops recording. Returns its path, or None if not recording."""
+    global _timeline
+    timeline, _timeline = _timeline, None
+    if timeline is None:
+        return None
+    timeline.write()
+    return timeline.path
+
+
+def is_enabled():
+    return _timeline is not None
+
+
+def span(name, category='stage', **args):
+    """
+    Context manager timing the enclosed block as a span, e.g.
+    'with timeline.span("Voltage Channels"):'. Categories used: session, stage,
+    iteration, serial and wait. Keyword arguments are shown with the span.
+    """
+    if _timeline is None:
+        return _NO_SPAN
+    return _Span(_timeline, name, category, args)
+
+
+def sleep(seconds, name='sleep'):
+    """time.sleep that shows up on the timeline as a wait span."""
+    if _timeline is None:
+        time.sleep(seconds)
+        return
+    with _Span(_timeline, name, 'wait', {'seconds': seconds}):
+        time.sleep(seconds)
+
+
+def default_timeline_path(serial_number=None):
+    name = f"timeline_{serial_number or 'session'}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    return os.path.join(TIMELINE_DIR, name)
@@ -0,0 +1,317 @@
+"""
+Recording and replay of serial sessions.
+
+TracingSerial sits between SupervisedSerial and the serial port and appends
+every command, every reply read and every port error with its time to a trace
+file. ReplaySerial plays a trace back in place of the port, so a failed session
+can be run through run_full_sequence again without a rig, e.g. to debug it or
+to profile the PC side.
+
+Trace file layout:
+    offset 0   8s   magic b'CICTRC01'
+    offset 8   u32  length of the JSON metadata (port, baud rate, session details, created)
+    offset 12       JSON metadata
+    then one event after another: 1s kind, u64 time in us since the start, u32 length, payload
+
+Event kinds: 'W' bytes written, 'R' bytes returned by read/readline/read_all,
+'N' in_waiting (the value is stored in the length field, no payload) and
+'E' an exception of the port (payload: its message). Busy polling of in_waiting
+(e.g. while a CAN test runs) is recorded only when the value changes or another
+event came in between. Replaying the first poll of a value at its time is
+equivalent to the repeated polls that returned it.
+"""
+import builtins
+import contextlib
+import json
+import os
+import struct
+import time
+
+import serial
+
+TRACE_DIR = os.path.join('logs', 'traces')
+
+MAGIC = b'CICTRC01'
+_LENGTH = struct.Struct('<I')
+_EVENT = struct.Struct('<cQI')
+
+
+class ReplayExhausted(Exception):
+    """Raised when the replayed session sends a command beyond the end of the trace."""
+
+
+class TraceWriter:
+    """Appends events to a trace file. The file is flushed after every command."""
+
+    def __init__(self, path, metadata=None):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'wb')
+        header = json.dumps(dict(metadata or {}, created=time.strftime('%Y-%m-%d %H:%M:%S'))).encode('utf-8')
+        self._file.write(MAGIC + _LENGTH.pack(len(header)) + header)
+        self._start = time.perf_counter()
+        self.events = 0
+
+    def event(self, kind, payload=b'', value=None):
+        t_us = int((time.perf_counter() - self._start) * 1e6)
+        self._file.write(_EVENT.pack(kind, t_us, len(payload) if value is None else value) + payload)
+        self.events += 1
+        if kind == b'W':
+            self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_trace(path):
+    """Returns (metadata, events) of a trace file, events as a list of (kind, t_s, payload or value)."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != MAGIC:
+        raise ValueError(f"'{path}' is not a trace file.")
+    (length,) = _LENGTH.unpack_from(data, 8)
+    metadata = json.loads(data[12:12 + length])
+    events = []
+    offset = 12 + length
+    while offset + _EVENT.size <= len(data):
+        kind, t_us, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        if kind == b'N':
+            events.append((kind, t_us / 1e6, length))
+            continue
+        events.append((kind, t_us / 1e6, data[offset:offset + length]))
+        offset += length
+    return metadata, events
+
+
+@contextlib.contextmanager
+def unattended():
+    """Answers operator prompts (e.g. to set the DIL switches) with Enter while a trace is replayed."""
+    real_input = builtins.input
+
+    def answer(prompt=''):
+        print(f"{prompt}[replay: Enter]")
+        return ''
+    builtins.input = answer
+    try:
+        yield
+    finally:
+        builtins.input = real_input
+
+
+def default_trace_path(serial_number=None):
+    name = f"trace_{serial_number or 'session'}_{time.strftime('%Y%m%d_%H%M%S')}.trc"
+    return os.path.join(TRACE_DIR, name)
+
+
+class TracingSerial:
+    """Wraps an open serial.Serial and records everything that passes through it to a TraceWriter."""
+
+    def __init__(self, ser, writer):
+        self.ser = ser
+        self.writer = writer
+        self._last_waiting = None  # in_waiting value of the last event, None after any other event
+
+    def __getattr__(self, name):
+        # Everything that is not traced (port, timeout, is_open, ...) comes from the port
+        return getattr(self.ser, name)
+
+    def _traced(self, operation):
+        try:
+            return operation()
+        except (serial.SerialException, OSError) as e:
+            self._last_waiting = None
+            self.writer.event(b'E', str(e).encode('utf-8'))
+            raise
+
+    def write(self, data):
+        result = self._traced(lambda: self.ser.write(data))
+        self._last_waiting = None
+        self.writer.event(b'W', bytes(data))
+        return result
+
+    def _read(self, operation):
+        data = self._traced(operation)
+        self._last_waiting = None
+        self.writer.event(b'R', data)
+        return data
+
+    def read(self, size=1):
+        return self._read(lambda: self.ser.read(size))
+
+    def readline(self):
+        return self._read(self.ser.readline)
+
+    def read_all(self):
+        return self._read(self.ser.read_all)
+
+    def reset_input_buffer(self):
+        return self._traced(self.ser.reset_input_buffer)
+
+    def flush(self):
+        return self._traced(self.ser.flush)
+
+    @property
+    def in_waiting(self):
+        waiting = self._traced(lambda: self.ser.in_waiting)
+        if waiting != self._last_waiting:
+            self._last_waiting = waiting
+            self.writer.event(b'N', value=waiting)
+        return waiting
+
+    def close(self):
+        self.ser.close()
+
+
+class _WallClock:
+    """Replays at the original speed: waits until an event is due."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def wait_until(self, t_s):
+        delay = t_s - self.now()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VirtualClock:
+    """
+    Replays as fast as possible. While active, time.time() and time.sleep() run on
+    the trace's time line instead of the wall clock: sleeping and waiting for an
+    event advance the virtual time at once, so timeouts and time-bounded stages
+    (initial checks, burnout) behave as they did in the recorded session.
+    """
+
+    def __init__(self):
+        self.offset_s = 0.0
+        self._base = None
+        self._real_time = time.time
+        self._real_sleep = time.sleep
+
+    def now(self):
+        return self.offset_s
+
+    def wait_until(self, t_s):
+        self.offset_s = max(self.offset_s, t_s)
+
+    def __enter__(self):
+        self._base = self._real_time()
+        time.time = lambda: self._base + self.offset_s
+        time.sleep = lambda seconds: self.wait_until(self.offset_s + max(seconds, 0))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        time.time = self._real_time
+        time.sleep = self._real_sleep
+
+
+class ReplaySerial:
+    """
+    Plays a trace back in place of a serial port.
+
+    The replay follows the commands: every write moves to the next recorded write,
+    and the reads after it return what was read after that write in the recorded
+    session, at its original time. Reads beyond that return nothing after the port
+    timeout, as a silent device would. Recorded port errors are raised again, so
+    reconnect handling is replayed as well. Commands that differ from the recorded
+    ones are counted in 'divergences' and the first few are printed.
+    """
+
+    def __init__(self, path, fast=True, timeout=3):
+        self.path = path
+        self.metadata, self.events = read_trace(path)
+        self.port = f"replay:{os.path.basename(path)}"
+        self.timeout = timeout
+        self.clock = VirtualClock() if fast else _WallClock()
+        self.divergences = 0
+        self._next = 0
+
+    def open(self, *args, **kwargs):
+        """Port opener for SupervisedSerial, returning this transport on every (re)connect."""
+        return self
+
+    def _peek(self, kind=None):
+        if self._next >= len(self.events):
+            return None
+        event = self.events[self._next]
+        if event[0] == b'E':
+            # A recorded port error is raised by whatever operation meets it
+            self._next += 1
+            self.clock.wait_until(event[1])
+            raise serial.SerialException(event[2].decode('utf-8', errors='replace'))
+        return event if kind is None or event[0] == kind else None
+
+    def write(self, data):
+        self._peek()
+        while self._next < len(self.events) and self.events[self._next][0] != b'W':
+            self._next += 1  # Replies the replayed session did not read
+        if self._next >= len(self.events):
+            raise ReplayExhausted(f"The session sent {bytes(data)!r} after the end of the trace.")
+        _, t_s, recorded = self.events[self._next]
+        self._next += 1
+        if bytes(data) != recorded:
+            self.divergences += 1
+            if self.divergences <= 5:
+                print(f"Replay: sent {bytes(data)!r}, the recorded session sent {recorded!r}.")
+        self.clock.wait_until(t_s)
+        return len(data)
+
+    def _read(self):
+        event = self._peek(b'R')
+        if event is None:
+            # Nothing more was received before the next command: the read times out
+            self.clock.wait_until(self.clock.now() + self.timeout)
+            return b''
+        self._next += 1
+        self.clock.wait_until(event[1])
+        return event[2]
+
+    def read(self, size=1):
+        return self._read()
+
+    def readline(self):
+        return self._read()
+
+    def read_all(self):
+        return self._read()
+
+    @property
+    def in_waiting(self):
+        event = self._peek(b'N')
+        if event is None:
+            self.clock.wait_until(self.clock.now() + 0.001)
+            return 0
+        self._next += 1
+        self.clock.wait_until(event[1])
+        return event[2]
+
+    def reset_input_buffer(self):
+        self._peek()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def remaining(self):
+        """Number of recorded events the replay has not reached."""
+        return len(self.events) - self._next
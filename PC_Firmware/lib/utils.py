@@ -5,19 +5,23 @@ from serial.tools import list_ports
 
 CONFIG_FILE_PATH = 'config.json'
 
-def load_config():
-    """Loads the main configuration file."""
+def load_config(path=CONFIG_FILE_PATH):
+    """Loads the main configuration file, or another one such as a candidate config."""
     try:
-        with open(CONFIG_FILE_PATH, 'r') as f:
+        with open(path, 'r') as f:
             return json.load(f)
     except FileNotFoundError:
-        print(f"Error: Configuration file not found at '{CONFIG_FILE_PATH}'.")
+        print(f"Error: Configuration file not found at '{path}'.")
     except json.JSONDecodeError:
-        print(f"Error: Could not parse '{CONFIG_FILE_PATH}'. Check for syntax errors.")
+        print(f"Error: Could not parse '{path}'. Check for syntax errors.")
     return None
 
-def select_serial_port():
-    """Scans for and allows user to select a serial port."""
+def select_serial_port(return_info=False):
+    """
+    Scans for and allows user to select a serial port.
+    Returns the device name, or the full port info (with USB VID/PID and
+    serial string) if return_info is True.
+    """
     print("\nScanning for available serial ports...")
     ports = [p for p in list_ports.comports() if p.device and "n/a" not in p.description.lower()]
 
@@ -27,7 +31,7 @@ def select_serial_port():
 
     if len(ports) == 1:
         print(f"Auto-connecting to: {ports[0].device}")
-        return ports[0].device
+        return ports[0] if return_info else ports[0].device
 
     print("Please select a serial port:")
     for i, p in enumerate(ports):
@@ -39,7 +43,7 @@ def select_serial_port():
             if choice.lower() == 'q': return None
             choice_idx = int(choice) - 1
             if 0 <= choice_idx < len(ports):
-                return ports[choice_idx].device
+                return ports[choice_idx] if return_info else ports[choice_idx].device
             else:
                 print("Invalid number.")
         except (ValueError, IndexError):
@@ -47,6 +51,17 @@ def select_serial_port():
         except KeyboardInterrupt:
             return None
 
+def find_serial_port(vid, pid, serial_number=None):
+    """
+    Looks for a USB serial port by vendor/product ID and, if given, its serial string.
+    Used to find a device again after it re-enumerated, possibly under another name.
+    Returns the device name, or None if the device is not present.
+    """
+    for p in list_ports.comports():
+        if p.vid == vid and p.pid == pid and (serial_number is None or p.serial_number == serial_number):
+            return p.device
+    return None
+
 def read_until_delimiter(ser, delimiter, timeout=1):
     """Reads from serial until a delimiter is found or timeout occurs."""
     start_time = time.time()
@@ -57,4 +72,4 @@ def read_until_delimiter(ser, delimiter, timeout=1):
             if delimiter in buffer:
                 line, rest = buffer.split(delimiter, 1)
                 return line
-    return None
\ No newline at end of file
+    return None
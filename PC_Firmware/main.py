@@ -1,14 +1,21 @@
+import argparse
+import os
 import serial
 import sys
 import time
 
-from PC_Firmware.lib import session_handler
-from lib import utils
-from lib.csv_logger import CsvLogger
+from lib import capabilities, metrics, protocol, psu, publisher, session_handler, stage_order, timeline, trace, utils
+from lib.csv_logger import CsvLogger, LOG_DIR
+from lib.device_clock import DeviceClock
+from lib.checkpoint import CHECKPOINT_DIR, SequenceCheckpoint
+from lib.connection import SupervisedSerial, SerialReconnected
 
 # Import individual test functions
 from test_functions import initial_checks, voltage_test, current_test, can_test, temperature_test, burnout_test
 
+# Test modules used by the full sequence. Their firmware commands are checked before it starts.
+FULL_SEQUENCE_MODULES = (initial_checks, voltage_test, current_test, temperature_test, can_test, burnout_test)
+
 
 class QCTester:
     """
@@ -25,71 +32,201 @@ class QCTester:
             print("Error: 'initial_check_ranges' section not found in config.json.")
             sys.exit(1)
         self.ser = None
+        self.clock = None
+        self.psu = None
         self.session_details = {}
 
     @staticmethod
-    def run_full_sequence(ser, config, ranges, session_details, logger):
-        # Request and retrieve Master ID and power supply voltage from ESP32
+    def run_full_sequence(ser, config, ranges, session_details, logger, checkpoint=None, clock=None, power_supply=None):
+        """
+        Runs the complete test sequence. If a checkpoint is given, stages it records
+        as completed are skipped and partially run stages continue where they stopped.
+        Progress is saved when the sequence is interrupted and the checkpoint is removed
+        once the sequence has finished.
+        A synchronised DeviceClock of the same master can be passed in to skip the clock
+        sync, e.g. when testing board after board on an open connection.
+        With a programmable 'power_supply' (psu.ScpiPsu) the board is ramped up before the
+        initial checks and switched off as soon as the sequence ends, fails or is interrupted.
+        """
+        # Fail before the first stage if the firmware lacks a command of the sequence
+        caps = capabilities.get(ser)
+        for module in FULL_SEQUENCE_MODULES:
+            capabilities.require(caps, module.REQUIRED_COMMANDS, "The full test sequence")
+
+        # Re-validate the Master ID and power supply voltage with a single round trip
         print("Requesting Master ID from device...")
-        ser.write(b"GET_TEST_INFO\n")
-        time.sleep(0.5)
-        response = utils.read_until_delimiter(ser, b'\n')
-
-        if response and response.startswith(b"TEST_INFO:"):
-            parts = response.decode('utf-8').strip().split(':')
-            master_id_from_device = parts[1]
-            psu_voltage_from_firmware = float(parts[2])
+        test_info = ser.identify(timeout_s=1.0)
+
+        if test_info:
+            master_id_from_device = test_info.master_id
+            psu_voltage_from_firmware = test_info.psu_voltage
             session_details['master_id'] = master_id_from_device
             session_details['psu_voltage'] = psu_voltage_from_firmware
             print(f"Device Master ID confirmed: {master_id_from_device}")
             print(f"Firmware configured PSU voltage: {psu_voltage_from_firmware}V")
+            metrics.set_station(master_id_from_device)
+            publisher.set_station(master_id_from_device)
         else:
             print("Failed to retrieve test info from device. Using values from config.")
             # Fallback to the ID from the config file if retrieval fails
             session_details['master_id'] = config['tester_info']['master_id']
             session_details['psu_voltage'] = config['tester_info']['lab_power_supply_voltage_v']
 
+        # Estimate the device clock offset once so all stages share the same time base
+        if clock is None or not clock.is_synced:
+            clock = DeviceClock()
+            if "GET_TIME" not in caps.commands or not clock.sync(ser):
+                print("Device does not report timestamps. Falling back to PC time.")
+
+        # The firmware's turnaround statistics are logged per board, so start them afresh
+        if "GET_LATENCY" in caps.commands:
+            protocol.query(ser, "GET_LATENCY RESET", protocol.FirmwareLatency, timeout=1.0)
+
         print("\n" + "=" * 50)
         print("           STARTING FULL TEST SEQUENCE")
         print(
             f"           Operator: {session_details['operator_name']} | S/N: {session_details['serial_number']} | Master ID: {session_details['master_id']}")
         print("=" * 50)
+        publisher.session_start(session_details)
+
+        if checkpoint is None:
+            checkpoint = SequenceCheckpoint(session_details['serial_number'])
+        elif checkpoint.data['completed_stages']:
+            print("Resuming interrupted sequence. Completed stages: " +
+                  ", ".join(name for name, _ in checkpoint.data['completed_stages']))
+
+        try:
+            with timeline.span(f"Session S/N {session_details['serial_number']}", 'session',
+                               master_id=session_details['master_id']):
+                test_results = QCTester._run_stages(ser, config, ranges, session_details, logger, clock, checkpoint,
+                                                    power_supply)
+        except BaseException:
+            # KeyboardInterrupt, SerialException, ...: keep the progress so the board can be resumed
+            checkpoint.save(force=True)
+            print(f"\nSequence interrupted. Progress saved to '{checkpoint.path}'.")
+            metrics.board_finished('interrupted')
+            publisher.verdict('interrupted')
+            raise
+        finally:
+            if power_supply is not None:
+                QCTester._power_off(power_supply)
+        checkpoint.clear()
+        if "GET_LATENCY" in caps.commands:
+            QCTester._log_firmware_latency(ser, session_details, logger)
+
+        # --- Final Summary ---
+        print("\n" + "=" * 50)
+        print("           FULL TEST SEQUENCE SUMMARY")
+        print("=" * 50)
+        all_passed = all(result for name, result in test_results)
+        metrics.board_finished('pass' if all_passed else 'fail')
+        publisher.verdict('pass' if all_passed else 'fail', test_results)
+        for name, result in test_results:
+            status_emoji = "✅" if result else "❌"
+            print(f"{status_emoji} {name:<40}: {'PASS' if result else 'FAIL'}")
+        print("-" * 50)
 
+        if all_passed:
+            print("✅ Overall Result: ALL TESTS PASSED")
+        else:
+            print("❌ Overall Result: TEST SEQUENCE FAILED")
+            print("   Failed stages:\n     - " + "\n     - ".join([name for name, res in test_results if not res]))
+        print("=" * 50)
+
+    @staticmethod
+    def _run_stages(ser, config, ranges, session_details, logger, clock, checkpoint, power_supply=None):
+        """Runs the initial checks and the test suite, returning a list of (name, result)."""
         test_results = []
 
-        # Run initial checks first and foremost.
-        initial_pass, initial_data = initial_checks.run(ser, config, ranges, session_details, logger)
+        # Power the board up and cross-check the supply's own readback before anything is measured
+        if power_supply is not None:
+            with timeline.span("PSU Power-Up"):
+                psu_pass = QCTester._power_up(power_supply, config, session_details, logger)
+            test_results.append(("PSU Power-Up", psu_pass))
+            metrics.stage_result("PSU Power-Up", psu_pass)
+            publisher.stage_result("PSU Power-Up", psu_pass)
+            if not psu_pass:
+                print("\n--- FULL TEST ABORTED: Power supply readback out of range. ---")
+                return test_results
+
+        # Run initial checks first and foremost. They are repeated on resume, as the board was re-powered.
+        with timeline.span("Initial Checks"), metrics.stage("Initial Checks"):
+            initial_pass, initial_data = initial_checks.run(ser, config, ranges, session_details, logger, clock=clock)
         test_results.append(("Initial Checks", initial_pass))
+        metrics.stage_result("Initial Checks", initial_pass)
+        publisher.stage_result("Initial Checks", initial_pass)
         logger.log_data("Initial Checks", 'PASS' if initial_pass else 'FAIL', session_details, initial_data)
 
+        # The supply must deliver the current the board measures at its input
+        if initial_pass and power_supply is not None:
+            with timeline.span("PSU Cross-Check"):
+                cross_check_pass = QCTester._cross_check_current(power_supply, config, initial_data,
+                                                                 session_details, logger)
+            test_results.append(("PSU Cross-Check", cross_check_pass))
+            metrics.stage_result("PSU Cross-Check", cross_check_pass)
+            publisher.stage_result("PSU Cross-Check", cross_check_pass)
+            if not cross_check_pass:
+                print("\n--- FULL TEST ABORTED: The supply current does not match the board's readings. ---")
+                return test_results
+
         if not initial_pass:
             print("\n--- FULL TEST ABORTED: Initial checks did not pass. ---")
         else:
             # Define the main test suite to run if initial checks pass
             test_suite = [
-                ("Voltage Channels", voltage_test.run, {}),
-                ("Current Channels", current_test.run, {}),
+                ("Voltage Channels", voltage_test.run, {'progress': checkpoint.progress("Voltage Channels")}),
+                ("Current Channels", current_test.run, {'progress': checkpoint.progress("Current Channels")}),
                 ("Temperature Communication", temperature_test.run, {}),
                 ("CAN Communication (Short)", can_test.run,
                  {'num_messages': config['can_test_settings']['short_run_messages']}),
-                ("Burnout Test", burnout_test.run, {}),
+                ("Burnout Test", burnout_test.run,
+                 {'clock': clock, 'progress': checkpoint.progress("Burnout Test")}),
                 ("CAN Communication (Post-Burnout)", can_test.run,
                  {'num_messages': config['can_test_settings']['long_run_messages']})
             ]
+            # Stages that fail often and run quickly first, if enabled and the logs have enough history
+            test_suite = stage_order.order_stages(test_suite, config)
 
             # Execute the test suite
             for name, test_func, kwargs in test_suite:
+                if checkpoint.is_completed(name):
+                    result = checkpoint.completed_result(name)
+                    print(f"\n--- Skipping Test: {name} (completed before interruption: {'PASS' if result else 'FAIL'}) ---")
+                    test_results.append((name, result))
+                    continue
+
                 print(f"\n--- Running Test: {name} ---")
-                # Perform a quick pre-check before each critical test
-                pre_check_pass, _ = initial_checks.run(ser, config, ranges, session_details, logger, is_pre_check=True)
+                max_retries = config['settings'].get('max_stage_retries', 2)
+                for attempt in range(max_retries + 1):
+                    try:
+                        # Perform a quick pre-check before each critical test
+                        with timeline.span(f"Pre-check: {name}"):
+                            pre_check_pass, _ = initial_checks.run(ser, config, ranges, session_details, logger,
+                                                                   is_pre_check=True, clock=clock)
+                        if pre_check_pass:
+                            with timeline.span(name, attempt=attempt + 1), metrics.stage(name):
+                                result, test_data = test_func(ser, config, session_details, logger, **kwargs)
+                        break
+                    except SerialReconnected as e:
+                        # The stage continues from its checkpointed progress
+                        if attempt == max_retries:
+                            raise
+                        print(f"--- {e}. Retrying {name} (attempt {attempt + 2}/{max_retries + 1}) ---")
+                        if "GET_TIME" in capabilities.get(ser).commands:
+                            clock.sync(ser)
+
                 if not pre_check_pass:
                     print(f"--- FAILED: Pre-check failed before {name} ---")
                     test_results.append((name, False))
+                    metrics.stage_result(name, 'pre_check_failed')
+                    publisher.stage_result(name, 'pre_check_failed')
                     logger.log_data(name, 'FAIL', session_details, {"pre_check_failed": True})
                     break  # Abort the rest of the sequence
 
-                result, test_data = test_func(ser, config, session_details, logger, **kwargs)
                 test_results.append((name, result))
+                metrics.stage_result(name, result)
+                publisher.stage_result(name, result)
+                checkpoint.complete_stage(name, result)
 
                 # The log_data call for this test is now handled inside each test function
                 # to allow for more granular logging, but we'll still log the overall result here
@@ -99,26 +236,81 @@ class QCTester:
                     print(f"--- ABORTING: Critical test failed: {name} ---")
                     break  # Abort the rest of the sequence
 
-        # --- Final Summary ---
-        print("\n" + "=" * 50)
-        print("           FULL TEST SEQUENCE SUMMARY")
-        print("=" * 50)
-        all_passed = all(result for name, result in test_results)
-        for name, result in test_results:
-            status_emoji = "✅" if result else "❌"
-            print(f"{status_emoji} {name:<40}: {'PASS' if result else 'FAIL'}")
-        print("-" * 50)
+        return test_results
 
-        if all_passed:
-            print("✅ Overall Result: ALL TESTS PASSED")
+    @staticmethod
+    def _log_firmware_latency(ser, session_details, logger):
+        """Logs the firmware's turnaround per command over the sequence: count, mean and max in microseconds."""
+        latency = protocol.query(ser, "GET_LATENCY", protocol.FirmwareLatency, timeout=1.0)
+        if latency is not None:
+            logger.log_data("Firmware Latency", 'INFO', session_details,
+                            {name: stats._asdict() for name, stats in latency.commands.items()})
+
+    @staticmethod
+    def _power_up(power_supply, config, session_details, logger):
+        """
+        Ramps the supply to the session's lab PSU voltage and checks its voltage and current
+        readback (see psu.check_readback). Returns True if the readback is within limits.
+        """
+        settings = config['psu']
+        voltage = session_details.get('lab_power_supply_voltage_v', config['tester_info']['lab_power_supply_voltage_v'])
+        print(f"\nPowering up the board: {voltage:.2f}V, limit {settings['current_limit_a'] * 1000:.0f}mA...")
+        reading = power_supply.power_on(voltage, settings['current_limit_a'], settings.get('ramp_step_v', 1.0),
+                                        settings.get('ramp_step_s', 0.05), settings.get('settle_s', 0.5))
+        passed, data = psu.check_readback(reading, voltage, settings)
+        print(f"  PSU readback: {reading.voltage:.3f}V, {reading.current * 1000:.1f}mA -> {'PASS' if passed else 'FAIL'}")
+        logger.log_data("PSU Power-Up", 'PASS' if passed else 'FAIL', session_details, data)
+        return passed
+
+    @staticmethod
+    def _cross_check_current(power_supply, config, board_readings, session_details, logger):
+        """
+        Reads the supply current and compares it with the board's current readings from the
+        initial checks (see psu.cross_check_current). Returns True if they match.
+        """
+        reading = power_supply.measure()
+        passed, data = psu.cross_check_current(reading, board_readings, config['psu'])
+        board = f"{data['board_current_a'] * 1000:.1f}mA" if data['board_current_a'] is not None else "n/a"
+        print(f"  PSU current {reading.current * 1000:.1f}mA, board {board} -> {'PASS' if passed else 'FAIL'}")
+        logger.log_data("PSU Cross-Check", 'PASS' if passed else 'FAIL', session_details, data)
+        return passed
+
+    @staticmethod
+    def _power_off(power_supply):
+        """Switches the board off. A supply error is reported, not raised, so it cannot hide the test result."""
+        try:
+            power_supply.power_off()
+            print("Board powered off.")
+        except (psu.PsuError, OSError, serial.SerialException) as e:
+            print(f"Warning: Could not switch off the power supply: {e}")
+
+    def _ensure_power(self, logger):
+        """Powers the board up for a single test from the menu, unless the supply is already on."""
+        if self.psu is not None and not self.psu.is_on:
+            self._power_up(self.psu, self.config, self.session_details, logger)
+
+    def _connect(self, ser):
+        """Identifies the device, reads its capabilities and synchronises the clock after connecting."""
+        self.ser = ser
+        print(f"\nSuccessfully connected to {ser.port}")
+        if not ser.identify():
+            print("Warning: Device did not answer 'GET_TEST_INFO'.")
         else:
-            print("❌ Overall Result: TEST SEQUENCE FAILED")
-            print("   Failed stages:\n     - " + "\n     - ".join([name for name, res in test_results if not res]))
-        print("=" * 50)
+            metrics.set_station(ser.test_info.master_id)
+            publisher.set_station(ser.test_info.master_id)
+        caps = capabilities.get(ser, refresh=True)
+        print(f"Firmware: {capabilities.describe(caps)}")
+        self.clock = DeviceClock()
+        if "GET_TIME" in caps.commands:
+            self.clock.sync(ser)
 
-    def run(self):
-        """The main execution loop for the test suite."""
-        port = utils.select_serial_port()
+    def run(self, record=None):
+        """
+        The main execution loop for the test suite.
+        With 'record' set, the serial session is recorded to a trace file for replay
+        ('' for the default path in logs/traces).
+        """
+        port = utils.select_serial_port(return_info=True)
         if not port:
             sys.exit(1)
 
@@ -128,26 +320,122 @@ class QCTester:
             print("\nExiting program due to incomplete details.")
             sys.exit(0)
 
+        # Offer to resume a sequence that was interrupted for this board
+        resume_checkpoint = self._offer_resume()
+
         # Initialize the CSV logger
         logger = CsvLogger()
 
+        metrics_url = metrics.start(self.config, station=self.config['tester_info']['master_id'])
+        if metrics_url:
+            print(f"Serving station metrics at {metrics_url}")
+        publisher_endpoint = publisher.start(self.config, station=self.config['tester_info']['master_id'])
+        if publisher_endpoint:
+            print(f"Publishing live results on {publisher_endpoint}")
+
         try:
-            with serial.Serial(port, self.config['settings']['baud_rate'], timeout=3) as ser:
-                self.ser = ser
-                print(f"\nSuccessfully connected to {port}")
-                time.sleep(1)
-                self.ser.read_all()
+            self.psu = psu.open_psu(self.config)
+        except psu.PsuError as e:
+            print(f"Error: {e}")
+            logger.close()
+            publisher.stop()
+            sys.exit(1)
+
+        baud_rate = self.config['settings']['baud_rate']
+        opener = serial.Serial
+        trace_writer = None
+        if record is not None:
+            trace_writer = trace.TraceWriter(record or trace.default_trace_path(self.session_details['serial_number']),
+                                             {'port': getattr(port, 'device', port), 'baud_rate': baud_rate,
+                                              'session_details': self.session_details})
+            print(f"Recording the serial session to '{trace_writer.path}'.")
+
+            def opener(port_name, baud, timeout):
+                return trace.TracingSerial(serial.Serial(port_name, baud, timeout=timeout), trace_writer)
+
+        try:
+            reconnect_timeout_s = self.config['settings'].get('reconnect_timeout_s', 30)
+            with SupervisedSerial(port, baud_rate, timeout=3, reconnect_timeout_s=reconnect_timeout_s,
+                                  opener=opener) as ser:
+                self._connect(ser)
+                if resume_checkpoint:
+                    QCTester.run_full_sequence(self.ser, self.config, self.ranges, self.session_details, logger,
+                                               checkpoint=resume_checkpoint, clock=self.clock, power_supply=self.psu)
                 self._main_menu(logger)
 
         except serial.SerialException as e:
             print(f"Serial Error: {e}")
+        except capabilities.IncompatibleDevice as e:
+            print(f"Incompatible firmware: {e}")
+        except psu.PsuError as e:
+            print(f"Power supply error: {e}")
         except KeyboardInterrupt:
             print("\nProgram interrupted by user.")
         finally:
+            if self.psu is not None:
+                self._power_off(self.psu)
+                self.psu.close()
             logger.close()  # Ensure the logger file is closed
+            publisher.stop()  # Send the queued result events
+            if trace_writer:
+                trace_writer.close()
+                print(f"Recorded {trace_writer.events} serial events to '{trace_writer.path}'.")
             print("Exiting program.")
             sys.exit(0)
 
+    def replay(self, trace_path, fast=True):
+        """
+        Runs the full test sequence against a recorded serial session instead of a device,
+        as fast as possible or at the original speed. Operator prompts are answered with
+        Enter, as the recorded replies already reflect them. Results are logged to logs/replay
+        and checkpoints to checkpoints/replay, so the files of real boards are not touched.
+        """
+        try:
+            replay = trace.ReplaySerial(trace_path, fast=fast)
+        except (OSError, ValueError) as e:
+            print(f"Error: Cannot read trace '{trace_path}': {e}")
+            sys.exit(1)
+        self.session_details = dict(replay.metadata.get('session_details', {}))
+        serial_number = self.session_details.get('serial_number', 'replay')
+        print(f"Replaying '{trace_path}' (recorded {replay.metadata.get('created')}, S/N {serial_number}, "
+              f"{len(replay.events)} events, {'fast' if fast else 'original speed'}).")
+
+        logger = CsvLogger(os.path.join(LOG_DIR, 'replay'))
+        checkpoint = SequenceCheckpoint(serial_number, directory=os.path.join(CHECKPOINT_DIR, 'replay'))
+        start = time.perf_counter()
+        try:
+            with replay.clock, trace.unattended(), SupervisedSerial(replay.port, replay.metadata.get('baud_rate'),
+                                                timeout=replay.timeout, opener=replay.open) as ser:
+                self._connect(ser)
+                QCTester.run_full_sequence(ser, self.config, self.ranges, self.session_details, logger,
+                                           checkpoint=checkpoint, clock=self.clock)
+        except trace.ReplayExhausted as e:
+            print(f"\nReplay ended early: {e}")
+        except (serial.SerialException, capabilities.IncompatibleDevice) as e:
+            print(f"\nReplay ended with: {e}")
+        finally:
+            logger.close()
+        print(f"Replay took {time.perf_counter() - start:.1f}s. {replay.divergences} command(s) differed from "
+              f"the recording, {replay.remaining} recorded event(s) were not reached.")
+
+    def _offer_resume(self):
+        """
+        Returns the checkpoint of an interrupted sequence for the current board if the
+        operator wants to resume it. A declined checkpoint is removed.
+        """
+        checkpoint = SequenceCheckpoint.load(self.session_details['serial_number'])
+        if not checkpoint:
+            return None
+        completed = [name for name, _ in checkpoint.data['completed_stages']]
+        print(f"\nFound an interrupted test sequence for S/N {self.session_details['serial_number']} "
+              f"from {checkpoint.data['created']}.")
+        print(f"  Completed stages: {', '.join(completed) if completed else 'none'}")
+        print(f"  Interrupted during: {checkpoint.data['current_stage'] or 'between stages'}")
+        if input("Resume this sequence? (y/n): ").lower() != 'y':
+            checkpoint.clear()
+            return None
+        return checkpoint
+
     def _main_menu(self, logger):
         """Displays the main menu and handles user choices."""
         while True:
@@ -159,32 +447,101 @@ class QCTester:
             print("5. Test Temperature Communication")
             print("6. Test CAN Communication (Short)")
             print("7. Run Burnout Test")
-            print("8. Exit")
+            print("8. Run CAN Throughput Sweep")
+            print("9. Next Board (keep connection)")
+            print("10. Exit")
             print("-" * 40)
             choice = input("Enter your choice: ")
 
-            if choice == '1':
-                QCTester.run_full_sequence(self.ser, self.config, self.ranges, self.session_details, logger)
-            elif choice == '2':
-                initial_checks.run(self.ser, self.config, self.ranges, self.session_details, logger)
-            elif choice == '3':
-                voltage_test.run(self.ser, self.config, self.session_details, logger)
-            elif choice == '4':
-                current_test.run(self.ser, self.config, self.session_details, logger)
-            elif choice == '5':
-                temperature_test.run(self.ser, self.config, self.session_details, logger)
-            elif choice == '6':
-                can_test.run(self.ser, self.config, self.session_details,
-                             logger)  # Runs with default short message count
-            elif choice == '7':
-                # The burnout test does not have a logger argument as requested.
-                burnout_test.run(self.ser, self.config)
-            elif choice == '8':
-                break
-            else:
-                print("Invalid choice, please try again.")
+            try:
+                if choice in ('2', '3', '4', '5', '6', '7', '8'):
+                    self._ensure_power(logger)
+                if choice == '1':
+                    QCTester.run_full_sequence(self.ser, self.config, self.ranges, self.session_details, logger,
+                                               checkpoint=self._offer_resume(), clock=self.clock,
+                                               power_supply=self.psu)
+                elif choice == '2':
+                    self._require(initial_checks, "Initial Checks")
+                    initial_checks.run(self.ser, self.config, self.ranges, self.session_details, logger,
+                                       clock=self.clock)
+                elif choice == '3':
+                    self._require(voltage_test, "Voltage Channels")
+                    voltage_test.run(self.ser, self.config, self.session_details, logger)
+                elif choice == '4':
+                    self._require(current_test, "Current Channels")
+                    current_test.run(self.ser, self.config, self.session_details, logger)
+                elif choice == '5':
+                    self._require(temperature_test, "Temperature Communication")
+                    temperature_test.run(self.ser, self.config, self.session_details, logger)
+                elif choice == '6':
+                    self._require(can_test, "CAN Communication")
+                    can_test.run(self.ser, self.config, self.session_details,
+                                 logger)  # Runs with default short message count
+                elif choice == '7':
+                    # The burnout test does not have a logger argument as requested.
+                    self._require(burnout_test, "Burnout Test")
+                    burnout_test.run(self.ser, self.config, clock=self.clock)
+                elif choice == '8':
+                    self._require(can_test, "CAN Throughput Sweep")
+                    can_test.run_sweep(self.ser, self.config, self.session_details, logger)
+                elif choice == '9':
+                    self._next_board(logger)
+                elif choice == '10':
+                    break
+                else:
+                    print("Invalid choice, please try again.")
+            except SerialReconnected as e:
+                print(f"\n{e}. The device was reconnected, please run the test again.")
+                if "GET_TIME" in capabilities.get(self.ser).commands:
+                    self.clock.sync(self.ser)
+            except capabilities.IncompatibleDevice as e:
+                print(f"\n--- Not supported by the connected firmware: {e} ---")
+            except psu.PsuError as e:
+                print(f"\n--- Power supply error: {e} ---")
+
+    def _require(self, module, what):
+        """Raises capabilities.IncompatibleDevice if the firmware lacks a command the test module uses."""
+        capabilities.require(capabilities.get(self.ser), module.REQUIRED_COMMANDS, what)
+
+    def _next_board(self, logger):
+        """
+        Warm start for the next board on the same rig: the port stays open, the cached
+        test info is re-validated with one round trip and the synchronised clock is
+        reused, so only the serial number has to be entered.
+        """
+        details = session_handler.get_next_board_details(self.config, self.session_details)
+        if not details:
+            return
+        self.session_details = details
+        QCTester.run_full_sequence(self.ser, self.config, self.ranges, self.session_details, logger,
+                                   checkpoint=self._offer_resume(), clock=self.clock, power_supply=self.psu)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="QC test suite for the CIC boards.")
+    parser.add_argument('--record', nargs='?', const='', metavar='TRACE',
+                        help="Record the serial session to a trace file (default: logs/traces/trace_<serial>_<time>.trc).")
+    parser.add_argument('--replay', metavar='TRACE',
+                        help="Run the full test sequence against a recorded trace instead of a device.")
+    parser.add_argument('--replay-speed', choices=('fast', 'original'), default='fast',
+                        help="Replay as fast as possible (default) or with the recorded timing.")
+    parser.add_argument('--timeline', nargs='?', const='', metavar='FILE',
+                        help="Write a timeline of stages, codes and serial commands in the Chrome trace-event "
+                             "format (default: logs/timelines/timeline_<time>.json).")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_args()
     tester = QCTester()
-    tester.run()
+    if args.timeline is not None:
+        timeline.start(args.timeline or timeline.default_timeline_path(), {'replay': args.replay})
+    try:
+        if args.replay:
+            tester.replay(args.replay, fast=args.replay_speed == 'fast')
+        else:
+            tester.run(record=args.record)
+    finally:
+        timeline_path = timeline.stop()
+        if timeline_path:
+            print(f"Timeline written to '{timeline_path}'. Open it in chrome://tracing or https://ui.perfetto.dev.")
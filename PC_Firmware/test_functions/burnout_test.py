@@ -1,47 +1,126 @@
+import math
+import os
 import time
-import sys
 
-def read_all_spi_values(ser):
+from lib import capabilities, protocol, timeline
+from lib.capture import CAPTURE_DIR, CaptureFile
+from lib.connection import SerialReconnected
+from lib.console import ConsoleRenderer
+from lib.device_clock import DeviceClock
+from lib.records import NAN
+from lib.running_stats import RunningStats
+from . import initial_checks
+
+# Firmware commands this test needs, checked against the device capabilities
+REQUIRED_COMMANDS = ("SET_VCAN_VOLTAGE", "SET_I2C_CURRENT", "READ_MASTER_SPI", "CHECK_SPI_ADC")
+
+# One record per poll. 't_device_us' is -1 if the firmware sent no timestamp.
+SAMPLE_SCHEMA = (
+    ('t_device_us', 'q'),
+    ('t_wall', 'd'),
+    ('v_a', 'd'),
+    ('i_a', 'd'),
+    ('v_b', 'd'),
+    ('i_b', 'd'),
+)
+
+# One record per temperature read. Failed sensor reads are NaN.
+TEMPERATURE_SCHEMA = (
+    ('t_device_us', 'q'),
+    ('t_wall', 'd'),
+    ('master_c', 'd'),
+    ('slave_c', 'd'),
+)
+
+# Firmware error values: -127 for a failed sensor read, 99 if the slave did not answer
+TEMPERATURE_ERRORS = (-127.0, 99.0)
+
+
+def read_temperatures(ser):
     """
-    Reads voltage and current from both the master (A) and slave (B) via SPI.
-    Returns: A tuple (v_a, i_a, v_b, i_b). Returns -999.0 for any failed reading.
+    Reads the latest master and slave temperatures from the firmware's background
+    sampling ('READ_TEMP_CACHED', answered without waiting for a conversion).
+    Returns (master_c, slave_c, t_us) with NaN for a failed sensor, or None without a reply.
     """
-    v_a, i_a, v_b, i_b = -999.0, -999.0, -999.0, -999.0
+    record = protocol.query(ser, "READ_TEMP_CACHED", protocol.Temperatures, timeout=0.5)
+    if record is None:
+        return None
+    master_c, slave_c = (NAN if value in TEMPERATURE_ERRORS else value for value in (record.master, record.slave))
+    return master_c, slave_c, record.t_device_us
+
+
+def thermal_profile(temperatures):
+    """
+    Summarises the temperature records per sensor with running statistics and the
+    thermal rise rate (least-squares slope over wall time) in °C per minute.
+    """
+    stats = {'master_c': RunningStats(), 'slave_c': RunningStats()}
+    for _, t_wall, master_c, slave_c in temperatures:
+        for sensor, value in (('master_c', master_c), ('slave_c', slave_c)):
+            if not math.isnan(value):
+                stats[sensor].add(value, t_wall)
+    return {sensor: dict(s.as_dict(), rise_rate_c_per_min=s.slope * 60) for sensor, s in stats.items()}
+
+
+def open_captures(state, session_details, capacity):
+    """
+    Returns the capture files (samples, temperatures) of a burnout: the ones of the
+    checkpointed run if it is resumed, otherwise new ones in CAPTURE_DIR.
+    """
+    saved = state.get('captures', {})
+    if all(os.path.exists(saved.get(name, '')) for name in ('samples', 'temperatures')):
+        return CaptureFile.open(saved['samples']), CaptureFile.open(saved['temperatures'])
+    serial_number = (session_details or {}).get('serial_number', 'unknown')
+    base = os.path.join(CAPTURE_DIR, f"burnout_{serial_number}_{time.strftime('%Y%m%d_%H%M%S')}")
+    return (CaptureFile(base + '_samples.cap', SAMPLE_SCHEMA, capacity, "Burnout V/I samples"),
+            CaptureFile(base + '_temperatures.cap', TEMPERATURE_SCHEMA, capacity // 4 + 16,
+                        "Burnout master/slave temperatures"))
 
-    # Read from Master
-    ser.reset_input_buffer()
-    ser.write(b"READ_MASTER_SPI\n")
-    response_a = ser.readline().decode('utf-8').strip()
-    if response_a.startswith("MASTER_SPI:"):
-        try:
-            parts = response_a.split(':')[1].split(',')
-            v_a = float(parts[0])
-            i_a = float(parts[1])
-        except (ValueError, IndexError):
-            pass # Keep default error values
-
-    # Read from Slave
-    ser.reset_input_buffer()
-    ser.write(b"CHECK_SPI_ADC\n")
-    response_b = ser.readline().decode('utf-8').strip()
-    if response_b.startswith("DATA:"):
-        try:
-            # Format is DATA:cic_v,cic_i,vcan_v,vcan_i
-            parts = response_b.split(':')[1].split(',')
-            v_b = float(parts[2])
-            i_b = float(parts[3])
-        except (ValueError, IndexError):
-            pass # Keep default error values
 
-    return v_a, i_a, v_b, i_b
+def read_all_spi_values(ser, samples=1):
+    """
+    Reads voltage and current from both the master (A) and slave (B) via SPI.
+    With samples > 1 the slave values are the means of that many conversions.
+    Firmware with READ_ALL_SPI reads both boards at the same time in one round trip.
+    Returns: A tuple (v_a, i_a, v_b, i_b, t_a_us, t_b_us). Returns protocol.INVALID
+    for any failed reading and None for a missing device timestamp.
+    """
+    if initial_checks.ALL_SPI_COMMAND in capabilities.get(ser).commands:
+        record = initial_checks.read_all_spi(ser, samples)
+        if record is None:
+            return protocol.INVALID, protocol.INVALID, protocol.INVALID, protocol.INVALID, None, None
+        return record.v_a, record.i_a, record.v_b, record.i_b, record.t_device_us, record.t_device_us
+    master = protocol.query(ser, "READ_MASTER_SPI", protocol.MasterSpi)
+    slave = initial_checks.read_adc(ser, samples)
+    v_a, i_a, t_a_us = (master.v, master.i, master.t_device_us) if master else (protocol.INVALID, protocol.INVALID, None)
+    v_b, i_b, t_b_us = (slave.vcan_v, slave.vcan_i, slave.t_device_us) if slave else (protocol.INVALID, protocol.INVALID, None)
+    return v_a, i_a, v_b, i_b, t_a_us, t_b_us
 
-def run(ser, config):
+def run(ser, config, session_details=None, logger=None, clock=None, progress=None):
     """
     Initiates and monitors a burnout test by directly controlling and polling
     the hardware from Python.
+    Every sample is stored with the master's device timestamp and the matching
+    wall time, so the series has the true sample spacing independent of USB latency.
+    Samples and temperatures are written to memory-mapped capture files (lib/capture.py)
+    instead of being kept in memory, so memory use does not grow with the duration,
+    and the series can be analysed with numpy while the burnout is still running.
+    The log holds the capture file paths and running statistics of every channel.
+    On firmware with batches, the slave (B) values of every poll are the means of
+    'settings.adc_oversampling' conversions.
+    Temperatures are read every 'temperature_interval_s' between two SPI polls. The
+    polls are scheduled on fixed deadlines, so the temperature reads use the idle
+    time of the poll interval instead of delaying the next poll. The test aborts if
+    a temperature exceeds 'max_temperature_c'.
+    With a stage progress checkpoint, an interrupted burnout continues for the
+    remaining duration and appends to the capture files of the interrupted run.
+    Returns: A tuple (test_passed, log_data).
     """
     print("\n--- Running Test: Burnout Sequence (Python-Controlled) ---")
     test_passed = False
+    is_final = True  # False while an interruption or reconnect propagates
+    state = progress.state if progress else {}
+    elapsed_before = state.get('elapsed_s', 0.0)
 
     try:
         # --- Load Configuration ---
@@ -49,9 +128,12 @@ def run(ser, config):
         ranges = config['initial_check_ranges']
 
         duration_min = burnout_cfg['duration_minutes']
-        duration_sec = duration_min * 60
+        duration_sec = duration_min * 60 - elapsed_before
         max_i_setting = burnout_cfg['max_i2c_dac_value'] # Direct DAC value
         max_v_setting = burnout_cfg.get('max_vcan_setting', 255) # Voltage code
+        poll_interval_s = burnout_cfg.get('poll_interval_s', 1.0)
+        temp_interval_s = burnout_cfg.get('temperature_interval_s', 5.0)
+        max_temp_c = burnout_cfg.get('max_temperature_c')
 
         # Safety check ranges
         v_min, v_max = ranges['vcan_v_min'], ranges['vcan_v_max']
@@ -59,61 +141,121 @@ def run(ser, config):
 
     except KeyError as e:
         print(f"ERROR: Missing key in config.json: {e}")
-        return False
+        return False, {}
+
+    # Preallocate for the whole run, the files grow if polls are faster than planned
+    samples, temperatures = open_captures(state, session_details, int(duration_sec / poll_interval_s) + 16)
+    captures = {'samples': samples.path, 'temperatures': temperatures.path}
+    log_data = {'captures': captures}
+    print(f"Capturing samples to '{samples.path}'.")
+
+    # Statistics of the whole run, including the samples captured before an interruption
+    sample_stats = {channel: RunningStats() for channel in ('v_a', 'i_a', 'v_b', 'i_b')}
+    for _, t_wall, *values in samples:
+        for channel_stats, value in zip(sample_stats.values(), values):
+            channel_stats.add(value, t_wall)
+    if progress:
+        progress.update(force=True, captures=captures)
+
+    if clock is None:
+        clock = DeviceClock()
+        clock.sync(ser)
+
+    adc_samples = initial_checks.adc_samples(ser, config)
+    log_data['adc_samples_per_poll'] = adc_samples
+    record_temperatures = "READ_TEMP_CACHED" in capabilities.get(ser).commands
+    if not record_temperatures:
+        print("Note: The firmware cannot read temperatures without blocking. No temperatures are recorded.")
 
     # --- Test Execution ---
     try:
         # 1. Set max voltage and current
         print(f"This test will run for {duration_min} minute(s).")
+        if elapsed_before > 0:
+            print(f"Resuming with {int(duration_sec)}s remaining.")
         print(f"Setting max voltage (code: {max_v_setting}) and max current (DAC: {max_i_setting})...")
         ser.write(f"SET_VCAN_VOLTAGE {max_v_setting}\n".encode('utf-8'))
-        time.sleep(0.1)
+        timeline.sleep(0.1)
         ser.write(f"SET_I2C_CURRENT {max_i_setting}\n".encode('utf-8'))
-        time.sleep(1) # Allow time for components to settle
+        timeline.sleep(1, "burnout settle") # Allow time for components to settle
 
         # 2. Monitor for the duration
         start_time = time.time()
         end_time = start_time + duration_sec
+        next_poll = start_time
+        next_temp_read = start_time
+        temp_text = ""
+
+        with ConsoleRenderer(config['settings'].get('console_refresh_hz', 10)) as console:
+            while time.time() < end_time:
+                with timeline.span("poll", 'iteration'):
+                    v_a, i_a, v_b, i_b, t_a_us, t_b_us = read_all_spi_values(ser, adc_samples)
+                remaining_time = end_time - time.time()
+
+                # Check for communication errors
+                if protocol.INVALID in [v_a, i_a, v_b, i_b]:
+                    console.message("ERROR: Failed to read sensor values. Aborting test.")
+                    return False, log_data # Exit immediately, finally block will handle cleanup
 
-        while time.time() < end_time:
-            v_a, i_a, v_b, i_b = read_all_spi_values(ser)
-            remaining_time = end_time - time.time()
-
-            # Check for communication errors
-            if -999.0 in [v_a, i_a, v_b, i_b]:
-                print("\nERROR: Failed to read sensor values. Aborting test.")
-                return False # Exit immediately, finally block will handle cleanup
-
-            # Check if values are within safety ranges
-            v_a_ok = v_min <= v_a <= v_max
-            i_a_ok = i_min <= i_a <= i_max
-            v_b_ok = v_min <= v_b <= v_max
-            i_b_ok = i_min <= i_b <= i_max
-
-            if not all([v_a_ok, i_a_ok, v_b_ok, i_b_ok]):
-                print("\n--- FAILED: A measurement went out of the safe range! ---")
-                print(f"    V_A: {v_a:.3f}V {'(OK)' if v_a_ok else '(FAIL)'} | I_A: {i_a*1000:.1f}mA {'(OK)' if i_a_ok else '(FAIL)'}")
-                print(f"    V_B: {v_b:.3f}V {'(OK)' if v_b_ok else '(FAIL)'} | I_B: {i_b*1000:.1f}mA {'(OK)' if i_b_ok else '(FAIL)'}")
-                return False # Exit immediately, finally block will handle cleanup
-
-            # Display progress
-            progress_msg = (
-                f"  -> In progress... Time left: {int(remaining_time // 60)}m {int(remaining_time % 60)}s | "
-                f"A(V:{v_a:.2f}, I:{i_a*1000:.1f}mA) | B(V:{v_b:.2f}, I:{i_b*1000:.1f}mA)"
-            )
-            sys.stdout.write('\r' + ' ' * 120) # Clear line
-            sys.stdout.write('\r' + progress_msg)
-            sys.stdout.flush()
-
-            time.sleep(1) # Poll every second
+                t_wall = clock.to_wall(t_a_us) or time.time()
+                samples.append(t_a_us if t_a_us is not None else -1, t_wall, v_a, i_a, v_b, i_b)
+                for channel_stats, value in zip(sample_stats.values(), (v_a, i_a, v_b, i_b)):
+                    channel_stats.add(value, t_wall)
+                if progress:
+                    progress.update(elapsed_s=elapsed_before + time.time() - start_time)
+
+                # Check if values are within safety ranges
+                v_a_ok = v_min <= v_a <= v_max
+                i_a_ok = i_min <= i_a <= i_max
+                v_b_ok = v_min <= v_b <= v_max
+                i_b_ok = i_min <= i_b <= i_max
+
+                if not all([v_a_ok, i_a_ok, v_b_ok, i_b_ok]):
+                    console.message("--- FAILED: A measurement went out of the safe range! ---")
+                    console.message(f"    V_A: {v_a:.3f}V {'(OK)' if v_a_ok else '(FAIL)'} | I_A: {i_a*1000:.1f}mA {'(OK)' if i_a_ok else '(FAIL)'}")
+                    console.message(f"    V_B: {v_b:.3f}V {'(OK)' if v_b_ok else '(FAIL)'} | I_B: {i_b*1000:.1f}mA {'(OK)' if i_b_ok else '(FAIL)'}")
+                    return False, log_data # Exit immediately, finally block will handle cleanup
+
+                # Read the temperatures in the slack before the next poll
+                if record_temperatures and time.time() >= next_temp_read:
+                    next_temp_read = max(next_temp_read + temp_interval_s, time.time())
+                    reading = read_temperatures(ser)
+                    if reading:
+                        master_c, slave_c, t_us = reading
+                        temperatures.append(t_us if t_us is not None else -1, clock.to_wall(t_us) or time.time(),
+                                            master_c, slave_c)
+                        temp_text = f" | T(M:{master_c:.1f}, S:{slave_c:.1f}°C)"
+                        hottest = max((t for t in (master_c, slave_c) if not math.isnan(t)), default=None)
+                        if max_temp_c is not None and hottest is not None and hottest > max_temp_c:
+                            console.message("--- FAILED: Temperature limit exceeded! ---")
+                            console.message(f"    Master: {master_c:.1f}°C | Slave: {slave_c:.1f}°C "
+                                            f"(limit: {max_temp_c:.1f}°C)")
+                            return False, log_data # Exit immediately, finally block will handle cleanup
+
+                # Display progress
+                console.progress(
+                    f"  -> In progress... Time left: {int(remaining_time // 60)}m {int(remaining_time % 60)}s | "
+                    f"A(V:{v_a:.2f}, I:{i_a*1000:.1f}mA) | B(V:{v_b:.2f}, I:{i_b*1000:.1f}mA){temp_text}"
+                )
+
+                # Poll on fixed deadlines, so the time spent reading does not stretch the interval
+                next_poll = max(next_poll + poll_interval_s, time.time())
+                timeline.sleep(max(0.0, next_poll - time.time()), "until next poll")
 
         # If the loop completes without issue
-        sys.stdout.write('\n') # Move to the next line after progress bar
         print("  -> Test completed successfully. All readings remained in range.")
         test_passed = True
 
+    except SerialReconnected:
+        # The stage is retried, so this is not its outcome and is not logged
+        is_final = False
+        raise
+
     except KeyboardInterrupt:
-        sys.stdout.write('\n')
+        if progress is not None:
+            # The sequence saves its checkpoint, so the burnout is resumed later and not logged now
+            is_final = False
+            raise
         print("\nWARN: Burnout test interrupted by user.")
         # test_passed remains False
 
@@ -121,8 +263,24 @@ def run(ser, config):
         # --- Cleanup ---
         # CRITICAL: Always turn off power regardless of test outcome
         print("Cleaning up: Turning off voltage and current...")
-        ser.write(b"SET_VCAN_VOLTAGE 0\n")
-        time.sleep(0.1)
-        ser.write(b"SET_I2C_CURRENT 0\n")
+        try:
+            ser.write(b"SET_VCAN_VOLTAGE 0\n")
+            timeline.sleep(0.1)
+            ser.write(b"SET_I2C_CURRENT 0\n")
+        finally:
+            # The captures are closed and summarised even if the port is gone
+            log_data['num_samples'] = len(samples)
+            log_data['sample_stats'] = {channel: stats.as_dict() for channel, stats in sample_stats.items()}
+            if len(temperatures):
+                log_data['thermal'] = thermal_profile(temperatures)
+                for sensor, profile in log_data['thermal'].items():
+                    if profile['n']:
+                        print(f"Thermal profile {sensor}: max {profile['max']:.1f}°C, "
+                              f"rise rate {profile['rise_rate_c_per_min']:+.2f}°C/min")
+            samples.close()
+            temperatures.close()
+
+            if logger and is_final:
+                logger.log_data("Burnout Test", 'PASS' if test_passed else 'FAIL', session_details, log_data)
 
-    return test_passed
\ No newline at end of file
+    return test_passed, log_data
\ No newline at end of file
@@ -1,48 +1,88 @@
+import re
 import time
 
+from lib import capabilities, metrics, timeline
 
-def run(ser, config, session_details, logger=None, num_messages=None):
+# Firmware commands this test needs, checked against the device capabilities
+REQUIRED_COMMANDS = ("RUN_CAN_TEST",)
+# The bitrate and send interval arguments of RUN_CAN_TEST need this protocol version
+SWEEP_PROTOCOL_VERSION = 1
+
+# Matches e.g. "Master(tx_ok:10,tx_fail:0,rx_ok:10,crosstalk:0)"
+DETAILS_PATTERN = re.compile(r"(Master|Slave|Timing)\(([^)]*)\)")
+
+
+def parse_final_details(details):
+    """
+    Parses the details part of a 'CAN_TEST_FINAL' line into a dictionary of
+    dictionaries, e.g. {'Master': {'tx_ok': 10, ...}, 'Timing': {'elapsed_ms': 512, ...}}.
+    Unknown or malformed fields are skipped.
+    """
+    parsed = {}
+    for group, fields in DETAILS_PATTERN.findall(details):
+        values = {}
+        for field in fields.split(','):
+            key, _, value = field.partition(':')
+            try:
+                values[key.strip()] = int(value)
+            except ValueError:
+                continue
+        parsed[group] = values
+    return parsed
+
+
+def run(ser, config, session_details, logger=None, num_messages=None, bitrate=None, send_interval_ms=None):
     """
     Initiates and verifies a two-way CAN communication test.
+    The bitrate and send interval default to the firmware defaults (125 kbit/s, 50 ms).
     """
     try:
         # If num_messages isn't passed, default to the short run from config
         if num_messages is None:
             num_messages = config['can_test_settings']['short_run_messages']
 
-        # Calculate a dynamic timeout: 5s base + 100ms per message
-        timeout_s = 5 + (num_messages * 0.1)
+        # Calculate a dynamic timeout: 5s base + the send interval and 50ms of margin per message
+        interval_s = (send_interval_ms if send_interval_ms is not None else 50) / 1000.0
+        timeout_s = 5 + (num_messages * (interval_s + 0.05))
 
     except KeyError as e:
         print(f"ERROR: Missing key in 'can_test_settings' in config.json: {e}")
         return False, {}
 
-    command = f"RUN_CAN_TEST {num_messages}\n"
+    command = f"RUN_CAN_TEST {num_messages}"
+    if bitrate is not None or send_interval_ms is not None:
+        command += f" {bitrate if bitrate is not None else 125000} {send_interval_ms if send_interval_ms is not None else 50}"
     print(f"Sending command to test with {num_messages} messages (timeout: {int(timeout_s)}s)...")
-    ser.write(command.encode('utf-8'))
+    with timeline.span(command, 'serial', num_messages=num_messages), metrics.command(command):
+        ser.write(f"{command}\n".encode('utf-8'))
 
-    start_time = time.time()
-    test_passed = False
+        start_time = time.time()
+        test_passed = False
+        details = {}
 
-    while time.time() - start_time < timeout_s:
-        if ser.in_waiting > 0:
-            line = ser.readline().decode('utf-8').strip()
-            if not line:
-                continue
+        while time.time() - start_time < timeout_s:
+            if ser.in_waiting > 0:
+                line = ser.readline().decode('utf-8').strip()
+                if not line:
+                    continue
 
-            if "CAN_TEST_PROGRESS" in line:
-                print(f"  -> {line.split(': ', 1)[1]}")
+                if "CAN_TEST_PROGRESS" in line:
+                    print(f"  -> {line.split(': ', 1)[1]}")
 
-            elif "CAN_TEST_FINAL:PASS" in line:
-                print("  -> Firmware reports PASS.")
-                print(f"  -> Details: {line.split(':', 2)[2]}")
-                test_passed = True
-                break
+                elif "CAN_TEST_FINAL:PASS" in line:
+                    print("  -> Firmware reports PASS.")
+                    print(f"  -> Details: {line.split(':', 2)[2]}")
+                    details = parse_final_details(line.split(':', 2)[2])
+                    test_passed = True
+                    break
 
-            elif "CAN_TEST_FINAL:FAIL" in line:
-                print("  -> Firmware reports FAIL.")
-                print(f"  -> Details: {line.split(':', 2)[2]}")
-                break
+                elif "CAN_TEST_FINAL:FAIL" in line:
+                    print("  -> Firmware reports FAIL.")
+                    print(f"  -> Details: {line.split(':', 2)[2]}")
+                    details = parse_final_details(line.split(':', 2)[2])
+                    break
+            else:
+                time.sleep(0.005)  # Progress lines come every few messages, no need to spin on the port
 
     if not test_passed:
         print("--- FAILED (Timeout: Did not receive final status from firmware) ---")
@@ -50,11 +90,92 @@ def run(ser, config, session_details, logger=None, num_messages=None):
     # Log the final result
     log_data = {
         'num_messages': num_messages,
+        'bitrate': bitrate,
+        'send_interval_ms': send_interval_ms,
         'timeout_s': timeout_s,
-        'final_firmware_response': line if 'line' in locals() else 'TIMEOUT'
+        'final_firmware_response': line if 'line' in locals() else 'TIMEOUT',
+        'details': details
     }
 
     if logger:
         logger.log_data("CAN Communication", 'PASS' if test_passed else 'FAIL', session_details, log_data)
 
     return test_passed, log_data
+
+
+def run_sweep(ser, config, session_details, logger=None):
+    """
+    Characterises CAN throughput by running the two-way test for every combination
+    of bitrate and send interval from 'can_sweep_settings'. For each setting the
+    achieved message rate and the loss on both nodes are recorded, and the highest
+    rate without any loss is reported as the board's clean rate.
+    This is a characterisation, so it always returns True as long as it ran.
+    """
+    print("\n--- Running Test: CAN Throughput Sweep ---")
+    try:
+        sweep_cfg = config['can_sweep_settings']
+        bitrates = sweep_cfg['bitrates']
+        send_intervals_ms = sweep_cfg['send_intervals_ms']
+        num_messages = sweep_cfg['messages_per_setting']
+    except KeyError as e:
+        print(f"ERROR: Missing key in 'can_sweep_settings' in config.json: {e}")
+        return False, {}
+
+    # Older firmware ignores the bitrate and interval and would sweep the default setting only
+    caps = capabilities.get(ser)
+    if caps.protocol_version < SWEEP_PROTOCOL_VERSION:
+        print(f"ERROR: The sweep needs firmware protocol version {SWEEP_PROTOCOL_VERSION}, "
+              f"the device reports {capabilities.describe(caps)}.")
+        return False, {}
+
+    results = []
+    best = None
+
+    for bitrate in bitrates:
+        for interval_ms in send_intervals_ms:
+            print(f"\n  Setting: {bitrate // 1000} kbit/s, {interval_ms} ms interval")
+            with timeline.span(f"{bitrate // 1000} kbit/s, {interval_ms} ms", 'iteration'):
+                passed, data = run(ser, config, session_details, None, num_messages=num_messages,
+                                   bitrate=bitrate, send_interval_ms=interval_ms)
+            details = data.get('details', {})
+            master, slave = details.get('Master', {}), details.get('Slave', {})
+            elapsed_ms = details.get('Timing', {}).get('elapsed_ms', 0)
+
+            rx_total = master.get('rx_ok', 0) + slave.get('rx_ok', 0)
+            loss = 1.0 - min(rx_total / (2.0 * num_messages), 1.0) if num_messages else 0.0
+            msgs_per_s = (rx_total / (elapsed_ms / 1000.0)) if elapsed_ms > 0 else 0.0
+            clean = passed and loss == 0.0
+
+            print(f"  -> {msgs_per_s:.1f} msg/s, loss {loss * 100:.2f}% {'(CLEAN)' if clean else ''}")
+            result = {
+                'bitrate': bitrate,
+                'send_interval_ms': interval_ms,
+                'num_messages': num_messages,
+                'passed': passed,
+                'elapsed_ms': elapsed_ms,
+                'msgs_per_s': msgs_per_s,
+                'loss': loss,
+                'master': master,
+                'slave': slave
+            }
+            results.append(result)
+            if clean and (best is None or msgs_per_s > best['msgs_per_s']):
+                best = result
+
+    print("\n--- CAN Sweep Summary ---")
+    if best:
+        print(f"Highest clean rate: {best['msgs_per_s']:.1f} msg/s "
+              f"@ {best['bitrate'] // 1000} kbit/s, {best['send_interval_ms']} ms interval")
+    else:
+        print("No setting completed without loss.")
+
+    log_data = {
+        'settings': results,
+        'best_clean_msgs_per_s': best['msgs_per_s'] if best else 0.0,
+        'best_clean_bitrate': best['bitrate'] if best else None,
+        'best_clean_send_interval_ms': best['send_interval_ms'] if best else None
+    }
+    if logger:
+        logger.log_data("CAN Throughput Sweep", 'PASS' if best else 'FAIL', session_details, log_data)
+
+    return True, log_data
@@ -1,31 +1,34 @@
-import time
 import math
-from . import voltage_test
-
-
-def get_i2c_voltage(ser, channel):
-    """Sends a command to read I2C voltage and parses the response."""
-    prefix = f"I2C_VOLTAGE_{channel}:"
-    command = f"READ_I2C_VOLTAGE_{channel}\n"
-    ser.reset_input_buffer()
-    ser.write(command.encode('utf-8'))
-    ser.flush()
-    start_time = time.time()
-    while time.time() - start_time < 2.0:
-        if ser.in_waiting > 0:
-            response = ser.readline().decode('utf-8').strip()
-            if response.startswith(prefix):
-                try:
-                    return float(response.split(':')[1])
-                except (ValueError, IndexError):
-                    print(f"Error: Could not parse I2C voltage for Ch {channel}: {response}")
-                    return -999.0
-    print(f"Error: Timeout waiting for I2C response for Ch {channel}")
-    return -999.0
-
-
-def set_current(ser, current_a, config):
-    """Calculates the DAC value for a given current and sends the command."""
+from lib import capabilities, metrics, protocol, publisher, timeline
+from lib.records import RecordBuffer, NAN, pass_fail
+from . import initial_checks, voltage_test
+
+# Firmware commands this test needs, checked against the device capabilities
+REQUIRED_COMMANDS = voltage_test.REQUIRED_COMMANDS + ("SET_I2C_CURRENT", "READ_MASTER_SPI", "CHECK_SPI_ADC")
+
+# Firmware command that runs the whole measurement loop on the device, see measure_sequenced()
+SEQUENCE_COMMAND = "RUN_CURRENT_SEQ"
+# Most codes per SEQUENCE_COMMAND (MAX_SEQ_CODES in the firmware), longer lists are sent in chunks
+SEQUENCE_MAX_CODES = 16
+
+# One row per voltage code. Values not measured because an earlier step failed are NaN.
+CURRENT_SCHEMA = (
+    ('voltage_code', 'B'),
+    ('expected_v', 'd'),
+    ('voltage_check_pass', 'b', bool),
+    ('v_spi_a', 'd'),
+    ('v_spi_b', 'd'),
+    ('v_i2c_a', 'd'),
+    ('v_i2c_b', 'd'),
+    ('current_set_ack', 'b', bool),
+    ('meas_i_a', 'd'),
+    ('meas_i_b', 'd'),
+    ('result', 'b', pass_fail),
+)
+
+
+def current_to_dac(current_a, config):
+    """Converts a load current to the DAC value that sets it."""
     settings = config['current_test_settings']
     r_ref = settings['R_REF_ohms']
     v_ref_dac = settings['V_REF_DAC_volts']
@@ -34,147 +37,217 @@ def set_current(ser, current_a, config):
         print(
             f"Warning: Requested current {current_a * 1000:.1f}mA is higher than max possible {max_possible_current * 1000:.1f}mA.")
     dac_value = (current_a * r_ref * 4095.0) / v_ref_dac
-    dac_value = int(min(max(dac_value, 0), 4095))
-    command = f"SET_I2C_CURRENT {dac_value}\n"
-    ser.reset_input_buffer()
-    ser.write(command.encode('utf-8'))
-    response = ser.readline().decode('utf-8').strip()
-    return response == "ACK_CURRENT_SET"
-
-
-def measure_all_currents(ser):
-    """Requests current readings from both master (A) and slave (B)."""
-    ser.reset_input_buffer()
-    ser.write(b"READ_MASTER_SPI\n")
-    response_a = ser.readline().decode('utf-8').strip()
-    i_a = -999.0
-    if response_a.startswith("MASTER_SPI:"):
-        try:
-            i_a = float(response_a.split(',')[1])
-        except (ValueError, IndexError):
-            pass
-    ser.reset_input_buffer()
-    ser.write(b"CHECK_SPI_ADC\n")
-    response_b = ser.readline().decode('utf-8').strip()
-    i_b = -999.0
-    if response_b.startswith("DATA:"):
-        try:
-            i_b = float(response_b.split(',')[3])
-        except (ValueError, IndexError):
-            pass
+    return int(min(max(dac_value, 0), 4095))
+
+
+def set_current(ser, current_a, config):
+    """Calculates the DAC value for a given current and sends the command."""
+    dac_value = current_to_dac(current_a, config)
+    return protocol.query(ser, f"SET_I2C_CURRENT {dac_value}", protocol.Ack) is not None
+
+
+def measure_all_currents(ser, samples=1):
+    """
+    Requests current readings from both master (A) and slave (B). With samples > 1
+    the slave current is the mean of that many conversions. Firmware with READ_ALL_SPI
+    reads both boards at the same time in one round trip.
+    Returns protocol.INVALID for a channel without a valid reply.
+    """
+    if initial_checks.ALL_SPI_COMMAND in capabilities.get(ser).commands:
+        record = initial_checks.read_all_spi(ser, samples)
+        return (record.i_a, record.i_b) if record else (protocol.INVALID, protocol.INVALID)
+    master = protocol.query(ser, "READ_MASTER_SPI", protocol.MasterSpi)
+    slave = initial_checks.read_adc(ser, samples)
+    i_a = master.i if master else protocol.INVALID
+    i_b = slave.vcan_i if slave else protocol.INVALID
     return i_a, i_b
 
 
-def run(ser, config, session_details, logger=None):
-    """Main function to execute the current channel test, assuming pre-checks have passed."""
+def voltages_ok(voltages, expected_v, v_tol):
+    return all(math.isclose(v, expected_v, abs_tol=v_tol) for v in voltages)
+
+
+def measure_stepwise(ser, codes, config):
+    """
+    Measures the codes with one command per step (about seven round trips and the
+    settle time per code). Yields a protocol.CurrentRecord per code. The current is
+    only set if the voltages are in range. The slave current is oversampled on
+    firmware with batches.
+    """
+    samples = initial_checks.adc_samples(ser, config)
+    for code in codes:
+        with timeline.span(f"code {code:#04x}", 'iteration'):
+            record = _measure_code(ser, code, config, samples)
+        yield record
+
+
+def _measure_code(ser, code, config, samples=1):
+    settings = config['current_test_settings']
+    print(f"\n--- Testing with voltage code {code:#04x} ---")
+    expected_v = voltage_test.get_expected_voltage(code, switches_on=True)
+
+    print(f"1. Setting voltage to {expected_v:.3f}V...")
+    v_spi_a, v_spi_b = voltage_test.set_vcan_voltage(ser, code)
+    v_i2c_a, v_i2c_b = voltage_test.get_i2c_voltages(ser)
+    voltages = (v_spi_a, v_spi_b, v_i2c_a, v_i2c_b)
+    if not voltages_ok(voltages, expected_v, settings['voltage_tolerance_v']):
+        return protocol.CurrentRecord(code, *voltages, False, NAN, NAN, 0, None)
+
+    print("   Voltage OK.")
+    print(f"2. Setting current to {settings['target_current_a'] * 1000:.1f}mA...")
+    if not set_current(ser, settings['target_current_a'], config):
+        return protocol.CurrentRecord(code, *voltages, False, NAN, NAN, 0, None)
+
+    print("   Current set command sent.")
+    timeline.sleep(settings['current_settle_time_s'], "current settle")
+    print("4. Measuring currents...")
+    meas_i_a, meas_i_b = measure_all_currents(ser, samples)
+    return protocol.CurrentRecord(code, *voltages, True, meas_i_a, meas_i_b,
+                                  round(settings['current_settle_time_s'] * 1000), None)
+
+
+def measure_sequenced(ser, codes, config):
+    """
+    Uploads the codes, target current and settle policy with SEQUENCE_COMMAND, so the
+    firmware runs the steps of every code itself and streams one CURRENT_REC per code.
+    Yields a protocol.CurrentRecord per code, or None for codes without a record.
+    """
+    settings = config['current_test_settings']
+    settle_time_s = settings['current_settle_time_s']
+    arguments = (f"{current_to_dac(settings['target_current_a'], config)} {round(settle_time_s * 1000)} "
+                 f"{round(settings.get('current_settle_stable_a', 0.0) * 1e6)} "
+                 f"{round(settings['voltage_tolerance_v'] * 1000)}")
+    # Voltage set and read back, two slave round trips and the settle time
+    record_timeout_s = settle_time_s + 3.0
+
+    for start in range(0, len(codes), SEQUENCE_MAX_CODES):
+        chunk = codes[start:start + SEQUENCE_MAX_CODES]
+        code_list = ",".join(f"{code}:{round(voltage_test.get_expected_voltage(code, switches_on=True) * 1000)}"
+                             for code in chunk)
+        out_of_step_at = None
+        # One span and latency sample for the whole chunk, like every other command
+        with timeline.span(SEQUENCE_COMMAND, 'serial', codes=len(chunk)), metrics.command(SEQUENCE_COMMAND):
+            ser.reset_input_buffer()
+            ser.write(f"{SEQUENCE_COMMAND} {arguments} {code_list}\n".encode('utf-8'))
+            for position, code in enumerate(chunk):
+                # The firmware measures the code while the PC waits for its record
+                with timeline.span(f"code {code:#04x}", 'iteration', sequenced=True):
+                    record = protocol.read_record(ser, protocol.CurrentRecord, timeout=record_timeout_s)
+                if record is None or record.code != code:
+                    print(f"Error: The firmware sent no record for voltage code {code:#04x}.")
+                    # The firmware may still be measuring the rest of the chunk. Wait until it is done,
+                    # so its records do not arrive during later commands and the load current is off.
+                    protocol.read_record(ser, protocol.CurrentSeqDone,
+                                         timeout=(len(chunk) - position) * record_timeout_s)
+                    ser.reset_input_buffer()
+                    out_of_step_at = start + position
+                    break
+                print(f"\n--- Voltage code {code:#04x}: measured on the firmware, settled in {record.settled_ms} ms ---")
+                yield record
+            else:
+                protocol.read_record(ser, protocol.CurrentSeqDone, timeout=1.0)
+        if out_of_step_at is not None:
+            # The sequence is out of step, the remaining codes are reported as not measured
+            for _ in codes[out_of_step_at:]:
+                yield None
+            return
+
+
+def run(ser, config, session_details, logger=None, progress=None):
+    """
+    Main function to execute the current channel test, assuming pre-checks have passed.
+    If the firmware supports SEQUENCE_COMMAND, it runs the loop over the voltage codes
+    itself and the PC only validates and logs the records, so the stage time is set
+    by the settle times instead of USB round trips. Otherwise every step is a command.
+    With a stage progress checkpoint, an interrupted run continues at the first untested code.
+    """
     print("\n" + "=" * 40)
     print("         Running Test: Current Channels")
     print("=" * 40)
 
     settings = config['current_test_settings']
     voltage_codes = settings['voltage_codes_for_current_test']
-    target_current_a = settings['target_current_a']
     current_min_a = settings['current_min_a']
     current_max_a = settings['current_max_a']
-    settle_time_s = settings['current_settle_time_s']
     v_tol = settings['voltage_tolerance_v']
 
-    passed_count = 0
-    failed_count = 0
-    logged_data = []
-
-    for code in voltage_codes:
-        test_pass = True
-        print(f"\n--- Testing with voltage code {code:#04x} ---")
+    state = progress.state if progress else {}
+    start_index = state.get('next_index', 0)
+    logged_data = RecordBuffer.restore(CURRENT_SCHEMA, state.get('logged_data'))
+    publisher.sweep_start("Current Channels", logged_data)
+    failed_count = logged_data.count('result', 0)
+    passed_count = len(logged_data) - failed_count
+    if 0 < start_index < len(voltage_codes):
+        print(f"Resuming at voltage code {voltage_codes[start_index]:#04x}...")
+
+    codes = voltage_codes[start_index:]
+    sequenced = capabilities.select_path(capabilities.get(ser), streaming=SEQUENCE_COMMAND) == 'streaming'
+    if sequenced:
+        print(f"The firmware runs the measurement sequence ({SEQUENCE_COMMAND}).")
+        records = measure_sequenced(ser, codes, config)
+    else:
+        records = measure_stepwise(ser, codes, config)
+
+    # The records come first, so the sequence reads its final CURRENT_SEQ_DONE before the loop ends
+    for index, (record, code) in enumerate(zip(records, codes), start=start_index):
         expected_v = voltage_test.get_expected_voltage(code, switches_on=True)
+        if record is None:
+            record = protocol.CurrentRecord(code, *[protocol.INVALID] * 4, False, NAN, NAN, 0, None)
+        v_spi_a, v_spi_b, v_i2c_a, v_i2c_b = voltages = [
+            protocol.or_invalid(v) for v in (record.v_spi_a, record.v_spi_b, record.v_i2c_a, record.v_i2c_b)]
 
-        print(f"1. Setting voltage to {expected_v:.3f}V...")
-        ser.reset_input_buffer()
-        ser.write(f"SET_VCAN_VOLTAGE {code}\n".encode('utf-8'))
-        response = ser.readline().decode('utf-8').strip()
-
-        v_spi_a, v_spi_b = -1.0, -1.0
-        if response.startswith("VCAN_DATA:"):
-            try:
-                parts = response.split(':')[1].split(',')
-                v_spi_a, v_spi_b = map(float, parts)
-            except (ValueError, IndexError):
-                pass
-
-        v_i2c_a = get_i2c_voltage(ser, 'A')
-        v_i2c_b = get_i2c_voltage(ser, 'B')
-
-        if not (math.isclose(v_spi_a, expected_v, abs_tol=v_tol) and
-                math.isclose(v_i2c_a, expected_v, abs_tol=v_tol) and
-                math.isclose(v_spi_b, expected_v, abs_tol=v_tol) and
-                math.isclose(v_i2c_b, expected_v, abs_tol=v_tol)):
+        if not voltages_ok(voltages, expected_v, v_tol):
             print(f"-> FAIL: Voltage not in range before current test. Exp: {expected_v:.3f}V")
             print(f"    A[SPI:{v_spi_a:.3f} I2C:{v_i2c_a:.3f}] | B[SPI:{v_spi_b:.3f} I2C:{v_i2c_b:.3f}]")
             failed_count += 1
-            test_pass = False
-
-            log_entry = {
-                'voltage_code': code,
-                'expected_v': expected_v,
-                'voltage_check_pass': False,
-                'v_spi_a': v_spi_a, 'v_spi_b': v_spi_b, 'v_i2c_a': v_i2c_a, 'v_i2c_b': v_i2c_b,
-                'current_check_pass': False
-            }
-            logged_data.append(log_entry)
-
-            continue
-
-        print("   Voltage OK.")
-        print(f"2. Setting current to {target_current_a * 1000:.1f}mA...")
-        if not set_current(ser, target_current_a, config):
-            print("-> FAIL: Did not receive ACK for set current command.")
-            failed_count += 1
-            test_pass = False
+            logged_data.append(code, expected_v, False, v_spi_a, v_spi_b, v_i2c_a, v_i2c_b, False, NAN, NAN, False)
 
-            log_entry = {
-                'voltage_code': code,
-                'expected_v': expected_v,
-                'voltage_check_pass': True,
-                'v_spi_a': v_spi_a, 'v_spi_b': v_spi_b, 'v_i2c_a': v_i2c_a, 'v_i2c_b': v_i2c_b,
-                'current_set_ack': False
-            }
-            logged_data.append(log_entry)
-
-            continue
-
-        print("   Current set command sent.")
-        time.sleep(settle_time_s)
-        print("4. Measuring currents...")
-        meas_i_a, meas_i_b = measure_all_currents(ser)
-
-        fail_a = not (current_min_a <= meas_i_a <= current_max_a)
-        fail_b = not (current_min_a <= meas_i_b <= current_max_a)
+        elif not record.current_set and sequenced:
+            # The firmware sets the current only if its own voltage check passes. It compares millivolts,
+            # so at the edge of the tolerance it can fail where the check above passed.
+            print(f"-> FAIL: Voltage not in range on the firmware's check, the current was not set. "
+                  f"Exp: {expected_v:.3f}V")
+            failed_count += 1
+            logged_data.append(code, expected_v, False, v_spi_a, v_spi_b, v_i2c_a, v_i2c_b, False, NAN, NAN, False)
 
-        if fail_a or fail_b:
+        elif not record.current_set:
+            print("-> FAIL: The current was not set (no ACK for the set current command).")
             failed_count += 1
-            fstr_a, fstr_b = ('(FAIL)' if fail_a else ''), ('(FAIL)' if fail_b else '')
-            print(f"-> FAIL: Currents out of range. Exp: {current_min_a * 1000:.1f}-{current_max_a * 1000:.1f}mA")
-            print(f"    A: {meas_i_a * 1000:.1f}mA {fstr_a} | B: {meas_i_b * 1000:.1f}mA {fstr_b}")
-            test_pass = False
+            logged_data.append(code, expected_v, True, v_spi_a, v_spi_b, v_i2c_a, v_i2c_b, False, NAN, NAN, False)
+
         else:
-            passed_count += 1
-            print(f"   Currents OK. (A: {meas_i_a * 1000:.1f}mA, B: {meas_i_b * 1000:.1f}mA)")
-
-        # Log the current test result for this cycle
-        log_entry = {
-            'voltage_code': code,
-            'expected_v': expected_v,
-            'voltage_check_pass': True,
-            'v_spi_a': v_spi_a, 'v_spi_b': v_spi_b, 'v_i2c_a': v_i2c_a, 'v_i2c_b': v_i2c_b,
-            'current_set_ack': True,
-            'meas_i_a': meas_i_a, 'meas_i_b': meas_i_b,
-            'current_min_a': current_min_a, 'current_max_a': current_max_a,
-            'result': 'PASS' if test_pass else 'FAIL'
-        }
-        logged_data.append(log_entry)
+            meas_i_a, meas_i_b = protocol.or_invalid(record.i_a), protocol.or_invalid(record.i_b)
+            fail_a = not (current_min_a <= meas_i_a <= current_max_a)
+            fail_b = not (current_min_a <= meas_i_b <= current_max_a)
+
+            if fail_a or fail_b:
+                failed_count += 1
+                fstr_a, fstr_b = ('(FAIL)' if fail_a else ''), ('(FAIL)' if fail_b else '')
+                print(f"-> FAIL: Currents out of range. Exp: {current_min_a * 1000:.1f}-{current_max_a * 1000:.1f}mA")
+                print(f"    A: {meas_i_a * 1000:.1f}mA {fstr_a} | B: {meas_i_b * 1000:.1f}mA {fstr_b}")
+            else:
+                passed_count += 1
+                print(f"   Currents OK. (A: {meas_i_a * 1000:.1f}mA, B: {meas_i_b * 1000:.1f}mA)")
+
+            # Log the current test result for this cycle
+            logged_data.append(code, expected_v, True, v_spi_a, v_spi_b, v_i2c_a, v_i2c_b, True, meas_i_a, meas_i_b,
+                               not (fail_a or fail_b))
+
+        if progress:
+            progress.update(next_index=index + 1, logged_data=logged_data)
+        publisher.sweep_progress("Current Channels", logged_data)
+
+    if progress:
+        progress.update(next_index=len(voltage_codes), logged_data=logged_data)
+    publisher.sweep_progress("Current Channels", logged_data, flush=True)
 
     set_current(ser, 0, config)
     print("\n--- Current Test Summary ---")
     print(f"Passed={passed_count}, Failed={failed_count}")
 
+    if logger:
+        log_data = {'current_min_a': current_min_a, 'current_max_a': current_max_a, 'sequenced': sequenced,
+                    'records': logged_data}
+        logger.log_data("Current Channels", 'PASS' if failed_count == 0 else 'FAIL', session_details, log_data)
+
     return failed_count == 0, logged_data
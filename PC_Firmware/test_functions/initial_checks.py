@@ -1,32 +1,97 @@
 import time
 import re
 
+from lib import capabilities, protocol, timeline
+from lib.console import ConsoleRenderer
+from lib.device_clock import DeviceClock
+from lib.running_stats import RunningStats, check_stability
+
+CHANNELS = ("cic_v", "cic_i", "vcan_v", "vcan_i")
+
+# Firmware commands this test needs, checked against the device capabilities
+REQUIRED_COMMANDS = ("CHECK_SPI_ADC",)
+
+# Takes 'CHECK_SPI_ADC <n>' on firmware with batches: n conversions aggregated in one reply
+ADC_COMMAND = "CHECK_SPI_ADC"
+
+# Reads both boards in one round trip: the slave converts board B while the master reads board A
+ALL_SPI_COMMAND = "READ_ALL_SPI"
+
 
 def parse_data_response(response):
-    """Parses the 'DATA:' response string into a dictionary of floats."""
-    if not response or not response.startswith("DATA:"):
+    """
+    Parses the 'DATA:' response string into a dictionary of floats.
+    The device timestamp, if present, is returned as 't_device_us'.
+    """
+    record = protocol.decode(response) if response else None
+    if not isinstance(record, protocol.AdcData):
         return None
+    return record._asdict()
 
-    parts = response.replace("DATA:", "").strip().split(',')
-    if len(parts) == 4:
-        try:
-            return {
-                "cic_v": float(parts[0]),
-                "cic_i": float(parts[1]),
-                "vcan_v": float(parts[2]),
-                "vcan_i": float(parts[3])
-            }
-        except (ValueError, IndexError):
-            return None
-    return None
+
+def adc_samples(ser, config):
+    """
+    Returns how many conversions to aggregate per slave ADC read: 'settings.adc_oversampling'
+    limited to the firmware's max batch, or 1 for firmware without batches.
+    """
+    caps = capabilities.get(ser)
+    if capabilities.select_path(caps, batched=ADC_COMMAND) != 'batched':
+        return 1
+    return max(1, min(config['settings'].get('adc_oversampling', 1), caps.max_batch))
+
+
+def read_adc(ser, samples=1, timeout=2.0):
+    """
+    Reads the slave ADC channels. With samples > 1 the firmware takes that many
+    conversions back to back and replies with a protocol.AdcAggregate (mean, min,
+    max and std per channel, the means under the channel names), otherwise with a
+    single protocol.AdcData. Returns None without a valid reply.
+    """
+    if samples > 1:
+        return protocol.query(ser, f"{ADC_COMMAND} {samples}", protocol.AdcAggregate, timeout)
+    return protocol.query(ser, ADC_COMMAND, protocol.AdcData, timeout)
 
 
-def run(ser, config, ranges, session_details, logger=None, is_pre_check=False):
+def read_all_spi(ser, samples=1, timeout=2.0):
+    """
+    Reads the VCAN voltage and current of both boards with one READ_ALL_SPI, as a
+    protocol.AllSpi. With samples > 1 the board B values are the means of that many
+    slave conversions. Board B values the slave did not deliver are protocol.INVALID.
+    Returns None without a valid reply.
+    """
+    command = f"{ALL_SPI_COMMAND} {samples}" if samples > 1 else ALL_SPI_COMMAND
+    record = protocol.query(ser, command, protocol.AllSpi, timeout)
+    if record is None:
+        return None
+    return record._replace(v_b=protocol.or_invalid(record.v_b), i_b=protocol.or_invalid(record.i_b))
+
+
+def run(ser, config, ranges, session_details, logger=None, is_pre_check=False, clock=None):
     """
     Performs initial hardware checks by reading sensor values and
     comparing them against expected ranges from the config file.
+    Each reading carries its device timestamp mapped to wall time ('t_wall')
+    using the given DeviceClock, which is synchronised here if not passed in.
+
+    Besides the per-sample range check, running statistics (mean, std, slope,
+    ripple) are kept per channel over the check window, so noisy or drifting
+    supplies are flagged against 'initial_check_stability' even within range.
+    The short pre-checks before each stage only check the ranges, as their few
+    samples give too noisy a slope to judge.
+    The returned and logged readings are the window means.
+
+    On firmware with batches, every reading is the mean of 'settings.adc_oversampling'
+    conversions taken back to back, so the checks see less noise at the same number
+    of round trips. The largest standard deviation within a reading is logged per
+    channel as 'adc_noise'.
     """
     duration = config['settings']['initial_voltage_duration']
+    interval_s = config['settings'].get('initial_check_interval_s', 0.2)
+    stability = config.get('initial_check_stability', {})
+
+    if clock is None:
+        clock = DeviceClock()
+        clock.sync(ser)
 
     if not is_pre_check:
         print("\n--- Expected Ranges ---")
@@ -41,39 +106,69 @@ def run(ser, config, ranges, session_details, logger=None, is_pre_check=False):
     start_time = time.time()
     all_checks_passed = True
     readings = {}
-
-    while time.time() - start_time < duration:
-        ser.write(b"CHECK_SPI_ADC\n")
-        response = ser.readline().decode('utf-8').strip()
-
-        readings = parse_data_response(response)
-
-        if not readings:
-            print(f"  Error: Invalid response from device: '{response}'")
-            all_checks_passed = False
-            continue
-
-        # Perform checks against the provided ranges
-        checks = {
-            "CIC V": (ranges['cic_v_min'], readings['cic_v'], ranges['cic_v_max']),
-            "VCAN V": (ranges['vcan_v_min'], readings['vcan_v'], ranges['vcan_v_max']),
-            "CIC I": (ranges['cic_i_min'], readings['cic_i'], ranges['cic_i_max']),
-            "VCAN I": (ranges['vcan_i_min'], readings['vcan_i'], ranges['vcan_i_max'])
-        }
-
-        pass_fail_summary = []
-        for name, (min_val, val, max_val) in checks.items():
-            if not (min_val <= val <= max_val):
+    stats = {channel: RunningStats() for channel in CHANNELS}
+    samples = adc_samples(ser, config)
+    noise = dict.fromkeys(CHANNELS, 0.0)
+    read_errors = 0
+
+    with ConsoleRenderer(config['settings'].get('console_refresh_hz', 10)) as console:
+        while time.time() - start_time < duration:
+            record = read_adc(ser, samples)
+            if record is None:
+                console.message("  Error: No valid response from device.")
                 all_checks_passed = False
-                pass_fail_summary.append(f"{name} FAIL")
-
-        if not all_checks_passed:
-            print(f"  FAIL: Readings out of range. {', '.join(pass_fail_summary)}")
-        else:
-            print(f"  OK: CIC V:{readings['cic_v']:.3f}V, I:{readings['cic_i'] * 1000:.1f}mA | "
-                  f"VCAN V:{readings['vcan_v']:.3f}V, I:{readings['vcan_i'] * 1000:.1f}mA")
+                read_errors += 1
+                continue
+            readings = {channel: getattr(record, channel) for channel in CHANNELS}
+            readings['t_device_us'] = record.t_device_us
+            if samples > 1:
+                for channel in CHANNELS:
+                    noise[channel] = max(noise[channel], getattr(record, f"{channel}_std"))
+
+            # Fall back to the PC clock for firmware without device timestamps
+            readings['t_wall'] = clock.to_wall(readings['t_device_us']) or time.time()
+
+            # Perform checks against the provided ranges
+            checks = {
+                "CIC V": (ranges['cic_v_min'], readings['cic_v'], ranges['cic_v_max']),
+                "VCAN V": (ranges['vcan_v_min'], readings['vcan_v'], ranges['vcan_v_max']),
+                "CIC I": (ranges['cic_i_min'], readings['cic_i'], ranges['cic_i_max']),
+                "VCAN I": (ranges['vcan_i_min'], readings['vcan_i'], ranges['vcan_i_max'])
+            }
 
-        time.sleep(0.2)  # Short delay between readings
+            last_t_wall = readings['t_wall']
+            for channel in CHANNELS:
+                stats[channel].add(readings[channel], last_t_wall)
+
+            pass_fail_summary = []
+            for name, (min_val, val, max_val) in checks.items():
+                if not (min_val <= val <= max_val):
+                    all_checks_passed = False
+                    pass_fail_summary.append(f"{name} FAIL")
+
+            if not all_checks_passed:
+                console.message(f"  FAIL: Readings out of range. {', '.join(pass_fail_summary)}")
+            else:
+                console.progress(f"  OK: CIC V:{readings['cic_v']:.3f}V, I:{readings['cic_i'] * 1000:.1f}mA | "
+                                 f"VCAN V:{readings['vcan_v']:.3f}V, I:{readings['vcan_i'] * 1000:.1f}mA")
+
+            timeline.sleep(interval_s, "sample interval")  # Short delay between readings
+
+    # Judge the whole window once enough samples are available for meaningful statistics
+    violations = {}
+    if not is_pre_check and stats[CHANNELS[0]].n >= stability.get('min_samples', 3):
+        for channel in CHANNELS:
+            failed = check_stability(stats[channel], stability.get(channel, {}))
+            if failed:
+                violations[channel] = failed
+    if violations:
+        all_checks_passed = False
+        print("  FAIL: Unstable supply: " +
+              ", ".join(f"{channel} ({'/'.join(failed)})" for channel, failed in violations.items()))
+
+    if stats[CHANNELS[0]].n:
+        readings = {channel: stats[channel].mean for channel in CHANNELS}
+        readings['t_wall'] = last_t_wall
 
     if not is_pre_check:
         print("\n--- Initial Check Complete ---")
@@ -84,6 +179,11 @@ def run(ser, config, ranges, session_details, logger=None, is_pre_check=False):
         log_data = {
             "ranges": ranges,
             "readings": readings,
+            "stats": {channel: stats[channel].as_dict() for channel in CHANNELS},
+            "stability_violations": violations,
+            "read_errors": read_errors,
+            "adc_samples_per_reading": samples,
+            "adc_noise": noise if samples > 1 else None,
             "overall_pass": all_checks_passed
         }
         logger.log_data("Initial Checks", 'PASS' if all_checks_passed else 'FAIL', session_details, log_data)
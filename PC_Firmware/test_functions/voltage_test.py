@@ -1,5 +1,13 @@
-import time
 import math
+from lib import capabilities, protocol, publisher, timeline
+from lib.console import ConsoleRenderer
+from lib.records import RecordBuffer, pass_fail
+
+# Firmware commands this test needs, checked against the device capabilities
+REQUIRED_COMMANDS = ("SET_VCAN_VOLTAGE", "READ_I2C_VOLTAGE_A", "READ_I2C_VOLTAGE_B")
+
+# Reads both channels in one round trip, channel B on the slave while the master reads A
+I2C_VOLTAGES_COMMAND = "READ_I2C_VOLTAGES"
 
 # DIL switches are in the OFF position.
 SWITCHES_OFF_1_25V_CODES = {
@@ -23,6 +31,22 @@ VCAN_3_5V_CODES = {0xcf, 0xdf, 0xef}
 VCAN_4_2V_CODES = {0xf3, 0xf7, 0xfb}
 VCAN_4_7V_CODES = {0xff}
 
+# Expected voltages above this are judged with the high-voltage tolerances
+HIGH_VOLTAGE_V = 4.0
+
+
+# One row per tested code; 'result' is stored as 1 (PASS) / 0 (FAIL)
+VOLTAGE_SCHEMA = (
+    ('byte_val', 'B'),
+    ('switches_on', 'b', bool),
+    ('expected_v', 'd'),
+    ('spi_v_a', 'd'),
+    ('spi_v_b', 'd'),
+    ('i2c_v_a', 'd'),
+    ('i2c_v_b', 'd'),
+    ('result', 'b', pass_fail),
+)
+
 
 def get_expected_voltage(byte_value, switches_on):
     """Calculates the expected voltage based on the corrected, data-driven sets."""
@@ -40,115 +64,177 @@ def get_expected_voltage(byte_value, switches_on):
         return 1.25 if (byte_value & 0x03) == 0x03 else 0.0
 
 
+def voltage_tolerances(expected_v, settings):
+    """
+    Returns the (SPI, I2C) tolerances for an expected voltage from the 'settings'
+    section: the zero threshold at 0 V, the high-voltage tolerances above
+    HIGH_VOLTAGE_V and the normal tolerances otherwise.
+    """
+    if math.isclose(expected_v, 0.0):
+        return settings['zero_threshold_v'], settings['zero_threshold_v']
+    if expected_v > HIGH_VOLTAGE_V:
+        return settings['high_voltage_tolerance_v'], settings['i2c_high_voltage_tolerance_v']
+    return settings['voltage_test_tolerance_v'], settings['i2c_voltage_tolerance_v']
+
+
 def get_i2c_voltage(ser, channel):
-    """Sends a command to read I2C voltage and parses the response."""
-    prefix = f"I2C_VOLTAGE_{channel}:"
-    command = f"READ_I2C_VOLTAGE_{channel}\n"
-    ser.reset_input_buffer()
-    ser.write(command.encode('utf-8'))
-    ser.flush()
-    response = ser.readline().decode('utf-8').strip()
-
-    if not response.startswith(prefix):
-        print(f"Error: Unexpected I2C response for Ch {channel}: {response}")
-        return -999.0
-    try:
-        return float(response.split(':')[1])
-    except (ValueError, IndexError):
-        print(f"Error: Could not parse I2C voltage for Ch {channel}: {response}")
-        return -999.0
-
-
-def run_test_cycle(ser, switches_on, config, session_details, logger):
+    """Reads the I2C voltage of a channel. Returns protocol.INVALID on failure."""
+    record = protocol.query(ser, f"READ_I2C_VOLTAGE_{channel}", protocol.I2cVoltage)
+    if record is None or record.channel != channel:
+        print(f"Error: No valid I2C voltage response for Ch {channel}")
+        return protocol.INVALID
+    return record.v
+
+
+def get_i2c_voltages(ser):
+    """
+    Reads the I2C voltages of both channels, (v_a, v_b). Firmware with READ_I2C_VOLTAGES
+    reads channel B on the slave while the master reads channel A and replies once.
+    Returns protocol.INVALID for a channel without a reading.
+    """
+    if I2C_VOLTAGES_COMMAND not in capabilities.get(ser).commands:
+        return get_i2c_voltage(ser, 'A'), get_i2c_voltage(ser, 'B')
+    record = protocol.query(ser, I2C_VOLTAGES_COMMAND, protocol.I2cVoltages)
+    if record is None:
+        print("Error: No valid I2C voltage response for Ch A and B")
+        return protocol.INVALID, protocol.INVALID
+    if math.isnan(record.v_b):
+        print("Error: No valid I2C voltage response for Ch B")
+    return protocol.or_invalid(record.v_a), protocol.or_invalid(record.v_b)
+
+
+def set_vcan_voltage(ser, code):
+    """
+    Sets the VCAN voltage code on both channels and returns the SPI voltages (v_a, v_b)
+    measured by the master afterwards. Returns protocol.INVALID for a missing reply.
+    """
+    record = protocol.query(ser, f"SET_VCAN_VOLTAGE {code}", protocol.VcanData)
+    if record is None:
+        return protocol.INVALID, protocol.INVALID
+    return record.v_a, record.v_b
+
+
+def run_test_cycle(ser, switches_on, config, session_details, logger, start_code=0, logged_data=None,
+                   on_progress=None):
     """
     Runs through all 256 combinations, checking both SPI and I2C voltages.
+    Results are collected in a RecordBuffer with VOLTAGE_SCHEMA.
+    To resume an interrupted cycle, pass the first code still to test as 'start_code'
+    and the buffer logged so far as 'logged_data'. 'on_progress' is called with the
+    next code and the logged data after each checked code.
     """
     print(f"\n--- Testing all 256 combinations with DIL switches {'ON' if switches_on else 'OFF'} ---")
-    time.sleep(0.5)
-
-    # Load tolerance values from config
-    v_spi_tol = config['settings']['voltage_test_tolerance_v']
-    zero_thresh = config['settings']['zero_threshold_v']
-    high_v_tol = config['settings']['high_voltage_tolerance_v']
-    v_i2c_tol = config['settings']['i2c_voltage_tolerance_v']
-    i2c_high_v_tol = config['settings']['i2c_high_voltage_tolerance_v']
-
-    passed_count = 0
-    failed_count = 0
-
-    logged_data = []
-
-    for byte_val in range(257):
-        if byte_val > 0:
-            byte_to_check = byte_val - 1
-            expected_v = get_expected_voltage(byte_to_check, switches_on)
-
-            # Determine dynamic tolerance for SPI voltage
-            current_spi_tol = zero_thresh if math.isclose(expected_v, 0.0) else \
-                high_v_tol if expected_v > 4.0 else v_spi_tol
-
-            # Determine dynamic tolerance for I2C voltage
-            current_i2c_tol = zero_thresh if math.isclose(expected_v, 0.0) else \
-                i2c_high_v_tol if expected_v > 4.0 else v_i2c_tol
-
-            # Perform checks for both SPI and I2C channels
-            fail_spi_a = not math.isclose(v_spi_a, expected_v, abs_tol=current_spi_tol)
-            fail_spi_b = not math.isclose(v_spi_b, expected_v, abs_tol=current_spi_tol)
-            fail_i2c_a = not math.isclose(v_i2c_a, expected_v, abs_tol=current_i2c_tol)
-            fail_i2c_b = not math.isclose(v_i2c_b, expected_v, abs_tol=current_i2c_tol)
-
-            # A channel fails if either its SPI or I2C reading is out of tolerance
-            fail_a = fail_spi_a or fail_i2c_a
-            fail_b = fail_spi_b or fail_i2c_b
-
-            result_str = 'FAIL' if fail_a or fail_b else 'PASS'
-
-            if fail_a or fail_b:
-                failed_count += 1
-                fstr_a = '(FAIL)' if fail_a else ''
-                fstr_b = '(FAIL)' if fail_b else ''
-                print(f"-> FAIL @ {byte_to_check:#04x} (exp: {expected_v:.3f}V): "
-                      f"A[SPI:{v_spi_a:.3f} I2C:{v_i2c_a:.3f}]{fstr_a} | "
-                      f"B[SPI:{v_spi_b:.3f} I2C:{v_i2c_b:.3f}]{fstr_b}")
-            else:
-                passed_count += 1
-                print(f"  OK   @ {byte_to_check:#04x} (exp: {expected_v:.3f}V): "
-                      f"A[SPI:{v_spi_a:.3f} I2C:{v_i2c_a:.3f}] | "
-                      f"B[SPI:{v_spi_b:.3f} I2C:{v_i2c_b:.3f}]")
-
-            # Log data for each combination
-            test_data = {
-                'byte_val': byte_to_check,
-                'switches_on': switches_on,
-                'expected_v': expected_v,
-                'spi_v_a': v_spi_a,
-                'spi_v_b': v_spi_b,
-                'i2c_v_a': v_i2c_a,
-                'i2c_v_b': v_i2c_b,
-                'result': result_str
-            }
-            logged_data.append(test_data)
-
-        if byte_val < 256:
-            # Get SPI voltages
-            ser.reset_input_buffer()
-            command = f"SET_VCAN_VOLTAGE {byte_val}\n"
-            ser.write(command.encode('utf-8'))
-            response = ser.readline().decode('utf-8').strip()
-            if response.startswith("VCAN_DATA:"):
-                try:
-                    parts = response.split(':')[1].split(',')
-                    v_spi_a, v_spi_b = map(float, parts)
-                except (ValueError, IndexError):
-                    v_spi_a, v_spi_b = -998.0, -998.0
-            else:
-                v_spi_a, v_spi_b = -999.0, -999.0
-
-            # Get I2C voltages for both channels
-            v_i2c_a = get_i2c_voltage(ser, 'A')
-            v_i2c_b = get_i2c_voltage(ser, 'B')
-
+    if start_code > 0:
+        print(f"Resuming at code {start_code:#04x}...")
+    timeline.sleep(0.5)
+
+    settings = config['settings']
+
+    if logged_data is None:
+        logged_data = RecordBuffer(VOLTAGE_SCHEMA)
+    publisher.sweep_start("Voltage Channels", logged_data)
+    failed_count = logged_data.count('result', 0)
+    passed_count = len(logged_data) - failed_count
+
+    # Passing codes only update the status line, failures are printed in full
+    with ConsoleRenderer(config['settings'].get('console_refresh_hz', 10)) as console:
+        for byte_val in range(start_code, 257):
+            if byte_val > start_code:
+                byte_to_check = byte_val - 1
+                expected_v = get_expected_voltage(byte_to_check, switches_on)
+
+                # Dynamic tolerances for the SPI and I2C voltages
+                current_spi_tol, current_i2c_tol = voltage_tolerances(expected_v, settings)
+
+                # Perform checks for both SPI and I2C channels
+                fail_spi_a = not math.isclose(v_spi_a, expected_v, abs_tol=current_spi_tol)
+                fail_spi_b = not math.isclose(v_spi_b, expected_v, abs_tol=current_spi_tol)
+                fail_i2c_a = not math.isclose(v_i2c_a, expected_v, abs_tol=current_i2c_tol)
+                fail_i2c_b = not math.isclose(v_i2c_b, expected_v, abs_tol=current_i2c_tol)
+
+                # A channel fails if either its SPI or I2C reading is out of tolerance
+                fail_a = fail_spi_a or fail_i2c_a
+                fail_b = fail_spi_b or fail_i2c_b
+
+                if fail_a or fail_b:
+                    failed_count += 1
+                    fstr_a = '(FAIL)' if fail_a else ''
+                    fstr_b = '(FAIL)' if fail_b else ''
+                    console.message(f"-> FAIL @ {byte_to_check:#04x} (exp: {expected_v:.3f}V): "
+                                    f"A[SPI:{v_spi_a:.3f} I2C:{v_i2c_a:.3f}]{fstr_a} | "
+                                    f"B[SPI:{v_spi_b:.3f} I2C:{v_i2c_b:.3f}]{fstr_b}")
+                else:
+                    passed_count += 1
+                    console.progress(f"  OK   @ {byte_to_check:#04x} (exp: {expected_v:.3f}V): "
+                                     f"A[SPI:{v_spi_a:.3f} I2C:{v_i2c_a:.3f}] | "
+                                     f"B[SPI:{v_spi_b:.3f} I2C:{v_i2c_b:.3f}] | "
+                                     f"Passed={passed_count} Failed={failed_count}")
+
+                # Log data for each combination
+                logged_data.append(byte_to_check, switches_on, expected_v, v_spi_a, v_spi_b, v_i2c_a, v_i2c_b,
+                                   not (fail_a or fail_b))
+                if on_progress:
+                    on_progress(byte_val, logged_data)
+                publisher.sweep_progress("Voltage Channels", logged_data)
+
+            if byte_val < 256:
+                with timeline.span(f"code {byte_val:#04x}", 'iteration'):
+                    # Get SPI voltages
+                    v_spi_a, v_spi_b = set_vcan_voltage(ser, byte_val)
+
+                    # Get I2C voltages for both channels
+                    v_i2c_a, v_i2c_b = get_i2c_voltages(ser)
+
+    publisher.sweep_progress("Voltage Channels", logged_data, flush=True)
     print(f"\nSummary: Passed={passed_count}/256, Failed={failed_count}/256")
 
     # Return overall result and all logged data
     return failed_count == 0, logged_data
+
+
+def run(ser, config, session_details, logger=None, progress=None):
+    """
+    Runs the 256-code sweep twice, first with the DIL switches OFF and then ON.
+    The operator is asked to set the switches before each pass. With a stage
+    progress checkpoint, finished passes are skipped and an interrupted pass
+    continues from the last checked code.
+    """
+    print("\n" + "=" * 40)
+    print("         Running Test: Voltage Channels")
+    print("=" * 40)
+
+    state = progress.state if progress else {}
+    all_data = RecordBuffer.restore(VOLTAGE_SCHEMA, state.get('logged_data'))
+    all_passed = all_data.count('result', 0) == 0
+
+    for switches_on in (False, True):
+        pass_name = 'ON' if switches_on else 'OFF'
+        if pass_name in state.get('completed_passes', []):
+            print(f"Skipping DIL switches {pass_name} pass (already completed).")
+            continue
+
+        partial = state.get('partial', {}) if state.get('partial_pass') == pass_name else {}
+        with timeline.span("operator prompt", 'wait'):
+            input(f"Set the DIL switches to {pass_name} and press Enter to continue...")
+
+        def save_progress(next_code, logged, pass_name=pass_name):
+            if progress:
+                progress.update(partial_pass=pass_name, partial={'next_code': next_code, 'logged_data': logged})
+
+        cycle_passed, cycle_data = run_test_cycle(ser, switches_on, config, session_details, logger,
+                                                  start_code=partial.get('next_code', 0),
+                                                  logged_data=RecordBuffer.restore(VOLTAGE_SCHEMA,
+                                                                                   partial.get('logged_data')),
+                                                  on_progress=save_progress)
+        all_passed = all_passed and cycle_passed
+        all_data.extend(cycle_data)
+
+        if progress:
+            progress.update(force=True, logged_data=all_data, partial_pass=None, partial={},
+                            completed_passes=state.get('completed_passes', []) + [pass_name])
+
+    if logger:
+        logger.log_data("Voltage Channels", 'PASS' if all_passed else 'FAIL', session_details,
+                        {'records': all_data})
+
+    return all_passed, all_data